@@ -0,0 +1,105 @@
+import functools
+import numpy as np
+import pandas as pd
+import pyBigWig
+from concurrent.futures import ProcessPoolExecutor
+
+
+########################################################################################
+# Bulk bigWig signal extraction
+########################################################################################
+
+
+def interval_stats(bw_path, chroms, starts, ends, max_read=10000000):
+    """
+    Mean and max signal of a bigWig track in many intervals. Intervals are sorted per chromosome and nearby ones
+    are read together in blocks of up to max_read bp, then reduced per interval with vectorized reductions.
+    inputs:
+        bw_path : str
+            Path of the bigWig file.
+        chroms, starts, ends : np.arrays
+            Coordinates of the intervals (end exclusive).
+        max_read : int
+            Largest span in bp of one read.
+
+    Returns
+    -------
+        np.arrays : mean and max signal per interval in input order, NaN if part of an interval has no data.
+    """
+    chroms, starts, ends = np.asarray(chroms), np.asarray(starts, dtype=int), np.asarray(ends, dtype=int)
+    means = np.empty(len(starts))
+    maxs = np.empty(len(starts))
+    bw = pyBigWig.open(bw_path)
+    try:
+        for chrom in np.unique(chroms):
+            rows = np.flatnonzero(chroms == chrom)
+            rows = rows[np.argsort(starts[rows], kind='stable')]
+            for block in _blocks(starts[rows], ends[rows], max_read):
+                block_rows = rows[block]
+                means[block_rows], maxs[block_rows] = _block_stats(bw, chrom, starts[block_rows], ends[block_rows])
+    finally:
+        bw.close()
+    return means, maxs
+
+
+def _blocks(starts, ends, max_read):
+    """Split intervals sorted by start into consecutive slices that span at most max_read bp (or one interval)."""
+    blocks = []
+    first = 0
+    block_end = ends[0]
+    for k in range(1, len(starts)):
+        if max(block_end, ends[k]) - starts[first] > max_read:
+            blocks.append(slice(first, k))
+            first = k
+            block_end = ends[k]
+        else:
+            block_end = max(block_end, ends[k])
+    blocks.append(slice(first, len(starts)))
+    return blocks
+
+
+def _block_stats(bw, chrom, starts, ends):
+    """Mean and max of intervals from one read of the block they span."""
+    offset = starts.min()
+    values = np.asarray(bw.values(chrom, int(offset), int(ends.max()), numpy=True), dtype=np.float64)
+    # sentinel so that reduceat can index the end of the last interval
+    values = np.append(values, 0)
+    bounds = np.column_stack([starts - offset, ends - offset]).ravel()
+    sums = np.add.reduceat(values, bounds)[::2]
+    maxs = np.maximum.reduceat(values, bounds)[::2]
+    return sums / (ends - starts), maxs
+
+
+def signal_table(tracks, intervals, num_workers=4, max_read=10000000):
+    """
+    Tidy table of the mean and max signal of every bigWig track in every interval, with one worker process per
+    track at a time.
+    inputs:
+        tracks : pd.DataFrame
+            Row per track with a path column (bigWig file) and descriptor columns copied to the table.
+        intervals : pd.DataFrame
+            Row per interval with chrom, start and end columns and descriptor columns copied to the table.
+        num_workers : int
+            Number of worker processes.
+        max_read : int
+            Largest span in bp of one read.
+
+    Returns
+    -------
+        pd.DataFrame with a row per track and interval (intervals in order, grouped by track) and mean and max
+        columns.
+    """
+    stats_fn = functools.partial(interval_stats, chroms=intervals['chrom'].values, starts=intervals['start'].values,
+                                 ends=intervals['end'].values, max_read=max_read)
+    with ProcessPoolExecutor(num_workers) as executor:
+        stats = list(executor.map(stats_fn, tracks['path']))
+
+    table = []
+    for (_, track), (means, maxs) in zip(tracks.iterrows(), stats):
+        df = intervals.copy()
+        df['mean'] = means
+        df['max'] = maxs
+        for column, value in track.items():
+            df[column] = value
+        table.append(df)
+    return pd.concat(table, ignore_index=True)
@@ -2,13 +2,16 @@ import numpy as np
 import shuffle
 from tqdm import tqdm
 import operator
+import itertools
+import profiling
 
 
 ############################################################################################
 # TSS Context Dependence Test
 ############################################################################################
 
-def context_dependence_test(model, x, tile_pos, num_shuffle, mean=True, drop_wt=False):
+@profiling.profile('context_dependence_test')
+def context_dependence_test(model, x, tile_pos, num_shuffle, mean=True, drop_wt=False, tol=None, max_shuffle=None):
     """
     This test embeds a sequence pattern bounded by start and end in shuffled
     background contexts -- in line with a global importance analysis.
@@ -29,12 +32,18 @@ def context_dependence_test(model, x, tile_pos, num_shuffle, mean=True, drop_wt=
         drop_wt : bool
             If true, do not run predictions on the WT sequence. Use this to avoid the computational
             cost if predictions are already available.
+        tol : float
+            If set, draw shuffles in batches of num_shuffle until the 95% confidence interval of the mean
+            prediction is within tol relative to the WT prediction (see sample_shuffles). Requires mean=True.
+        max_shuffle : int
+            Maximum number of shuffles in adaptive mode, defaults to 10 * num_shuffle.
 
     Returns
     -------
-        np.array : prediction of wild type sequence.
-        np.array : prediction of mutant sequences.
+        list : WT sequence prediction, mean and standard deviation of mutant predictions or all mutant predictions
+        without averaging. In adaptive mode, the number of shuffles used is appended.
     """
+    assert tol is None or mean, 'adaptive number of shuffles requires mean=True'
 
     # get wild-type prediction
     if drop_wt:
@@ -47,23 +56,27 @@ def context_dependence_test(model, x, tile_pos, num_shuffle, mean=True, drop_wt=
     x_pattern = x[start:end, :]
 
     # loop over shuffles
-    pred_mut = []
-    for n in range(num_shuffle):
+    def predict_shuffle(n):
         x_mut = shuffle.dinuc_shuffle(x)
         x_mut[start:end, :] = x_pattern
-        pred_mut.append(model.predict(x_mut)[np.newaxis][0])
+        return model.predict(x_mut)[np.newaxis][0]
+    pred_mut, = sample_shuffles(predict_shuffle, num_shuffle, tol, max_shuffle, scale=pred_wt[0])
     pred_mut = np.concatenate(pred_mut, axis=0)
 
     if mean:
-        return pred_wt[0], np.mean(pred_mut, axis=0), np.std(pred_mut, axis=0)
+        test_res = [pred_wt[0], np.mean(pred_mut, axis=0), np.std(pred_mut, axis=0)]
     else:
-        return pred_wt, pred_mut
+        test_res = [pred_wt, pred_mut]
+    if tol is not None:
+        test_res.append(len(pred_mut))
+    return test_res
 
 
 ############################################################################################
 # TSS Context Swap Test
 ############################################################################################
 
+@profiling.profile('context_swap_test')
 def context_swap_test(model, x_source, x_target, tile_pos):
     """
     This test places a source sequence pattern bounded by start and end in a 
@@ -104,10 +117,135 @@ def context_swap_test(model, x_source, x_target, tile_pos):
     return pred_mut
 
 
+@profiling.profile('context_swap_block')
+def context_swap_block(model, src_tokens, dest_tokens, tile_pos, bin_index=None, mask=None):
+    """
+    Context swap test of every source and target pair of a block of sequences in one model.predict call.
+
+    Parameters
+    ----------
+        model : keras.Model
+            A keras model.
+        src_tokens : np.array
+            Source sequences as tokens (0-3 for ACGT, 4 for N, see shuffle.one_hot_to_tokens), shape (S, L).
+        dest_tokens : np.array
+            Target sequences as tokens, shape (D, L).
+        tile_pos : list
+            List of start and end index of pattern along L.
+        bin_index : list
+            Prediction bins to average, defaults to all bins.
+        mask : np.array
+            Pairs to predict, shape (S, D). Defaults to all pairs.
+
+    Returns
+    -------
+        np.array : predictions of the source patterns in the target contexts averaged over bins, shape (S, D, tracks),
+        or (number of pairs in mask, tracks) if mask is given.
+    """
+    start, end = tile_pos
+    tokens = np.repeat(dest_tokens[np.newaxis], len(src_tokens), axis=0)
+    tokens[:, :, start:end] = src_tokens[:, np.newaxis, start:end]
+    if mask is not None:
+        tokens = tokens[mask]
+
+    # one-hot only for the block, with all zeros for N
+    x_mut = np.eye(5, 4, dtype=np.float32)[tokens.reshape(-1, src_tokens.shape[1])]
+    pred_mut = model.predict(x_mut)
+    if bin_index is not None:
+        pred_mut = pred_mut[:, bin_index]
+    pred_mut = pred_mut.mean(axis=1)
+    if mask is not None:
+        return pred_mut
+    return pred_mut.reshape(len(src_tokens), len(dest_tokens), -1)
+
+
+@profiling.profile('context_swap_all_pairs')
+def context_swap_all_pairs(model, seqs, tile_pos, block_size=4, bin_index=None, swap_matrix=None, done=None,
+                           blocks=None, sources=None, targets=None, wt_preds=None):
+    """
+    Context swap test of all pairs of sequences, or of a sub-block of sources and targets. Sources and targets are
+    streamed through the model in blocks of block_size x block_size pairs (one model.predict call per block) and
+    finished blocks are marked in done, so an interrupted run resumes at block level. A source in its own context is
+    the WT sequence, so these pairs are taken from wt_preds when available instead of predicted.
+
+    Parameters
+    ----------
+        model : keras.Model
+            A keras model.
+        seqs : np.array
+            Sequences as tokens (see shuffle.one_hot_to_tokens), shape (N, L).
+        tile_pos : list
+            List of start and end index of pattern along L.
+        block_size : int
+            Number of sources and of targets per block.
+        bin_index : list
+            Prediction bins to average, defaults to all bins.
+        swap_matrix : np.array
+            Output of shape (number of sources, number of targets, tracks), e.g. memory-mapped with
+            utils.open_prediction_matrix. Allocated if None.
+        done : np.array
+            Bitmap of finished blocks, shape (ceil(number of sources / block_size), ceil(number of targets / block_size)).
+        blocks : iterable
+            (source block, target block) indices to compute, e.g. claimed from a work queue. Defaults to all blocks.
+        sources : list
+            Indices of the source sequences (rows of the swap matrix), defaults to all sequences.
+        targets : list
+            Indices of the target sequences (columns of the swap matrix), defaults to all sequences.
+        wt_preds : np.array
+            WT predictions averaged over the same bins, shape (N, tracks), NaN for sequences without WT prediction.
+
+    Returns
+    -------
+        np.array : swap matrix with the prediction of each source pattern (rows) in each target context (columns).
+    """
+    sources = np.arange(len(seqs)) if sources is None else np.asarray(sources)
+    targets = np.arange(len(seqs)) if targets is None else np.asarray(targets)
+    num_blocks = (-(-len(sources) // block_size), -(-len(targets) // block_size))
+    if done is None:
+        done = np.zeros(num_blocks, dtype=bool)
+    if blocks is None:
+        blocks = itertools.product(range(num_blocks[0]), range(num_blocks[1]))
+
+    for i, j in blocks:
+        if done[i, j]:
+            continue
+        rows = slice(i * block_size, (i + 1) * block_size)
+        columns = slice(j * block_size, (j + 1) * block_size)
+        src, dest = sources[rows], targets[columns]
+
+        # reuse WT predictions for sources in their own context
+        reuse = src[:, np.newaxis] == dest[np.newaxis]
+        if wt_preds is None:
+            reuse[:] = False
+        else:
+            reuse &= ~np.isnan(wt_preds[src]).any(axis=-1)[:, np.newaxis]
+        pred = None
+        if not reuse.all():
+            pred_pairs = context_swap_block(model, seqs[src], seqs[dest], tile_pos, bin_index, mask=~reuse)
+            pred = np.empty(reuse.shape + pred_pairs.shape[-1:], dtype=np.float32)
+            pred[~reuse] = pred_pairs
+        if reuse.any():
+            if pred is None:
+                pred = np.empty(reuse.shape + wt_preds.shape[-1:], dtype=np.float32)
+            pred[reuse] = wt_preds[np.broadcast_to(src[:, np.newaxis], reuse.shape)[reuse]]
+        if swap_matrix is None:
+            swap_matrix = np.full((len(sources), len(targets), pred.shape[-1]), np.nan, dtype=np.float32)
+
+        # block is marked done only after its predictions are written
+        swap_matrix[rows, columns] = pred
+        if hasattr(swap_matrix, 'flush'):
+            swap_matrix.flush()
+        done[i, j] = True
+        if hasattr(done, 'flush'):
+            done.flush()
+    return swap_matrix
+
+
 ############################################################################################
 # CRE Necessity Test
 ############################################################################################
 
+@profiling.profile('generate_tile_shuffles')
 def generate_tile_shuffles(x, tile_set, num_shuffle):
     """
     inputs:
@@ -136,7 +274,8 @@ def generate_tile_shuffles(x, tile_set, num_shuffle):
     return seq_mut
 
 
-def necessity_test(model, x, tiles, num_shuffle, mean=True, return_seqs=False):
+@profiling.profile('necessity_test')
+def necessity_test(model, x, tiles, num_shuffle, mean=True, return_seqs=False, seed=False, tol=None, max_shuffle=None):
     """
     This test systematically measures how tile shuffles affects model predictions. 
 
@@ -154,12 +293,22 @@ def necessity_test(model, x, tiles, num_shuffle, mean=True, return_seqs=False):
             If True, return the mean predictions across shuffles, otherwise return full predictions.
         return_seqs : bool
             If True, return generated sequences for future use.
+        seed : bool
+            If True, set a seed for the random dinuc shuffle of each tile so that repeated runs use the same shuffles.
+        tol : float
+            If set, draw shuffles of each tile in batches of num_shuffle until the 95% confidence interval of the
+            mean prediction is within tol relative to the WT prediction (see sample_shuffles). Requires mean=True
+            and return_seqs=False.
+        max_shuffle : int
+            Maximum number of shuffles per tile in adaptive mode, defaults to 10 * num_shuffle.
 
     Returns
     -------
         list : WT sequence prediction, mean and standard deviation of mutant predictions (with shuffled tile) or
-        all mutant predictions without averaging and (optionally) return generated sequences.
+        all mutant predictions without averaging and (optionally) return generated sequences. In adaptive mode,
+        the number of shuffles used per tile is appended.
     """
+    assert tol is None or (mean and not return_seqs), 'adaptive number of shuffles requires mean=True'
 
     # get wild-type prediction
     pred_wt = model.predict(x[np.newaxis])
@@ -171,25 +320,30 @@ def necessity_test(model, x, tiles, num_shuffle, mean=True, return_seqs=False):
         start, end = pos
 
         # loop over number of shuffles
-        pred_shuffle = []
-
-        for n in range(num_shuffle):
+        def predict_shuffle(n):
             x_mut = np.copy(x)
 
             # shuffle tile
-            x_mut[start:end, :] = shuffle.dinuc_shuffle(x_mut[start:end, :])
-            all_muts[tile_i, n, :, :] = x_mut
+            if seed:
+                x_mut[start:end, :] = shuffle.dinuc_shuffle(x_mut[start:end, :], seed=n + 1)
+            else:
+                x_mut[start:end, :] = shuffle.dinuc_shuffle(x_mut[start:end, :])
+            if tol is None:
+                all_muts[tile_i, n, :, :] = x_mut
             # predict mutated sequence
-            pred_shuffle.append(model.predict(x_mut[np.newaxis])[0])
+            return model.predict(x_mut[np.newaxis])[0]
+        pred_shuffle, = sample_shuffles(predict_shuffle, num_shuffle, tol, max_shuffle, scale=pred_wt[0])
         pred_mut.append(pred_shuffle)
-    pred_mut = np.array(pred_mut)
 
     if mean:
-        test_res = [pred_wt, np.mean(pred_mut, axis=1), np.std(pred_mut, axis=1)]
+        test_res = [pred_wt, np.array([np.mean(p, axis=0) for p in pred_mut]),
+                    np.array([np.std(p, axis=0) for p in pred_mut])]
     else:
-        test_res = [pred_wt, pred_mut]
+        test_res = [pred_wt, np.array(pred_mut)]
     if return_seqs:
         test_res.append(all_muts)
+    if tol is not None:
+        test_res.append(np.array([len(p) for p in pred_mut]))
     return test_res
 
 
@@ -197,7 +351,9 @@ def necessity_test(model, x, tiles, num_shuffle, mean=True, return_seqs=False):
 # CRE Sufficiency Test
 ############################################################################################
 
-def sufficiency_test(model, x, tss_tile, tiles, num_shuffle, tile_seq=None, mean=True, return_seqs=False):
+@profiling.profile('sufficiency_test')
+def sufficiency_test(model, x, tss_tile, tiles, num_shuffle, tile_seq=None, mean=True, return_seqs=False,
+                     seed=False, tol=None, max_shuffle=None):
     """
     This test measures if a region of the sequence together with the TSS tile is sufficient to get model
     predictions same as in the WT case.
@@ -221,14 +377,24 @@ def sufficiency_test(model, x, tss_tile, tiles, num_shuffle, tile_seq=None, mean
             If True, return the mean predictions across shuffles, otherwise return full predictions.
         return_seqs : bool
             If True, return the generated mutant sequences.
+        seed : bool
+            If True, set a seed for the random dinuc shuffle of sequence so that repeated runs use the same backgrounds.
+        tol : float
+            If set, draw shuffles of each tile in batches of num_shuffle until the 95% confidence intervals of the
+            mean mutant and control predictions are within tol relative to the WT prediction (see sample_shuffles).
+            Requires mean=True and return_seqs=False.
+        max_shuffle : int
+            Maximum number of shuffles per tile in adaptive mode, defaults to 10 * num_shuffle.
 
     Returns
     -------
         list of numpy arrays. Depending on arguments returns either the WT prediction, mean and standard deviation of
         mutant sequence (dinuc shuffled sequence with TSS and tile) predictions, mean and standard deviation of
         control sequences (dinuc shuffled sequence with TSS only) or all the predictions without averaging and
-        (optionally) the constructed mutant sequences.
+        (optionally) the constructed mutant sequences. In adaptive mode, the number of shuffles used per tile is
+        appended.
     """
+    assert tol is None or (mean and not return_seqs), 'adaptive number of shuffles requires mean=True'
 
     # get wild-type prediction
     pred_wt = model.predict(x[np.newaxis])
@@ -239,17 +405,19 @@ def sufficiency_test(model, x, tss_tile, tiles, num_shuffle, tile_seq=None, mean
     for pos in tiles:
         start, end = pos
 
-        pred_mut_shuffle = []
-        pred_control_shuffle = []
         sequences = np.empty((num_shuffle, model.seq_length, 4))
-        for n in range(num_shuffle):
-            x_mut = shuffle.dinuc_shuffle(x)
+        def predict_shuffle(n):
+            if seed:
+                x_mut = shuffle.dinuc_shuffle(x, seed=n + 1)
+            else:
+                x_mut = shuffle.dinuc_shuffle(x)
 
             # embed tss tile
             x_mut[tss_tile[0]:tss_tile[1], :] = x[tss_tile[0]:tss_tile[1], :]
-            sequences[n] = x_mut.copy()
+            if tol is None:
+                sequences[n] = x_mut.copy()
             # predict shuffled context with just TSS
-            pred_control_shuffle.append(model.predict(x_mut[np.newaxis])[0])
+            pred_control_shuffle = model.predict(x_mut[np.newaxis])[0]
 
             # embed tile of interest in
             if tile_seq:
@@ -258,22 +426,25 @@ def sufficiency_test(model, x, tss_tile, tiles, num_shuffle, tile_seq=None, mean
                 x_mut[start:end, :] = x[start:end, :]
 
             # predict mutated sequence
-            pred_mut_shuffle.append(model.predict(x_mut[np.newaxis])[0])
+            return model.predict(x_mut[np.newaxis])[0], pred_control_shuffle
+        pred_mut_shuffle, pred_control_shuffle = sample_shuffles(predict_shuffle, num_shuffle, tol, max_shuffle,
+                                                                 scale=pred_wt[0])
 
         # store results
         pred_mut.append(pred_mut_shuffle)
         pred_control.append(pred_control_shuffle)
 
-    pred_mut = np.array(pred_mut)
-    pred_control = np.array(pred_control)
-
     if mean:
-        test_res = [pred_wt[0], np.mean(pred_mut, axis=1), np.std(pred_mut, axis=1), np.mean(pred_control, axis=1),
-                    np.std(pred_control, axis=1)]
+        test_res = [pred_wt[0], np.array([np.mean(p, axis=0) for p in pred_mut]),
+                    np.array([np.std(p, axis=0) for p in pred_mut]),
+                    np.array([np.mean(p, axis=0) for p in pred_control]),
+                    np.array([np.std(p, axis=0) for p in pred_control])]
     else:
-        test_res = [pred_wt, pred_mut, pred_control]
+        test_res = [pred_wt, np.array(pred_mut), np.array(pred_control)]
     if return_seqs:
         test_res.append(sequences)
+    if tol is not None:
+        test_res.append(np.array([len(p) for p in pred_mut]))
     return test_res
 
 
@@ -281,7 +452,9 @@ def sufficiency_test(model, x, tss_tile, tiles, num_shuffle, tile_seq=None, mean
 # TSS-CRE Distance Test
 ############################################################################################
 
-def distance_test(model, x, tile_fixed_coord, tile_var_coord, test_positions, num_shuffle, mean=True, seed=False):
+@profiling.profile('distance_test')
+def distance_test(model, x, tile_fixed_coord, tile_var_coord, test_positions, num_shuffle, mean=True, seed=False,
+                  tol=None, max_shuffle=None):
     """
     This test maps out the distance dependence of tile1 (anchored) and tile 2 (variable position).
     Tiles are placed in dinuc shuffled background contexts, in line with global importance analysis. 
@@ -305,22 +478,28 @@ def distance_test(model, x, tile_fixed_coord, tile_var_coord, test_positions, nu
         seed: bool
             If Ture, set a seed for the random dinuc shuffle of sequence and use the same background sequences
             for all position tests (per sequence).
+        tol : float
+            If set, draw shuffles of the control and of each position in batches of num_shuffle until the 95%
+            confidence interval of the mean prediction is within tol relative to the mean control prediction
+            (see sample_shuffles). Requires mean=True.
+        max_shuffle : int
+            Maximum number of shuffles per position in adaptive mode, defaults to 10 * num_shuffle.
 
     Returns
     -------
         dict: results organized as dictionary containing control (i.e. sequence with TSS and tile in original position)
         and mutant (variable tile location) predictions (either summarized as mean and standard deviation or all the
-        predictions).
+        predictions). In adaptive mode, also the number of shuffles used for the control and for each position.
 
     """
+    assert tol is None or mean, 'adaptive number of shuffles requires mean=True'
 
     # crop pattern of interest
     x_tile_fixed = x[tile_fixed_coord[0]:tile_fixed_coord[1], :]  # fixed tile sequence
     x_tile_var = x[tile_var_coord[0]:tile_var_coord[1], :]  # variable position tile sequence
 
     # get sufficiency of tiles in original positions
-    pred_control = []
-    for n in range(num_shuffle):
+    def predict_control(n):
         # shuffle sequence and place tiles in respective positions
         if seed:
             x_mut = shuffle.dinuc_shuffle(x, seed=n)
@@ -330,8 +509,8 @@ def distance_test(model, x, tile_fixed_coord, tile_var_coord, test_positions, nu
         x_mut[tile_var_coord[0]:tile_var_coord[1], :] = x_tile_var
 
         # predict mutant sequence
-        pred_control.append(model.predict(x_mut[np.newaxis])[0])
-    pred_control = np.array(pred_control)
+        return model.predict(x_mut[np.newaxis])[0]
+    pred_control, = sample_shuffles(predict_control, num_shuffle, tol, max_shuffle)
 
     # loop over embedding tile_var in available position list
     pred_mut = []
@@ -339,8 +518,7 @@ def distance_test(model, x, tile_fixed_coord, tile_var_coord, test_positions, nu
     for start in tqdm(test_positions):
 
         # loop over number of shuffles
-        pred_shuffle = []
-        for n in range(num_shuffle):
+        def predict_shuffle(n):
 
             # shuffle sequence
             if seed:
@@ -355,15 +533,20 @@ def distance_test(model, x, tile_fixed_coord, tile_var_coord, test_positions, nu
             x_mut[start:start + tile_len, :] = x_tile_var
 
             # predict mutant sequence
-            pred_shuffle.append(model.predict(x_mut[np.newaxis])[0])
+            return model.predict(x_mut[np.newaxis])[0]
+        pred_shuffle, = sample_shuffles(predict_shuffle, num_shuffle, tol, max_shuffle,
+                                        scale=np.mean(pred_control, axis=0))
         pred_mut.append(pred_shuffle)
-    pred_mut = np.array(pred_mut)
 
     if mean:
         res = {"mean_control": np.mean(pred_control, axis=0), "std_control": np.std(pred_control, axis=0),
-               "mean_mut": np.mean(pred_mut, axis=1), "std_mut": np.std(pred_mut, axis=1)}
+               "mean_mut": np.array([np.mean(p, axis=0) for p in pred_mut]),
+               "std_mut": np.array([np.std(p, axis=0) for p in pred_mut])}
+        if tol is not None:
+            res['num_shuffle_control'] = len(pred_control)
+            res['num_shuffle_mut'] = np.array([len(p) for p in pred_mut])
     else:
-        res = {'control': pred_control, 'mut': pred_mut}
+        res = {'control': pred_control, 'mut': np.array(pred_mut)}
     return res
 
 
@@ -372,6 +555,7 @@ def distance_test(model, x, tile_fixed_coord, tile_var_coord, test_positions, nu
 ############################################################################################
 
 
+@profiling.profile('higher_order_interaction_test')
 def higher_order_interaction_test(model, x, cre_tiles_to_test, optimization, num_shuffle=10, num_rounds=None):
     """
     This test performs a greedy search to identify which tile sets lead to optimal changes
@@ -438,6 +622,7 @@ def higher_order_interaction_test(model, x, cre_tiles_to_test, optimization, num
 ############################################################################################
 # CRE Multiplicity Test
 ############################################################################################
+@profiling.profile('multiplicity_test')
 def multiplicity_test(model, x, tss_tile_coord, cre_tile_coord, cre_tile_seq, test_coords, num_shuffle, num_copies,
                       optimization):
     """
@@ -520,6 +705,7 @@ def multiplicity_test(model, x, tss_tile_coord, cre_tile_coord, cre_tile_seq, te
 ########################################################################################
 
 
+@profiling.profile('prune_sequence')
 def prune_sequence(model, wt_seq, control_sequences, mut, whole_tile_start, whole_tile_end, scales, thresholds, frac,
                    N_batches, cre_type='enhancer'):
     """
@@ -656,6 +842,226 @@ def prune_sequence(model, wt_seq, control_sequences, mut, whole_tile_start, whol
     return result_summary
 
 
+@profiling.profile('pruning_curve')
+def pruning_curve(model, wt_seq, control_sequences, region, rankings, budgets, batch_size=4, reduce_fn=None):
+    """
+    Activity of a region embedded in background sequences as more and more of its positions are pruned (set back to
+    the background) in the order of a ranking, e.g. by saliency. Every (ranking, budget) pair is a patch of pruned
+    positions over the shared background with the WT region; identical patches (e.g. budget 0) are predicted once
+    and patches are predicted in batches.
+
+    Parameters
+    ----------
+        model : ModelBase
+            Model with a predict function for a batch of one-hot sequences.
+        wt_seq : np.array
+            Single one-hot sequence shape (L, A).
+        control_sequences : np.array
+            One-hot background sequences of shape (N, L, A).
+        region : list
+            Start and end index of the region embedded from wt_seq.
+        rankings : dict
+            Positions (in sequence coordinates) in order of pruning per label, e.g. {'saliency': ..., 'random': ...}.
+        budgets : list
+            Numbers of pruned positions, i.e. the points of the curve.
+        batch_size : int
+            Number of patches per model.predict call (each patch is N sequences).
+        reduce_fn : function
+            Reduction of a batch of predictions to one value per sequence, e.g.
+            lambda pred: pred[:, bin_index, track_index].mean(axis=1). Defaults to the mean over bins and tracks.
+
+    Returns
+    -------
+        dict : mean reduced prediction over the background sequences for each budget, np.array per ranking label.
+    """
+    if reduce_fn is None:
+        reduce_fn = lambda pred: np.mean(pred.reshape(pred.shape[0], -1), axis=1)
+    start, end = region
+    background = control_sequences.copy()
+    background[:, start:end] = wt_seq[start:end]
+
+    # describe each point of each curve by its pruned positions, shared by identical points
+    patch_index = {}
+    patches = []
+    curve_patches = {}
+    for label, ranking in rankings.items():
+        curve_patches[label] = []
+        for budget in budgets:
+            positions = np.sort(np.asarray(ranking[:budget], dtype=int))
+            key = positions.tobytes()
+            if key not in patch_index:
+                patch_index[key] = len(patches)
+                patches.append(positions)
+            curve_patches[label].append(patch_index[key])
+
+    num_seqs = len(control_sequences)
+    values = np.empty(len(patches))
+    for i in range(0, len(patches), batch_size):
+        masks = np.zeros((len(patches[i:i + batch_size]), background.shape[1]), dtype=bool)
+        for j, positions in enumerate(patches[i:i + batch_size]):
+            masks[j, positions] = True
+        x = np.where(masks[:, np.newaxis, :, np.newaxis], control_sequences[np.newaxis], background[np.newaxis])
+        pred = reduce_fn(model.predict(x.reshape((-1,) + background.shape[1:])))
+        values[i:i + len(masks)] = pred.reshape(len(masks), num_seqs).mean(axis=1)
+    return {label: values[index] for label, index in curve_patches.items()}
+
+
+########################################################################################
+# In silico mutagenesis
+########################################################################################
+
+
+@profiling.profile('ism_test')
+def ism_test(model, x, region, batch_size=16, substitutions=None, alphabet='ACGT', reduce_fn=None, cache=None):
+    """
+    Saturation in silico mutagenesis of a region. All single-nucleotide variants are described as patches
+    (position, nucleotide), applied to the WT sequence in batches and predicted, so only one batch of sequences
+    is in memory at a time.
+
+    Parameters
+    ----------
+        model : ModelBase
+            Model with a predict function for a batch of one-hot sequences.
+        x : np.array
+            Single one-hot sequence shape (L, A).
+        region : list
+            Start and end index of the region to mutate (i.e. [start, end]).
+        batch_size : int
+            Number of variants per model.predict call.
+        substitutions : dict
+            Alternative nucleotides per reference nucleotide, e.g. {'A': 'G', 'G': 'A', 'C': 'T', 'T': 'C'} for
+            transitions only. Defaults to all other nucleotides.
+        alphabet : str
+            Nucleotide order of the one-hot encoding.
+        reduce_fn : function
+            Reduction of a batch of predictions to one value per sequence, e.g.
+            lambda pred: pred[:, bin_index, track_index].mean(axis=1). Defaults to the mean over bins and tracks.
+        cache : dict
+            Reduced predictions of variants (keyed by position and nucleotide) and of the WT from previous calls with
+            the same sequence, model and reduce_fn, e.g. for overlapping regions. Updated in place.
+
+    Returns
+    -------
+        np.array : effect (mutant - WT) of each nucleotide at each position of the region, shape (end - start, A),
+        zero for the reference and skipped substitutions. For a logo, use
+        utils.grad_times_input_to_df(x[start:end], effects - effects.mean(axis=1, keepdims=True)).
+    """
+    if reduce_fn is None:
+        reduce_fn = lambda pred: np.mean(pred.reshape(pred.shape[0], -1), axis=1)
+    if cache is None:
+        cache = {}
+    start, end = region
+
+    # predict variants that are not cached yet
+    patches = get_ism_patches(x, region, substitutions, alphabet)
+    todo = [p for p in map(tuple, patches.tolist()) if p not in cache]
+    if 'wt' not in cache:
+        cache['wt'] = reduce_fn(model.predict(x[np.newaxis]))[0]
+    for i in tqdm(range(0, len(todo), batch_size)):
+        batch = np.array(todo[i:i + batch_size])
+        x_mut = np.repeat(x[np.newaxis], len(batch), axis=0)
+        x_mut[np.arange(len(batch)), batch[:, 0]] = np.eye(x.shape[1], dtype=x.dtype)[batch[:, 1]]
+        for patch, pred in zip(todo[i:i + batch_size], reduce_fn(model.predict(x_mut))):
+            cache[patch] = pred
+
+    effects = np.zeros((end - start, x.shape[1]))
+    if len(patches):
+        effects[patches[:, 0] - start, patches[:, 1]] = [cache[p] for p in map(tuple, patches.tolist())]
+        effects[patches[:, 0] - start, patches[:, 1]] -= cache['wt']
+    return effects
+
+
+def get_ism_patches(x, region, substitutions=None, alphabet='ACGT'):
+    """
+    Describe the single-nucleotide variants of a region as patches.
+    inputs:
+        x : np.array
+            Single one-hot sequence shape (L, A).
+        region : list
+            Start and end index of the region.
+        substitutions : dict
+            Alternative nucleotides per reference nucleotide, defaults to all other nucleotides. Positions without a
+            nucleotide (N) get all nucleotides.
+        alphabet : str
+            Nucleotide order of the one-hot encoding.
+
+    Returns
+    -------
+        np.array : (position, nucleotide index) of each variant, shape (N, 2).
+    """
+    start, end = region
+    if substitutions is None:
+        substitutions = {nuc: alphabet.replace(nuc, '') for nuc in alphabet}
+    allowed = np.zeros((len(alphabet) + 1, len(alphabet)), dtype=bool)  # last row for N
+    allowed[-1] = True
+    for nuc, alts in substitutions.items():
+        allowed[alphabet.index(nuc), [alphabet.index(alt) for alt in alts]] = True
+
+    ref = np.where(x[start:end].max(axis=1) > 0, np.argmax(x[start:end], axis=1), len(alphabet))
+    pos, nuc = np.nonzero(allowed[ref])
+    return np.stack([pos + start, nuc], axis=1)
+
+
+########################################################################################
+# Adaptive number of shuffles
+########################################################################################
+
+
+def sample_shuffles(predict_shuffle, num_shuffle, tol=None, max_shuffle=None, scale=None):
+    """
+    Predict shuffles in batches of num_shuffle until the 95% confidence interval of the mean prediction (averaged
+    over bins, per track) is narrower than tol relative to scale, or max_shuffle shuffles are done. Without tol,
+    exactly num_shuffle shuffles are predicted.
+
+    Parameters
+    ----------
+        predict_shuffle : function
+            Prediction of shuffle n, or a tuple of predictions that all need to converge.
+        num_shuffle : int
+            Number of shuffles per batch.
+        tol : float
+            Relative tolerance for the half-width of the confidence interval, e.g. 0.05.
+        max_shuffle : int
+            Maximum number of shuffles, defaults to 10 * num_shuffle.
+        scale : np.array
+            Prediction that sets the scale of tol (e.g. WT prediction), defaults to the mean of the shuffles.
+
+    Returns
+    -------
+        list of np.array : predictions of all shuffles, one array per output of predict_shuffle.
+    """
+    if max_shuffle is None:
+        max_shuffle = 10 * num_shuffle
+
+    preds = []
+    batch = num_shuffle
+    while batch > 0:
+        for n in range(len(preds), len(preds) + batch):
+            pred = predict_shuffle(n)
+            preds.append(pred if isinstance(pred, tuple) else (pred,))
+        if tol is None or shuffles_converged(preds, tol, scale):
+            break
+        batch = min(num_shuffle, max_shuffle - len(preds))
+    return [np.array(p) for p in zip(*preds)]
+
+
+def shuffles_converged(preds, tol, scale=None):
+    """Check if the 95% confidence intervals of the mean predictions across shuffles are within tol of scale."""
+    if len(preds) < 2:
+        return False
+    for pred in zip(*preds):
+        pred = np.array(pred)
+        pred = pred.reshape(len(pred), -1, pred.shape[-1]).mean(axis=1)  # (shuffles, tracks)
+        half_width = 1.96 * np.std(pred, axis=0, ddof=1) / np.sqrt(len(pred))
+        if scale is None:
+            ref = np.mean(pred, axis=0)
+        else:
+            ref = np.reshape(scale, (-1, pred.shape[-1])).mean(axis=0)
+        if np.any(half_width > tol * np.abs(ref)):
+            return False
+    return True
+
+
 ########################################################################################
 # Normalization functions
 ########################################################################################
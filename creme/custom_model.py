@@ -4,7 +4,11 @@ import tensorflow as tf
 import tensorflow_hub as hub
 import glob
 import json
+import time
+import queue
+import multiprocessing
 import pandas as pd
+import profiling
 
 ########################################################################################
 # CREME model
@@ -32,8 +36,14 @@ class Enformer(ModelBase):
             Enformer head to get predictions --> head or mouse.
         track_index : int
             Enformer index of prediciton track for a given head.
+        precision : str
+            CPU inference precision --> float32 or bfloat16 (see set_cpu_precision). If None, keep the current one.
     """
-    def __init__(self, track_index=None, bin_index=None, head='human'):
+    def __init__(self, track_index=None, bin_index=None, head='human', precision=None):
+
+        # reduced-precision CPU inference
+        if precision:
+            set_cpu_precision(precision)
 
         # path to enformer on tensorflow-hub
         tfhub_url = 'https://tfhub.dev/deepmind/enformer/1'
@@ -45,12 +55,14 @@ class Enformer(ModelBase):
         self.seq_length = 196608
         self.pseudo_pad = 196608
         self.target_length = 896
+        self.num_tracks = {'human': 5313, 'mouse': 1643}[head]  # tracks of the head output
         if type(self.bin_index)==int:
             self.bin_index = [self.bin_index]
         if type(self.track_index)==int:
             self.track_index = [self.track_index]
 
 
+    @profiling.profile('predict', batch_arg=1)
     def predict(self, x, batch_size=1):
         """Get full predictions from enformer in batches."""
 
@@ -104,10 +116,11 @@ class Enformer(ModelBase):
                 ) / target_mask_mass
         input_grad = tape.gradient(prediction, x)
 
-        # process saliency maps
+        # process saliency maps, a batch of sequences gives one map per sequence
         if mult_by_input:
             input_grad *= x
-            input_grad = tf.squeeze(input_grad, axis=0)
+            if input_grad.shape[0] == 1:
+                input_grad = tf.squeeze(input_grad, axis=0)
             return tf.reduce_sum(input_grad, axis=-1)
         else:
             return input_grad
@@ -115,6 +128,164 @@ class Enformer(ModelBase):
 
 
 
+########################################################################################
+# Multi-replica CPU inference
+########################################################################################
+
+
+class ReplicaPool(ModelBase):
+    """
+    Runs replicas of a model in worker processes behind one predict function, each with its own TensorFlow thread
+    counts and CPU cores, to use large CPU nodes on which one replica does not scale with intra-op threads. A predict
+    call is split into tasks of batch_size sequences that run in parallel on the replicas, so it speeds up calls
+    with many sequences (e.g. ism_test or context_swap_test). Simple model attributes (e.g. bin_index, track_index)
+    are copied to the pool and changes to them are sent to the replicas with every call. Not thread-safe.
+    inputs:
+        model_fn : function
+            Builds the model in a worker and must be picklable, e.g. functools.partial(Enformer, track_index=5111).
+        num_replicas : int
+            Number of worker processes.
+        intra_op_threads : int
+            TensorFlow intra-op threads per replica, defaults to the available cores divided by num_replicas.
+        inter_op_threads : int
+            TensorFlow inter-op threads per replica.
+        pin_cpus : bool
+            Pin each replica to its own intra_op_threads cores (Linux only).
+        batch_size : int
+            Number of sequences per task.
+        dispatch : str
+            depth sends each task to the replica with the fewest pending tasks, round_robin cycles through replicas.
+        max_pending : int
+            Maximum number of tasks queued per replica.
+    """
+    def __init__(self, model_fn, num_replicas=4, intra_op_threads=None, inter_op_threads=1, pin_cpus=True,
+                 batch_size=1, dispatch='depth', max_pending=2):
+        if dispatch not in ['depth', 'round_robin']:
+            raise ValueError(f'Unsupported dispatch {dispatch}')
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        if intra_op_threads is None:
+            intra_op_threads = max(1, len(cpus) // num_replicas)
+        self.num_replicas = num_replicas
+        self.batch_size = batch_size
+        self.dispatch = dispatch
+        self.max_pending = max_pending
+        # cores are shared if there are more threads than cores
+        self.cpus = [sorted({cpus[(r * intra_op_threads + i) % len(cpus)] for i in range(intra_op_threads)})
+                     if pin_cpus else None for r in range(num_replicas)]
+
+        # spawn, since TensorFlow is not fork-safe
+        context = multiprocessing.get_context('spawn')
+        self.results = context.Queue()
+        self.tasks = [context.Queue() for _ in range(num_replicas)]
+        self.workers = [context.Process(target=_replica_worker, daemon=True,
+                                        args=(model_fn, self.cpus[r], intra_op_threads, inter_op_threads,
+                                              self.tasks[r], self.results, r))
+                        for r in range(num_replicas)]
+        for worker in self.workers:
+            worker.start()
+
+        # wait for the replicas and copy the model attributes (e.g. seq_length); they are sent with every task, so
+        # that changes on the pool (e.g. model.bin_index = ...) apply to the replicas
+        self.model_attributes = []
+        for _ in range(num_replicas):
+            _, _, attributes, _ = self._get_result()
+            if isinstance(attributes, Exception):
+                self.close()
+                raise attributes
+            for key, value in attributes.items():
+                if not hasattr(self, key):
+                    setattr(self, key, value)
+                    self.model_attributes.append(key)
+
+        self.pending = np.zeros(num_replicas, dtype=int)
+        self.num_tasks = np.zeros(num_replicas, dtype=int)
+        self.num_seqs = np.zeros(num_replicas, dtype=int)
+        self.busy = np.zeros(num_replicas)
+        self.start_time = time.perf_counter()
+        self._next = 0
+
+
+    @profiling.profile('predict', batch_arg=1)
+    def predict(self, x):
+        """Get predictions of the replicas in the order of the sequences."""
+        if len(x.shape) == 2:
+            x = x[np.newaxis]
+        chunks = list(batch_np(x, self.batch_size))
+        attributes = {key: getattr(self, key) for key in self.model_attributes}
+        preds = [None] * len(chunks)
+        error = None
+        next_chunk = 0
+        while next_chunk < len(chunks) or self.pending.sum():
+            # keep up to max_pending tasks queued per replica, stop dispatching after an error
+            while next_chunk < len(chunks) and error is None:
+                replica = self._next_replica()
+                if replica is None:
+                    break
+                self.tasks[replica].put((next_chunk, chunks[next_chunk], attributes))
+                self.pending[replica] += 1
+                next_chunk += 1
+            if error is not None and not self.pending.sum():
+                break
+
+            replica, chunk, pred, busy = self._get_result()
+            self.pending[replica] -= 1
+            self.num_tasks[replica] += 1
+            self.busy[replica] += busy
+            if isinstance(pred, Exception):
+                error = pred
+            else:
+                self.num_seqs[replica] += len(pred)
+                preds[chunk] = pred
+        if error is not None:
+            raise error
+        return np.concatenate(preds)
+
+
+    def _next_replica(self):
+        """Replica for the next task, None if all are busy."""
+        if self.dispatch == 'round_robin':
+            if self.pending[self._next] >= self.max_pending:
+                return None
+            replica = self._next
+            self._next = (self._next + 1) % self.num_replicas
+            return replica
+        replica = int(np.argmin(self.pending))
+        return replica if self.pending[replica] < self.max_pending else None
+
+
+    def _get_result(self):
+        while True:
+            try:
+                return self.results.get(timeout=10)
+            except queue.Empty:
+                dead = [r for r, worker in enumerate(self.workers) if not worker.is_alive()]
+                if dead:
+                    raise RuntimeError(f'Model replicas {dead} died')
+
+
+    def utilization(self):
+        """
+        Per-replica statistics since the pool started, to tune the number of replicas against threads.
+
+        Returns
+        -------
+            pd.DataFrame with cores, number of tasks and sequences, busy seconds and fraction of time busy per replica.
+        """
+        elapsed = time.perf_counter() - self.start_time
+        return pd.DataFrame({'cpus': [','.join(map(str, c)) if c else '' for c in self.cpus],
+                             'tasks': self.num_tasks, 'sequences': self.num_seqs, 'busy_seconds': self.busy,
+                             'utilization': self.busy / elapsed})
+
+
+    def close(self):
+        """Stop the worker processes."""
+        for tasks, worker in zip(self.tasks, self.workers):
+            if worker.is_alive():
+                tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
 ########################################################################################
 # Template for custom model 
 ########################################################################################
@@ -135,6 +306,50 @@ class Enformer(ModelBase):
 ########################################################################################
 
 
+def set_cpu_precision(precision='float32'):
+    """
+    Set the precision of CPU inference for all models in this process. With bfloat16 the graph optimizer rewrites
+    conv, dense and matmul ops to run in bfloat16 on CPUs that support it (oneDNN, e.g. AVX512-BF16 or AMX), while
+    weights and outputs stay float32. Check the effect on CREME tests with paper_reproducibility/precision_test.py.
+    inputs:
+        precision : str
+            float32 or bfloat16.
+    """
+    if precision not in ['float32', 'bfloat16']:
+        raise ValueError(f'Unsupported CPU precision {precision}')
+    tf.config.optimizer.set_experimental_options({'auto_mixed_precision_onednn_bfloat16': precision == 'bfloat16'})
+
+
+def _replica_worker(model_fn, cpus, intra_op_threads, inter_op_threads, tasks, results, replica):
+    """Worker process of a ReplicaPool: configure threads, build the model and predict tasks until None."""
+    try:
+        if cpus and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+        model = model_fn()
+    except Exception as e:
+        results.put((replica, None, RuntimeError(f'Model replica {replica} failed to start: {e!r}'), 0.0))
+        return
+    attributes = {key: value for key, value in vars(model).items()
+                  if isinstance(value, (int, float, str, list, tuple, type(None)))}
+    results.put((replica, None, attributes, 0.0))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        chunk, x, attributes = task
+        start = time.perf_counter()
+        try:
+            for key, value in attributes.items():
+                setattr(model, key, value)
+            pred = model.predict(x)
+        except Exception as e:
+            pred = RuntimeError(f'Model replica {replica} failed: {e!r}')
+        results.put((replica, chunk, pred, time.perf_counter() - start))
+
+
 def batch_np(whole_dataset, batch_size):
     """Batch generator for dataset."""
     for i in range(0, whole_dataset.shape[0], batch_size):
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+import utils
+
+
+########################################################################################
+# Greedy search results
+########################################################################################
+
+
+def load_results(result_paths, cre_tiles, num_workers=8):
+    """
+    Load greedy search results (see creme.higher_order_interaction_test) of many sequences into stacked arrays,
+    reading each pickle once.
+    inputs:
+        result_paths : list
+            Result pickles, one per sequence, all with the same number of rounds.
+        cre_tiles : list
+            Tile coordinates that were searched.
+        num_workers : int
+            Number of reader threads.
+
+    Returns
+    -------
+        dict of arrays (S sequences, R rounds, T tiles):
+            order : (S, R) index of the tile selected in each round.
+            initial_pred : (S, R) prediction at the start of each round, round 0 is WT.
+            first_preds : (S, T, shuffles) predictions of the tile shuffles of the first round.
+            last_preds : (S, T - R + 1, shuffles) predictions of the tile shuffles of the last round.
+    """
+    with ThreadPoolExecutor(num_workers) as executor:
+        results = list(executor.map(_read_result, result_paths))
+    selected_starts = np.stack([r[0] for r in results])
+
+    # tile index of the selected tile starts
+    tile_starts = np.array(cre_tiles)[:, 0]
+    sorter = np.argsort(tile_starts)
+    order = sorter[np.searchsorted(tile_starts, selected_starts, sorter=sorter)]
+    return {'order': order,
+            'initial_pred': np.stack([r[1] for r in results]),
+            'first_preds': np.stack([r[2] for r in results]),
+            'last_preds': np.stack([r[3] for r in results])}
+
+
+def _read_result(result_path):
+    res = utils.read_pickle(result_path)
+    rounds = sorted(res.keys())
+    return (np.array([res[i]['selected_tile'][0] for i in rounds]),
+            np.array([res[i]['initial_pred'] for i in rounds]),
+            res[rounds[0]]['preds'],
+            res[rounds[-1]]['preds'])
+
+
+def traces(results, optimization_name, log=False):
+    """
+    Greedy search traces and the traces of a hypothetical additive model of all sequences.
+    inputs:
+        results : dict
+            Stacked results from load_results.
+        optimization_name : str
+            min or max, direction of the greedy search.
+        log : bool
+            If True, use log predictions.
+
+    Returns
+    -------
+        np.arrays : trace (S, R + 1) relative to WT, with the best tile of the last round appended;
+        hypothetical additive trace (S, R + 1) from summing the first-round effects of the selected tiles;
+        first-round effects (S, R) of the selected tiles relative to WT.
+    """
+    transform = np.log if log else (lambda pred: pred)
+    initial_pred = transform(results['initial_pred'])
+    wt = initial_pred[:, :1]
+    last_mean = transform(results['last_preds']).mean(axis=-1)
+    best_last = last_mean.min(axis=1) if optimization_name == 'min' else last_mean.max(axis=1)
+    trace = np.concatenate([initial_pred, best_last[:, np.newaxis]], axis=1) / wt
+
+    # hypothetical additive model
+    effect_sizes_first_iter = transform(results['first_preds']).mean(axis=-1) - wt
+    sorted_effect_first_iter = np.take_along_axis(effect_sizes_first_iter, results['order'], axis=1)
+    hypothetical_trace = np.concatenate([wt, wt + np.cumsum(sorted_effect_first_iter, axis=1)], axis=1) / wt
+    return trace, hypothetical_trace, sorted_effect_first_iter / wt
+
+
+def location_maps(results, num_tiles, num_rounds=5):
+    """Map (S, T) of the tiles selected in the first num_rounds rounds."""
+    location_map = np.zeros((len(results['order']), num_tiles), dtype=int)
+    np.put_along_axis(location_map, results['order'][:, :num_rounds], 1, axis=1)
+    return location_map
+
+
+def second_iteration(results):
+    """WT, the first two selected tiles shuffled separately and both shuffled together, shape (S, 4)."""
+    first_two = np.take_along_axis(results['first_preds'].mean(axis=-1), results['order'][:, :2], axis=1)
+    return np.column_stack([results['initial_pred'][:, 0], first_two, results['initial_pred'][:, 2]])
+
+
+def summary_tables(results, optimization_name, info):
+    """
+    Summary tables of the greedy search of many sequences, in the layout of the higher-order test summary csvs.
+    inputs:
+        results : dict
+            Stacked results from load_results.
+        optimization_name : str
+            min or max.
+        info : pd.DataFrame
+            Row per sequence with context, seq_id and cell_line columns.
+
+    Returns
+    -------
+        dict of pd.DataFrame : second_iteration, traces and locations.
+    """
+    num_seqs, num_rounds = results['order'].shape
+    traces_df = {}
+    for prefix, log in [('', False), ('log_', True)]:
+        trace, hypothetical_trace, sorted_effect = traces(results, optimization_name, log)
+        traces_df[f'{prefix}trace'] = trace.ravel()
+        traces_df[f'{prefix}hypothetical_trace'] = hypothetical_trace.ravel()
+        traces_df[f'{prefix}sorted_effects'] = np.column_stack([sorted_effect, np.full(num_seqs, np.nan)]).ravel()
+    traces_df = pd.DataFrame(traces_df, index=np.tile(np.arange(num_rounds + 1), num_seqs))
+    traces_df = _add_info(traces_df, info, num_rounds + 1, ['cell_line', 'context', 'seq_id'])
+
+    second_df = pd.DataFrame(second_iteration(results).ravel(),
+                             index=np.tile(['wt', 'greedy_it1', 'greedy_it2', 'two_cres_shuffled'], num_seqs))
+    second_df = _add_info(second_df, info, 4, ['context', 'seq_id', 'cell_line'])
+
+    num_tiles = results['first_preds'].shape[1]
+    locations_df = pd.DataFrame(location_maps(results, num_tiles).ravel(), columns=['tile_selected'],
+                                index=np.tile(np.arange(num_tiles), num_seqs))
+    locations_df = _add_info(locations_df, info, num_tiles, ['context', 'seq_id', 'cell_line'])
+    return {'second_iteration': second_df, 'traces': traces_df, 'locations': locations_df}
+
+
+def _add_info(df, info, repeats, columns):
+    """Add info columns of each sequence to its repeats rows of df."""
+    for column in columns:
+        df[column] = np.repeat(info[column].values, repeats)
+    return df
@@ -0,0 +1,88 @@
+import numpy as np
+
+
+########################################################################################
+# Motif masks
+########################################################################################
+
+
+def interval_mask(starts, stops, length, rows=None, num_rows=None):
+    """
+    Boolean mask of intervals (e.g. FIMO hits) built with a difference array instead of a loop over the intervals.
+    inputs:
+        starts, stops : np.arrays
+            Interval coordinates in the sequence (stop exclusive), empty intervals (stop <= start) are ignored as
+            in slicing.
+        length : int
+            Sequence length.
+        rows : np.array
+            Row of each interval (e.g. motif index), if None all intervals are in one row.
+        num_rows : int
+            Number of rows, defaults to max(rows) + 1.
+
+    Returns
+    -------
+        np.array (num_rows, length) or (length,) if rows is None.
+    """
+    starts = np.clip(np.asarray(starts, dtype=int), 0, length)
+    stops = np.clip(np.asarray(stops, dtype=int), 0, length)
+    flat_rows = np.zeros(len(starts), dtype=int) if rows is None else np.asarray(rows, dtype=int)
+    if num_rows is None:
+        num_rows = flat_rows.max() + 1 if len(flat_rows) else 1
+    keep = stops > starts
+    delta = np.zeros((num_rows, length + 1), dtype=int)
+    np.add.at(delta, (flat_rows[keep], starts[keep]), 1)
+    np.add.at(delta, (flat_rows[keep], stops[keep]), -1)
+    mask = np.cumsum(delta[:, :length], axis=1) > 0
+    return mask[0] if rows is None else mask
+
+
+def mask_conditions(motif_mask):
+    """
+    Masks of the positions of a CRE kept from the WT sequence: motifs, non-motifs (complement), random positions
+    (a permutation of the motif mask, same number of positions) and all positions.
+
+    Returns
+    -------
+        list of labels and np.array (4, L) of masks.
+    """
+    motif_mask = np.asarray(motif_mask, dtype=bool)
+    masks = np.stack([motif_mask, ~motif_mask, np.random.permutation(motif_mask), np.ones_like(motif_mask)])
+    return ['motifs', 'non-motifs', 'random', 'all'], masks
+
+
+def embed_masks(control_sequences, cre_onehot, cre_start, masks):
+    """
+    Embed the masked WT positions of a CRE into its shuffled version in every control sequence, for all masks.
+    inputs:
+        control_sequences : np.array
+            Sequences (N, L, A) with a shuffled CRE.
+        cre_onehot : np.array
+            WT CRE (cre_L, A).
+        cre_start : int
+            Start of the CRE in the sequences.
+        masks : np.array
+            Masks (C, cre_L), True where the WT is kept.
+
+    Returns
+    -------
+        np.array (C * N, L, A), sequences of mask c are rows c * N to (c + 1) * N.
+    """
+    num_masks, cre_len = masks.shape
+    cre_end = cre_start + cre_len
+    test_seqs = np.repeat(control_sequences[np.newaxis], num_masks, axis=0)
+    test_seqs[:, :, cre_start:cre_end] = np.where(masks[:, np.newaxis, :, np.newaxis], cre_onehot,
+                                                  control_sequences[np.newaxis, :, cre_start:cre_end])
+    return test_seqs.reshape((-1,) + control_sequences.shape[1:])
+
+
+def evaluate_masks(model, control_sequences, cre_onehot, cre_start, masks):
+    """
+    Predict all mask conditions of a CRE in one call of the model.
+
+    Returns
+    -------
+        np.array (C,) mean prediction of the sequences of each mask.
+    """
+    test_pred = model.predict(embed_masks(control_sequences, cre_onehot, cre_start, masks))
+    return test_pred.reshape((len(masks), -1)).mean(axis=1)
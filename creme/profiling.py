@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import atexit
+import functools
+import threading
+import numpy as np
+
+
+########################################################################################
+# Profiling of CREME stages
+########################################################################################
+
+# profiling is off unless enable() is called or CREME_PROFILE is set, then every stage only checks this flag
+_enabled = False
+_trace = False
+_lock = threading.Lock()
+_local = threading.local()
+_stats = {}
+_events = []
+_start_time = time.perf_counter()
+
+
+class _Stage():
+    """Context manager that times one call of a stage and records it on exit."""
+    def __init__(self, name, batch=None, output_bytes=0):
+        self.name = name
+        self.batch = batch
+        self.output_bytes = output_bytes
+
+    def __enter__(self):
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        _local.stack.append(self)
+        self.child_time = 0.0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        _local.stack.pop()
+        if _local.stack:
+            _local.stack[-1].child_time += duration
+        _record(self, duration)
+        return False
+
+
+class _NullStage():
+    """Stage that records nothing, used while profiling is disabled."""
+    batch = None
+    output_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+def stage(name, batch=None, output_bytes=0):
+    """
+    Context manager that records a stage, e.g. with profiling.stage('assemble'): ... Time spent in nested stages is
+    excluded from the self time of the stage.
+    inputs:
+        name : str
+            Name of the stage.
+        batch : int
+            Batch size (number of sequences) of this call.
+        output_bytes : int
+            Bytes of the arrays output by this call (not memory allocated while it runs), can also be set on
+            the returned stage.
+    """
+    if not _enabled:
+        return _null_stage
+    return _Stage(name, batch, output_bytes)
+
+
+def profile(name, batch_arg=None):
+    """
+    Decorator that records every call of a function as a stage, with the bytes of its returned arrays.
+    inputs:
+        name : str
+            Name of the stage.
+        batch_arg : int
+            Position of the argument with a batch of sequences, to record the batch size.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            batch = None
+            if batch_arg is not None and len(args) > batch_arg:
+                shape = np.shape(args[batch_arg])
+                batch = shape[0] if len(shape) == 3 else 1
+            with _Stage(name, batch) as s:
+                result = fn(*args, **kwargs)
+                s.output_bytes = _nbytes(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def _record(s, duration):
+    self_time = duration - s.child_time
+    with _lock:
+        stats = _stats.setdefault(s.name, {'calls': 0, 'total_seconds': 0.0, 'self_seconds': 0.0,
+                                           'max_seconds': 0.0, 'output_bytes': 0, 'batched_calls': 0,
+                                           'sequences': 0, 'max_batch': 0})
+        stats['calls'] += 1
+        stats['total_seconds'] += duration
+        stats['self_seconds'] += self_time
+        stats['max_seconds'] = max(stats['max_seconds'], duration)
+        stats['output_bytes'] += s.output_bytes
+        if s.batch is not None:
+            stats['batched_calls'] += 1
+            stats['sequences'] += s.batch
+            stats['max_batch'] = max(stats['max_batch'], s.batch)
+        if _trace:
+            _events.append({'name': s.name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                            'ts': (s.start - _start_time) * 1e6, 'dur': duration * 1e6,
+                            'args': {'batch': s.batch, 'output_bytes': s.output_bytes}})
+
+
+def _nbytes(x):
+    """Bytes of the arrays in a (nested) result."""
+    if isinstance(x, np.ndarray):
+        return x.nbytes
+    if isinstance(x, (list, tuple)):
+        return sum(_nbytes(v) for v in x)
+    if isinstance(x, dict):
+        return sum(_nbytes(v) for v in x.values())
+    return 0
+
+
+########################################################################################
+# useful functions
+########################################################################################
+
+
+def enable(trace=False):
+    """
+    Start recording stages (dinuc shuffles, CREME tests, model predictions, sequence extraction and result I/O).
+    inputs:
+        trace : bool
+            Also keep every call for a Chrome trace (save_trace), which grows with the number of calls.
+    """
+    global _enabled, _trace
+    _enabled = True
+    _trace = trace
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def reset():
+    """Clear the recorded stages."""
+    global _start_time
+    with _lock:
+        _stats.clear()
+        _events.clear()
+        _start_time = time.perf_counter()
+
+
+def summary():
+    """
+    Return the recorded stages.
+
+    Returns
+    -------
+        dict per stage with number of calls, total (including nested stages), self and max wall time in seconds,
+        bytes of the output arrays, and number of batched calls, sequences and largest batch.
+    """
+    with _lock:
+        result = {name: dict(stats) for name, stats in _stats.items()}
+    for stats in result.values():
+        stats['mean_batch'] = stats['sequences'] / stats['batched_calls'] if stats['batched_calls'] else None
+    return result
+
+
+def save_summary(path):
+    """Save the summary as JSON."""
+    with open(path, 'w') as handle:
+        json.dump(summary(), handle, indent=2)
+
+
+def save_trace(path):
+    """Save the recorded calls as a Chrome trace (open in chrome://tracing or ui.perfetto.dev)."""
+    with _lock:
+        events = list(_events)
+    with open(path, 'w') as handle:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, handle)
+
+
+def _save_on_exit(prefix):
+    save_summary(f'{prefix}.json')
+    save_trace(f'{prefix}_trace.json')
+
+
+# e.g. CREME_PROFILE=../results/profile ./necessity_test.py enformer writes profile.json and profile_trace.json
+if os.environ.get('CREME_PROFILE'):
+    enable(trace=True)
+    atexit.register(_save_on_exit, os.environ['CREME_PROFILE'])
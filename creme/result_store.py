@@ -0,0 +1,378 @@
+import os
+import glob
+import json
+import hashlib
+import socket
+import h5py
+import numpy as np
+import pandas as pd
+import utils
+
+
+########################################################################################
+# Result store
+########################################################################################
+
+
+class ResultStore():
+    """
+    Columnar store of CREME test results, an optional alternative to one pickle per sequence for analyses that read
+    many sequences (the driver scripts still write pickles, see migrate_pickles). Each writer process appends to its
+    own HDF5 shard so that many processes can write to the same store at once. In a shard, every result key of a test
+    is one chunked array with a row per record and every shard keeps an append-only index table (tsv) keyed by
+    seq_id, test and parameters.
+    inputs:
+        store_dir : str
+            Directory of the store.
+        writer : str
+            Name of this writer's shard, defaults to host name and process id.
+    """
+    def __init__(self, store_dir, writer=None):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        if writer is None:
+            writer = f'{socket.gethostname()}_{os.getpid()}'
+        self.shard_path = f'{store_dir}/{writer}.h5'
+        self.consolidated_path = f'{store_dir}/consolidated.h5'
+        self._index = None
+        self._index_sizes = None
+
+
+    def write(self, test, seq_id, result, params=None):
+        """
+        Append the result of one sequence.
+        inputs:
+            test : str
+                Name of the test, e.g. necessity.
+            seq_id : str
+                Sequence identifier.
+            result : dict
+                Result arrays per key (same shapes for every record of a test), e.g. {'wt': ..., 'mut': ...}.
+                Nested dicts (e.g. rounds of the higher-order test) are stored under keys joined by '/', e.g. '0/preds'.
+            params : dict
+                Test parameters that are part of the index key, e.g. {'num_shuffle': 10}.
+        """
+        params = _params_key(params)
+        result = _flatten(result)
+        with h5py.File(self.shard_path, 'a') as h5:
+            group = h5.require_group(test)
+            row = group.attrs.get('num_rows', 0)
+            for key, value in result.items():
+                value = np.asarray(value)
+                if value.dtype.kind not in 'biufc':
+                    raise ValueError(f'Result {key} of {seq_id} is not a numeric array')
+                if key not in group:
+                    group.create_dataset(key, shape=(0,) + value.shape, maxshape=(None,) + value.shape,
+                                         dtype=value.dtype, chunks=(1,) + value.shape)
+                dataset = group[key]
+                if dataset.shape[1:] != value.shape:
+                    raise ValueError(f'Result {key} of {seq_id} has shape {value.shape}, '
+                                     f'expected {dataset.shape[1:]}')
+                dataset.resize(row + 1, axis=0)
+                dataset[row] = value
+            group.attrs['num_rows'] = row + 1
+
+        # index row is written only after the record is on disk
+        index_path = f'{self.shard_path[:-3]}.tsv'
+        with open(index_path, 'a') as handle:
+            handle.write(f'{seq_id}\t{test}\t{params}\t{os.path.basename(self.shard_path)}\t{row}\n')
+        if self._index is not None:
+            self._index.loc[(test, seq_id, params)] = [os.path.basename(self.shard_path), row]
+            self._index_sizes[os.path.basename(index_path)] = os.path.getsize(index_path)
+
+
+    def index(self, refresh=False):
+        """
+        Return the index table of all shards, keyed by test, seq_id and parameters. The table is cached and read
+        again when an index file of another writer has grown (or refresh is True).
+        """
+        sizes = {entry.name: entry.stat().st_size for entry in os.scandir(self.store_dir)
+                 if entry.name.endswith('.tsv')}
+        if self._index is None or refresh or sizes != self._index_sizes:
+            columns = ['seq_id', 'test', 'params', 'shard', 'row']
+            index = [pd.read_csv(f'{self.store_dir}/{name}', sep='\t', names=columns, dtype={'params': str},
+                                 keep_default_na=False)
+                     for name, size in sorted(sizes.items()) if size]
+            if index:
+                index = pd.concat(index)
+            else:
+                index = pd.DataFrame(columns=columns)
+            self._index = index.drop_duplicates(['test', 'seq_id', 'params']).set_index(['test', 'seq_id', 'params'])
+            self._index_sizes = sizes
+        return self._index
+
+
+    def contains(self, test, seq_id, params=None):
+        """Check if the result of a sequence is in the store (replaces os.path.isfile of the pickle)."""
+        return (test, seq_id, _params_key(params)) in self.index().index
+
+
+    def read_record(self, test, seq_id, params=None):
+        """Read the result of one sequence as a dict (replaces read_pickle), nested as it was written."""
+        shard, row = self.index().loc[(test, seq_id, _params_key(params))]
+        with h5py.File(f'{self.store_dir}/{shard}', 'r', locking=False) as h5:
+            return _unflatten({key: h5[test][key][row] for key in _dataset_keys(h5[test])})
+
+
+    def read(self, test, key, seq_ids=None, params=None, selection=()):
+        """
+        Read one result key of many sequences, optionally only part of each record (e.g. one bin or track).
+        inputs:
+            test : str
+                Name of the test.
+            key : str
+                Result key, e.g. wt.
+            seq_ids : list
+                Sequences to read, defaults to all sequences of the test.
+            params : dict
+                Test parameters.
+            selection : tuple
+                Index into each record, e.g. np.s_[:, 447, 0] for one bin and track.
+
+        Returns
+        -------
+            Array with a row per sequence in the order of seq_ids.
+        """
+        index = self.index().xs((test, _params_key(params)), level=['test', 'params'])
+        if seq_ids is not None:
+            index = index.loc[list(seq_ids)]
+        result = None
+        for shard, shard_index in index.groupby('shard'):
+            with h5py.File(f'{self.store_dir}/{shard}', 'r', locking=False) as h5:
+                dataset = h5[test][key]
+                rows = shard_index['row'].values
+                order = np.argsort(rows)
+                values = dataset[(rows[order],) + tuple(np.index_exp[selection])]
+                if result is None:
+                    result = np.empty((len(index),) + values.shape[1:], dtype=values.dtype)
+                result[np.flatnonzero(index['shard'].values == shard)[order]] = values
+        return result
+
+
+    def consolidate(self, test, params=None):
+        """
+        Merge the records of a test from all shards into one contiguous file so they can be memory-mapped.
+        Records are in the order of the index table.
+        """
+        index = self.index(refresh=True).xs((test, _params_key(params)), level=['test', 'params'])
+        group_name = _group_name(test, params)
+        with h5py.File(self.consolidated_path, 'a') as h5:
+            if group_name in h5:
+                del h5[group_name]
+            group = h5.create_group(group_name)
+            group.create_dataset('seq_id', data=index.index.values.astype('S'))
+            with h5py.File(f'{self.store_dir}/{index["shard"].iloc[0]}', 'r', locking=False) as shard_h5:
+                keys = _dataset_keys(shard_h5[test])
+            for key in keys:
+                # contiguous (unchunked) layout is required for memory-mapping
+                group.create_dataset(key, data=self.read(test, key, index.index, params))
+
+
+    def memmap(self, test, key, params=None):
+        """
+        Memory-map one result key of a consolidated test.
+
+        Returns
+        -------
+            Sequence ids and a read-only memory-mapped array with a row per sequence.
+        """
+        with h5py.File(self.consolidated_path, 'r', locking=False) as h5:
+            group = h5[_group_name(test, params)]
+            dataset = group[key]
+            offset = dataset.id.get_offset()
+            seq_ids = group['seq_id'][:].astype(str)
+            dtype, shape = dataset.dtype, dataset.shape
+        return seq_ids, np.memmap(self.consolidated_path, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+
+class SaliencyStore():
+    """
+    Persistent store of saliency maps (grad x input) of whole sequences, keyed by seq_id, track, target bins and
+    model, and of CREME pruning masks of CREs. Maps are computed in batches on the first request and read from disk
+    afterwards, and every CRE of a sequence reuses the same map.
+    inputs:
+        store_dir : str
+            Directory of the store.
+        model : custom_model.Enformer
+            Model with contribution_input_grad.
+        seq_parser : utils.SequenceParser
+            Parser of the reference genome.
+        model_name : str
+            Name of the model, part of the key.
+        target_bins : list
+            Target bins of the saliency maps.
+        batch_size : int
+            Number of sequences per gradient pass.
+    """
+    def __init__(self, store_dir, model, seq_parser, model_name='enformer', target_bins=[447, 448], batch_size=2):
+        self.store = ResultStore(store_dir)
+        self.model = model
+        self.seq_parser = seq_parser
+        self.model_name = model_name
+        self.target_bins = [int(b) for b in target_bins]
+        self.batch_size = batch_size
+
+
+    def _params(self, track_index):
+        return {'model': self.model_name, 'track_index': int(track_index), 'target_bins': self.target_bins}
+
+
+    def compute(self, seq_ids, track_index):
+        """Compute and store the maps of sequences (seq_id as gene_chrom_tss_strand) that are not stored yet."""
+        params = self._params(track_index)
+        missing = [seq_id for seq_id in dict.fromkeys(seq_ids) if not self.store.contains('saliency', seq_id, params)]
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i:i + self.batch_size]
+            seqs = np.array([self.seq_parser.extract_seq_centered(chrom, int(tss), strand, self.model.seq_length)
+                             for chrom, tss, strand in (seq_id.split('_')[1:4] for seq_id in batch)])
+            scores = utils.saliency_scores(self.model, seqs, track_index, self.target_bins, self.batch_size)
+            for seq_id, score in zip(batch, scores):
+                self.store.write('saliency', seq_id, {'saliency': score.astype(np.float32)}, params)
+        return len(missing)
+
+
+    def saliency(self, seq_ids, track_index, window=None):
+        """
+        Saliency maps of sequences, computed on a miss.
+        inputs:
+            seq_ids : list
+                Sequence identifiers (gene_chrom_tss_strand).
+            track_index : int
+                Target track.
+            window : list
+                Start and end of the positions to read, e.g. a CRE tile, defaults to the whole sequence.
+
+        Returns
+        -------
+            np.array with a row per sequence in the order of seq_ids.
+        """
+        seq_ids = list(seq_ids)
+        self.compute(seq_ids, track_index)
+        unique_ids = list(dict.fromkeys(seq_ids))
+        selection = () if window is None else np.s_[window[0]:window[1]]
+        scores = self.store.read('saliency', 'saliency', unique_ids, self._params(track_index), selection)
+        row = {seq_id: i for i, seq_id in enumerate(unique_ids)}
+        return scores[[row[seq_id] for seq_id in seq_ids]]
+
+
+    def creme_mask(self, seq_tile_id, cell_line):
+        """CREME pruning mask of a CRE (see utils.get_creme_mask), read from its pruning result on a miss."""
+        params = {'cell_line': cell_line}
+        if not self.store.contains('creme_mask', seq_tile_id, params):
+            self.store.write('creme_mask', seq_tile_id, {'mask': utils.get_creme_mask(seq_tile_id, cell_line)}, params)
+        return self.store.read_record('creme_mask', seq_tile_id, params)['mask']
+
+
+    def precompute(self, cre_df, track_index, creme_masks=True):
+        """
+        Store the saliency maps of all sequences of a CRE table (seq_id, tile_start, tile_end and cell_line columns,
+        e.g. sufficient_CREs.csv) and, if creme_masks, the CREME pruning masks of its CREs.
+
+        Returns
+        -------
+            Number of computed saliency maps.
+        """
+        num_computed = self.compute(cre_df['seq_id'], track_index)
+        if creme_masks:
+            for _, row in cre_df.iterrows():
+                self.creme_mask(f"{row['seq_id']}_{row['tile_start']}_{row['tile_end']}.pickle", row['cell_line'])
+        return num_computed
+
+
+########################################################################################
+# useful functions
+########################################################################################
+
+
+def _params_key(params):
+    """Canonical string of test parameters for the index."""
+    if not params:
+        return ''
+    return json.dumps(params, sort_keys=True)
+
+
+def _flatten(result, prefix=''):
+    """Flatten nested result dicts into keys joined by '/', e.g. {0: {'preds': x}} to {'0/preds': x}."""
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}/'))
+        else:
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def _unflatten(flat):
+    """Nest keys joined by '/' again, keys made of digits become ints (e.g. rounds or pruning window sizes)."""
+    result = {}
+    for path, value in flat.items():
+        keys = [int(key) if key.isdigit() else key for key in path.split('/')]
+        node = result
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+        node[keys[-1]] = value
+    return result
+
+
+def _dataset_keys(group):
+    """Paths of all datasets in an HDF5 group, including nested ones."""
+    keys = []
+    group.visititems(lambda name, item: keys.append(name) if isinstance(item, h5py.Dataset) else None)
+    return keys
+
+
+def _group_name(test, params):
+    """HDF5 group of a test and its parameters in the consolidated file."""
+    return f'{test}/{hashlib.md5(_params_key(params).encode()).hexdigest()}'
+
+
+def migrate_pickles(pickle_dir, store, test, params=None):
+    """
+    Copy per-sequence result pickles (named {seq_id}.pickle) into a result store, skipping ones already stored.
+    All pickles are checked before anything is written, so a directory either migrates completely or not at all.
+    Results must have the same numeric array shapes in every pickle; nested dicts are supported (e.g. the
+    higher-order test), results with per-sequence lengths are not (e.g. motif pruning, whose number of scores and
+    kept sub-tiles differ between sequences).
+    inputs:
+        pickle_dir : str
+            Directory of result pickles.
+        store : ResultStore
+            Store to write to.
+        test : str
+            Name of the test.
+        params : dict
+            Test parameters.
+
+    Returns
+    -------
+        Number of migrated pickles.
+    """
+    todo = {}
+    for pickle_path in sorted(glob.glob(f'{pickle_dir}/*.pickle')):
+        seq_id = os.path.basename(pickle_path)[:-len('.pickle')]
+        if not store.contains(test, seq_id, params):
+            todo[seq_id] = pickle_path
+
+    # check shapes and types of all results first
+    shapes = {}
+    errors = []
+    for seq_id, pickle_path in todo.items():
+        for key, value in _flatten(_read_result(pickle_path)).items():
+            value = np.asarray(value)
+            if value.dtype.kind not in 'biufc':
+                errors.append(f'{seq_id}: {key} is not a numeric array')
+            elif shapes.setdefault(key, value.shape) != value.shape:
+                errors.append(f'{seq_id}: {key} has shape {value.shape}, expected {shapes[key]}')
+    if errors:
+        raise ValueError(f'Cannot migrate {pickle_dir} ({len(errors)} problems), e.g.\n' + '\n'.join(errors[:10]))
+
+    for seq_id, pickle_path in todo.items():
+        store.write(test, seq_id, _read_result(pickle_path), params)
+    return len(todo)
+
+
+def _read_result(pickle_path):
+    result = utils.read_pickle(pickle_path)
+    if not isinstance(result, dict):
+        result = {'result': result}
+    return result
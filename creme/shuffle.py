@@ -1,5 +1,6 @@
 # Credits: This script is taken from https://github.com/kundajelab/deeplift/blob/master/deeplift/dinuc_shuffle.py
 import numpy as np
+import profiling
 
 
 def random_shuffle(seq):
@@ -8,6 +9,7 @@ def random_shuffle(seq):
     return seq[rand_index,:]
 
 
+@profiling.profile('dinuc_shuffle')
 def dinuc_shuffle(seq, num_shufs=None, rng=None, seed=None):
     """
     Creates shuffles of the given sequence, in which dinucleotide frequencies
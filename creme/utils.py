@@ -1,5 +1,6 @@
 import os
 import sys
+import argparse
 import pandas as pd
 import pyfaidx
 import kipoiseq
@@ -8,6 +9,14 @@ import numpy as np
 import logomaker
 import matplotlib.pyplot as plt
 import glob
+import time
+import queue
+import atexit
+import signal
+import threading
+import collections
+import profiling
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 
 def rc_dna(seq):
@@ -36,6 +45,7 @@ class SequenceParser():
     def __init__(self, fasta_path):
         self.fasta_extractor = FastaStringExtractor(fasta_path) 
 
+    @profiling.profile('extract_seq')
     def extract_seq_centered(self, chrom, midpoint, strand, seq_len, onehot=True):
         assert strand in ['+', '-'], 'bad strand!'
         # get coordinates for tss
@@ -50,6 +60,7 @@ class SequenceParser():
         else:
             return seq
 
+    @profiling.profile('extract_seq')
     def extract_seq_interval(self, chrom, start, end, strand, seq_len=None, onehot=True):
         assert strand in ['+', '-'], 'bad strand!'
         # get coordinates for tss
@@ -135,6 +146,24 @@ def set_tile_range(L, window):
 
     return center_tile, other_tiles
 
+def parse_shuffle_args(argv=None):
+    """
+    Remove the adaptive shuffle options (--tol TOL --max-shuffle N, see creme.sample_shuffles) from the command
+    line of a driver script so that its positional arguments stay in place.
+
+    Returns
+    -------
+        dict of tol and max_shuffle arguments of the shuffle-based tests.
+    """
+    if argv is None:
+        argv = sys.argv
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--tol', type=float, default=None)
+    parser.add_argument('--max-shuffle', type=int, default=None)
+    args, rest = parser.parse_known_args(argv[1:])
+    argv[1:] = rest
+    return {'tol': args.tol, 'max_shuffle': args.max_shuffle}
+
 def make_dir(dir_path):
     """ Make directory if doesn't exist."""
     if not os.path.isdir(dir_path):
@@ -163,18 +192,330 @@ def plot_cdf(x, bins=1000):
 def clean_cell_name(t):
      return t.split(':')[-1].split(' ENCODE')[0].strip()
 
+@profiling.profile('save_pickle')
 def save_pickle(result_path, x):
     if os.path.isfile(result_path):
         print('File already exists!')
     else:
-        with open(result_path, 'wb') as handle:
+        # write to a temporary file and rename, so that a crash never leaves a partial result behind
+        tmp_path = f'{result_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as handle:
             pickle.dump(x, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, result_path)
+
+class ResultWriter():
+    """
+    Background thread that saves results so that inference does not wait for disk I/O. Tasks run in the order
+    they are submitted, and submitting blocks while max_pending tasks are waiting. Pending results are saved
+    on close, at interpreter exit and on SIGTERM.
+    inputs:
+        max_pending : int
+            Maximum number of results waiting to be saved.
+    """
+    def __init__(self, max_pending=16):
+        self.tasks = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+        if threading.current_thread() is threading.main_thread() and \
+                signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            # exit normally on SIGTERM so that pending results are saved
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+    def _run(self):
+        while True:
+            task = self.tasks.get()
+            try:
+                if task is None:
+                    return
+                fn, args = task
+                if self.error is None:  # stop after a failed task, e.g. before marking its work done
+                    fn(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.tasks.task_done()
+
+    def submit(self, fn, *args):
+        """Run fn(*args) in the writer thread after all previously submitted tasks."""
+        if self.error is not None:
+            raise self.error
+        if not self.thread.is_alive():
+            raise RuntimeError('Result writer is closed')
+        self.tasks.put((fn, args))
+
+    def save_pickle(self, result_path, x):
+        """Save x like save_pickle in the background, x must not be modified afterwards."""
+        self.submit(save_pickle, result_path, x)
+
+    def flush(self):
+        """Wait until all submitted tasks are done."""
+        self.tasks.join()
+        if self.error is not None:
+            raise self.error
 
+    def close(self):
+        """Save the pending results and stop the writer thread."""
+        if self.thread.is_alive():
+            self.tasks.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+@profiling.profile('read_pickle')
 def read_pickle(result_path):
     with open(result_path, 'rb') as handle:
         context_res = pickle.load(handle)
     return context_res
 
+def aggregate_pickles(manifest, reduce_fn, path_columns=['path'], num_workers=8, processes=False, cache_path=None):
+    """
+    Read result pickles in parallel, reduce each one in the workers and collect the reductions in a table.
+    inputs:
+        manifest : pd.DataFrame or list
+            Result paths. If a dataframe, its other columns are added to the reduction of each row.
+        reduce_fn : function
+            Reduction of the results of one row (one argument per path column) that returns a dict (one row) or a
+            dataframe. Must be picklable (e.g. a module function or functools.partial) if processes is True.
+        path_columns : list
+            Manifest columns with result paths.
+        num_workers : int
+            Number of threads or processes.
+        processes : bool
+            If True, use a process pool, otherwise a thread pool.
+        cache_path : str
+            Pickle with reductions keyed by path and file modification time, so that re-runs only read changed
+            files. Use a separate cache for each reduction.
+
+    Returns
+    -------
+        pd.DataFrame with the reductions and manifest columns. Dataframe reductions keep their index (e.g. 0..n per
+        sequence, as when concatenating them in a loop), dict reductions are numbered in manifest order.
+    """
+    if not isinstance(manifest, pd.DataFrame):
+        manifest = pd.DataFrame({'path': list(manifest)})
+    manifest = manifest.reset_index(drop=True)
+    paths = list(zip(*[manifest[c] for c in path_columns]))
+    keys = [tuple((p, os.path.getmtime(p)) for p in row_paths) for row_paths in paths]
+
+    # reduce files that changed since the last run
+    cache = read_pickle(cache_path) if cache_path and os.path.isfile(cache_path) else {}
+    todo = [i for i, key in enumerate(keys) if key not in cache]
+    pool_executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool_executor(num_workers) as executor:
+        reduced = executor.map(_read_and_reduce, [paths[i] for i in todo], [reduce_fn] * len(todo))
+        for i, r in zip(todo, reduced):
+            cache[keys[i]] = r
+    if cache_path and todo:
+        with open(f'{cache_path}.tmp', 'wb') as handle:
+            pickle.dump({key: cache[key] for key in keys}, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{cache_path}.tmp', cache_path)
+
+    # combine reductions with manifest columns
+    reduced = [cache[key] for key in keys]
+    if reduced and isinstance(reduced[0], pd.DataFrame):
+        repeats = [len(r) for r in reduced]
+        table = pd.concat(reduced)
+    else:
+        repeats = 1
+        table = pd.DataFrame(reduced)
+    index = table.index
+    info = manifest.loc[np.repeat(manifest.index, repeats)].reset_index(drop=True)
+    table = pd.concat([table.reset_index(drop=True), info], axis=1)
+    table.index = index
+    return table
+
+def _read_and_reduce(paths, reduce_fn):
+    return reduce_fn(*[read_pickle(p) for p in paths])
+
+def prefetch(items, load_fn, lookahead=4, num_workers=2):
+    """
+    Iterate over (item, load_fn(item)) in order while the next items are loaded in a thread pool, e.g. to extract
+    and one-hot encode the next sequences while the model predicts the current one.
+    inputs:
+        items : iterable
+            Items, e.g. df.iterrows(), consumed at most lookahead items ahead of the loop.
+        load_fn : function
+            Loader of one item, e.g. sequence extraction. Must be thread-safe.
+        lookahead : int
+            Number of items loaded in advance.
+        num_workers : int
+            Number of loader threads.
+    """
+    pending = collections.deque()
+    with ThreadPoolExecutor(num_workers) as executor:
+        try:
+            for item in items:
+                pending.append((item, executor.submit(load_fn, item)))
+                if len(pending) > lookahead:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+            while pending:
+                item, future = pending.popleft()
+                yield item, future.result()
+        finally:
+            # loop was left early
+            for _, future in pending:
+                future.cancel()
+
+def open_prediction_matrix(result_prefix, num_rows, pred_shape=None, done_shape=None):
+    """
+    Open (or create) a memory-mapped matrix of predictions with a row per sequence and a completion bitmap, stored
+    as {result_prefix}.npy and {result_prefix}_done.npy. Rows can be written by several processes at once.
+    inputs:
+        result_prefix : str
+            Path prefix of the matrix files.
+        num_rows : int
+            Number of sequences.
+        pred_shape : tuple
+            Shape of one prediction, needed to create the matrix. If None, the matrix must exist.
+        done_shape : tuple
+            Shape of the completion bitmap, e.g. one entry per block of the matrix, defaults to one per row.
+
+    Returns
+    -------
+        Memory-mapped predictions (num_rows, *pred_shape) and completion bitmap (num_rows,) or done_shape.
+    """
+    if not os.path.isfile(f'{result_prefix}.npy'):
+        if pred_shape is None:
+            raise FileNotFoundError(f'{result_prefix}.npy')
+
+        # create under temporary names and link into place, so that only one job creates the matrix
+        tmp_prefix = f'{result_prefix}.{os.getpid()}.tmp'
+        np.lib.format.open_memmap(f'{tmp_prefix}.npy', mode='w+', dtype=np.float32,
+                                  shape=(num_rows,) + tuple(pred_shape)).flush()
+        np.lib.format.open_memmap(f'{tmp_prefix}_done.npy', mode='w+', dtype=bool,
+                                  shape=done_shape or (num_rows,)).flush()
+        try:
+            os.link(f'{tmp_prefix}_done.npy', f'{result_prefix}_done.npy')
+            os.link(f'{tmp_prefix}.npy', f'{result_prefix}.npy')
+        except FileExistsError:
+            while not os.path.isfile(f'{result_prefix}.npy'):
+                time.sleep(1)
+        finally:
+            os.remove(f'{tmp_prefix}.npy')
+            os.remove(f'{tmp_prefix}_done.npy')
+
+    preds = np.load(f'{result_prefix}.npy', mmap_mode='r+')
+    done = np.load(f'{result_prefix}_done.npy', mmap_mode='r+')
+    assert preds.shape[0] == num_rows, 'bad number of rows'
+    return preds, done
+
+def lookup_predictions(result_prefix, row_keys, keys):
+    """
+    Look up predictions of sequences in a prediction matrix (see open_prediction_matrix), e.g. to reuse WT
+    predictions of the TSS activity stage in later tests. Rows read from the shared window of another row (see
+    plan_shared_windows) or without a record in {result_prefix}_anchor.npy (see open_anchor_rows) are not
+    returned, since they may be approximate.
+    inputs:
+        result_prefix : str
+            Path prefix of the matrix files.
+        row_keys : list
+            Key of each row of the matrix, e.g. get_summary of the rows of tss_positions.csv.
+        keys : list
+            Keys of the sequences to look up.
+
+    Returns
+    -------
+        Predictions (len(keys), *pred_shape), NaN for sequences that are not in the matrix, not done or from a
+        shared window.
+    """
+    preds, done = open_prediction_matrix(result_prefix, len(row_keys))
+    row_of_key = dict(zip(row_keys, range(len(row_keys))))
+    rows = np.array([row_of_key.get(key, -1) for key in keys], dtype=int)
+    found = rows >= 0
+    found[found] = done[rows[found]]
+    if os.path.isfile(f'{result_prefix}_anchor.npy'):
+        anchor_rows = np.load(f'{result_prefix}_anchor.npy', mmap_mode='r')
+        found[found] = anchor_rows[rows[found]] == rows[found]
+    result = np.full((len(keys),) + preds.shape[1:], np.nan, dtype=np.float32)
+    result[found] = preds[rows[found]]
+    return result
+
+def open_anchor_rows(result_prefix, num_rows):
+    """
+    Open (or create) {result_prefix}_anchor.npy, the row whose (shared) window was predicted for each row of a
+    prediction matrix (see plan_shared_windows), -1 for rows without a record. Rows are exact if they are their
+    own anchor.
+    """
+    anchor_path = f'{result_prefix}_anchor.npy'
+    if not os.path.isfile(anchor_path):
+        # create under a temporary name and link into place, so that only one job creates it
+        tmp_path = f'{result_prefix}_anchor.{os.getpid()}.tmp.npy'
+        anchor_rows = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.int64, shape=(num_rows,))
+        anchor_rows[:] = -1
+        anchor_rows.flush()
+        try:
+            os.link(tmp_path, anchor_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    return np.load(anchor_path, mmap_mode='r+')
+
+def plan_shared_windows(tss_df, bin_size=128, max_offset=1):
+    """
+    Group TSSs on the same chromosome and strand that lie within max_offset output bins of each other, so that one
+    window centered on the first TSS of a group is predicted for the whole group and each TSS reads its bins shifted
+    by its offset (see read_shared_window).
+    inputs:
+        tss_df : pd.DataFrame
+            TSSs with Chromosome, Start (TSS position) and Strand columns.
+        bin_size : int
+            Base pairs per output bin of the model, e.g. 128 for Enformer.
+        max_offset : int
+            Largest shift in bins between a TSS and its shared window, 0 only merges identical positions.
+
+    Returns
+    -------
+        np.arrays (len(tss_df),) : row of the TSS whose window is predicted for each TSS and signed offset in bins
+        of each TSS in that window (negative strand windows are reverse complemented).
+    """
+    positions = tss_df['Start'].values
+    strands = tss_df['Strand'].values
+    anchor = np.arange(len(tss_df))
+    for rows in tss_df.groupby(['Chromosome', 'Strand']).indices.values():
+        rows = rows[np.argsort(positions[rows], kind='stable')]
+        first = rows[0]
+        for row in rows:
+            if positions[row] - positions[first] > max_offset * bin_size:
+                first = row
+            anchor[row] = first
+    offset = np.round((positions - positions[anchor]) / bin_size).astype(int)
+    offset[strands == '-'] *= -1
+    return anchor, offset
+
+def shared_window_bins(bin_index, max_offset):
+    """Output bins to predict for shared windows, the bins of bin_index shifted by up to max_offset bins."""
+    return sorted({b + o for b in bin_index for o in range(-max_offset, max_offset + 1)})
+
+def read_shared_window(preds, offset, bin_index, window_bins, axis=1):
+    """
+    Read the bins of each TSS from the predictions of its shared window.
+    inputs:
+        preds : np.array
+            Predictions of the shared window of each TSS, N first and len(window_bins) bins on axis, e.g.
+            (N, bins, tracks) or (N, folds, bins, tracks) for Borzoi without aggregation (axis=2).
+        offset : np.array
+            Offset in bins (N,) of each TSS in its window, see plan_shared_windows.
+        bin_index : list
+            Bins of a TSS in its own window.
+        window_bins : list
+            Bins that were predicted, see shared_window_bins.
+        axis : int
+            Bin axis of preds.
+
+    Returns
+    -------
+        np.array shaped like preds with len(bin_index) bins on axis.
+    """
+    shifted = np.searchsorted(window_bins, np.array(bin_index)[np.newaxis] + np.asarray(offset)[:, np.newaxis])
+    # broadcast the bin index of each TSS over the other axes
+    shape = [1] * preds.ndim
+    shape[0], shape[axis] = shifted.shape
+    return np.take_along_axis(preds, shifted.reshape(shape), axis=axis)
+
 def get_borzoi_targets(target_df, cell_lines):
     cage_tracks = [i for i, t in enumerate(target_df['description']) if
                    ('CAGE' in t) and (t.split(':')[-1].strip() in cell_lines)]
@@ -192,19 +533,43 @@ def get_borzoi_targets(target_df, cell_lines):
     return cell_line_info, cage_tracks
 
 
-def grad_times_input_to_df(x, grad, alphabet='ACGT'):
-    """generate pandas dataframe for saliency plot
-     based on grad x inputs """
+def attribution_at_sequence(x, grad, alphabet='ACGT'):
+    """
+    Attribution of the observed nucleotides and the sequence strings of one-hot sequences.
+    inputs:
+        x : np.array
+            One-hot sequences (N, L, A) or a single sequence (L, A).
+        grad : np.array
+            Attribution scores (e.g. gradients) of the same shape.
+        alphabet : str
+            Nucleotide order of the one-hot encoding.
+
+    Returns
+    -------
+        np.array (N, L) of the attribution at each observed nucleotide and list of N sequence strings, or (L,) and
+        one string for a single sequence.
+    """
+    x = np.asarray(x)
+    grad = np.asarray(grad)
+    x_index = np.argmax(x, axis=-1)
+    saliency = np.take_along_axis(grad, x_index[..., np.newaxis], axis=-1)[..., 0]
+    letters = np.frombuffer(alphabet.encode(), dtype='S1')[x_index]
+    if x.ndim == 2:
+        return saliency, letters.tobytes().decode()
+    return saliency, [seq.tobytes().decode() for seq in letters]
+
 
-    x_index = np.argmax(np.squeeze(x), axis=1)
+def grad_times_input_to_df(x, grad, alphabet='ACGT', window=None):
+    """
+    generate pandas dataframe for saliency plot
+    based on grad x inputs, only for positions window = [start, end] if given
+    """
+    x = np.squeeze(x)
     grad = np.squeeze(grad)
-    L, A = grad.shape
-
-    seq = ''
-    saliency = np.zeros((L))
-    for i in range(L):
-        seq += alphabet[x_index[i]]
-        saliency[i] = grad[i, x_index[i]]
+    if window is not None:
+        x = x[window[0]:window[1]]
+        grad = grad[window[0]:window[1]]
+    saliency, seq = attribution_at_sequence(x, grad, alphabet)
 
     # create saliency matrix
     saliency_df = logomaker.saliency_to_matrix(seq=seq, values=saliency)
@@ -253,10 +618,10 @@ def plot_attribution_map(saliency_df, ax=None, figsize=(20, 1)):
 #     return track_groups
 
 
-def plot_one_seq_feature_map(seq_tile_id, model, seq_parser, cell_line, track_index, plot_xstreme=True):
+def plot_one_seq_feature_map(seq_tile_id, model, seq_parser, cell_line, track_index, plot_xstreme=True, store=None):
     # get sequence coordinate info
     cre_saliency_scores, creme_mask = get_saliency_and_creme_mask_overlap(seq_tile_id, model, seq_parser, cell_line,
-                                                                          track_index)
+                                                                          track_index, store)
 
 
     fig, ax = plt.subplots(1, 1, figsize=[15, 2])
@@ -279,14 +644,20 @@ def plot_one_seq_feature_map(seq_tile_id, model, seq_parser, cell_line, track_in
 
 
 
-def get_saliency_and_creme_mask_overlap(seq_tile_id, model, seq_parser, cell_line, track_index):
+def get_saliency_and_creme_mask_overlap(seq_tile_id, model, seq_parser, cell_line, track_index, store=None):
+    """
+    Saliency (grad x input) and CREME pruning mask of a CRE. With a result_store.SaliencyStore, both are read from
+    (or computed once into) the store and the saliency is a np.array instead of a tensor.
+    """
     # get sequence coordinate info
     chrom, tss, strand, enh_tile_start = seq_tile_id.split('_')[1:5]
     tss = int(tss)
     enh_tile_start = int(enh_tile_start)
     enh_tile_end = enh_tile_start + 5000
-    # load creme and XSTREME results
-    creme_res = read_pickle(f'../results/motifs_500,50_batch_1,10_shuffle_10_thresh_0.9,0.7/{cell_line}/{seq_tile_id}')
+    if store is not None:
+        seq_id = '_'.join(seq_tile_id.split('_')[:4])
+        cre_saliency_scores = store.saliency([seq_id], track_index, [enh_tile_start, enh_tile_end])[0]
+        return cre_saliency_scores, store.creme_mask(seq_tile_id, cell_line)
 
     # get saliency of seq
     wt_seq = seq_parser.extract_seq_centered(chrom, int(tss), strand, model.seq_length)
@@ -301,13 +672,49 @@ def get_saliency_and_creme_mask_overlap(seq_tile_id, model, seq_parser, cell_lin
     cre_saliency_scores = model.contribution_input_grad(wt_seq_padded, target_mask)[
                           model.seq_length // 2:-model.seq_length // 2][enh_tile_start: enh_tile_end]
 
+    return cre_saliency_scores, get_creme_mask(seq_tile_id, cell_line)
 
-    creme_mask = np.zeros((5000,))
+
+def get_creme_mask(seq_tile_id, cell_line, tile_size=5000):
+    """Mask of the positions of a CRE kept by CREME pruning (50 bp stage), from its pruning result."""
+    enh_tile_start = int(seq_tile_id.split('_')[4])
+    creme_res = read_pickle(f'../results/motifs_500,50_batch_1,10_shuffle_10_thresh_0.9,0.7/{cell_line}/{seq_tile_id}')
+    creme_mask = np.zeros((tile_size,))
     for interval in creme_res[50]['insert_coords']:
         interval = interval - enh_tile_start
         creme_mask[interval[0]: interval[1]] = 1
+    return creme_mask
 
-    return cre_saliency_scores, creme_mask
+
+def saliency_scores(model, seqs, track_index, target_bins=[447, 448], batch_size=2):
+    """
+    Saliency (grad x input) of whole sequences for the target bins of a track, computed in batches.
+    inputs:
+        model : custom_model.Enformer
+            Model with contribution_input_grad, its bin_index and track_index do not apply.
+        seqs : np.array
+            One-hot sequences (N, L, A) of the model's sequence length.
+        track_index : int
+            Target track.
+        target_bins : list
+            Target bins.
+        batch_size : int
+            Number of sequences per gradient pass.
+
+    Returns
+    -------
+        np.array (N, L).
+    """
+    # mask of the full head output, which contribution_input_grad differentiates
+    target_mask = np.zeros((model.target_length, model.num_tracks), dtype=np.float32)
+    target_mask[target_bins, track_index] = 1
+    pad = model.seq_length // 2
+    scores = []
+    for i in range(0, len(seqs), batch_size):
+        seqs_padded = np.pad(seqs[i:i + batch_size], ((0, 0), (pad, pad), (0, 0)), 'constant')
+        grad = np.asarray(model.contribution_input_grad(seqs_padded, target_mask, head=model.head))
+        scores.append(grad.reshape(len(seqs_padded), -1)[:, pad:-pad])
+    return np.concatenate(scores)
 
 
 def convert_pvalue_to_asterisks(pvalue):
@@ -0,0 +1,263 @@
+import os
+import sys
+import time
+import zlib
+import socket
+import argparse
+import threading
+import utils
+
+
+########################################################################################
+# Filesystem work queue
+########################################################################################
+
+
+class WorkQueue():
+    """
+    Work queue on a shared filesystem, so that many jobs (e.g. on a cluster) can split the sequences of a driver
+    script without a scheduler. A job claims an item by atomically creating its lock file, which holds a lease
+    that the job renews in the background while it works on the item. Other jobs take the item over once the lease
+    is older than lease_timeout (e.g. after a crash), or at once if the lock belongs to a dead process on the same
+    host. Items are marked done with a marker file. Each job first works through its own shard of the items and
+    then helps with the other shards.
+    inputs:
+        queue_dir : str
+            Directory for lock and done files, shared by all jobs.
+        workers : int
+            Number of jobs (shards).
+        shard : int
+            Shard of this job, 0 <= shard < workers.
+        lease_timeout : float
+            Seconds without renewal after which the claim of another job is considered stale.
+        writer : utils.ResultWriter
+            Background writer of the results, items are marked done only after their results are saved.
+    """
+    def __init__(self, queue_dir, workers=1, shard=0, lease_timeout=600, writer=None):
+        assert 0 <= shard < workers, 'bad shard'
+        self.queue_dir = queue_dir
+        os.makedirs(queue_dir, exist_ok=True)
+        self.workers = workers
+        self.shard = shard
+        self.lease_timeout = lease_timeout
+        self.writer = writer
+        self.worker_id = f'{socket.gethostname()}_{os.getpid()}'
+        self.complete = False
+        self._held = set()
+        self._heartbeat_thread = None
+
+
+    def _path(self, item, suffix):
+        return f"{self.queue_dir}/{str(item).replace('/', '_')}.{suffix}"
+
+
+    def claim(self, item):
+        """Try to claim an item, returns True if this job now holds its lease."""
+        lock_path = self._path(item, 'lock')
+        for _ in range(2):
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                # take over a stale lease: move the lock to a name of this job, so that no other job can act on
+                # it, and check again that it is the stale lock and not the fresh lock of a job that took over in
+                # the meantime, which is put back
+                stale_path = f'{lock_path}.{self.worker_id}.stale'
+                try:
+                    if not self._stale(lock_path):
+                        return False
+                    os.rename(lock_path, stale_path)
+                except FileNotFoundError:
+                    continue
+                if not self._stale(stale_path):
+                    try:
+                        os.link(stale_path, lock_path)
+                    except FileExistsError:
+                        pass
+                    os.remove(stale_path)
+                    return False
+                os.remove(stale_path)
+                continue
+            with os.fdopen(fd, 'w') as handle:
+                handle.write(self.worker_id)
+            self._held.add(item)
+            if self._heartbeat_thread is None:
+                self._heartbeat_thread = threading.Thread(target=self._heartbeat, daemon=True)
+                self._heartbeat_thread.start()
+            return True
+        return False
+
+
+    def _stale(self, lock_path):
+        """Check if a lock has not been renewed for lease_timeout or belongs to a dead process on this host."""
+        if time.time() - os.path.getmtime(lock_path) >= self.lease_timeout:
+            return True
+        with open(lock_path) as handle:
+            host, _, pid = handle.read().rpartition('_')
+        if host != socket.gethostname() or not pid.isdigit() or int(pid) == os.getpid():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+
+    def _heartbeat(self):
+        """Renew the leases of the held items until the job ends."""
+        while True:
+            time.sleep(self.lease_timeout / 4)
+            for item in list(self._held):
+                try:
+                    self.renew(item)
+                except FileNotFoundError:
+                    pass
+
+
+    def renew(self, item):
+        """Extend the lease of a claimed item (for items that take longer than lease_timeout)."""
+        os.utime(self._path(item, 'lock'))
+
+
+    def release(self, item):
+        """Give up the lease of an unfinished item."""
+        self._held.discard(item)
+        try:
+            os.remove(self._path(item, 'lock'))
+        except FileNotFoundError:
+            pass
+
+
+    def done(self, item):
+        """Mark a claimed item as done."""
+        open(self._path(item, 'done'), 'w').close()
+        self.release(item)
+
+
+    def is_done(self, item):
+        return os.path.isfile(self._path(item, 'done'))
+
+
+    def progress(self, items):
+        """Return number of done, claimed and total items."""
+        files = set(os.listdir(self.queue_dir))
+        names = [str(item).replace('/', '_') for item in items]
+        num_done = sum(f'{name}.done' in files for name in names)
+        num_claimed = sum(f'{name}.lock' in files for name in names)
+        return num_done, num_claimed, len(names)
+
+
+    def available(self, item):
+        """Check if an item is neither done nor under a live lease of another job."""
+        if self.is_done(item):
+            return False
+        try:
+            return self._stale(self._path(item, 'lock'))
+        except FileNotFoundError:
+            return True
+
+
+    def in_shard(self, item):
+        return zlib.crc32(str(item).encode()) % self.workers == self.shard
+
+
+    def process(self, items, key=str, report_every=100, load=None, lookahead=4):
+        """
+        Iterate over the items this job claims, own shard first, and mark each one done after the loop body.
+        If the loop body fails, the item is released for other jobs. Afterwards, complete tells whether all items
+        are done (e.g. to only summarize results in the last job).
+        inputs:
+            items : iterable
+                Items, e.g. df.iterrows().
+            key : function
+                Unique name of an item.
+            report_every : int
+                Print progress after this many items of this job.
+            load : function
+                Loader of an item (e.g. sequence extraction), run in background threads for the next available items.
+                If given, yields (item, load(item)).
+            lookahead : int
+                Number of items loaded in advance.
+        """
+        items = list(items)
+        keys = [key(item) for item in items]
+        order = sorted(range(len(items)), key=lambda i: not self.in_shard(keys[i]))
+        print('Queue {}: {} done, {} claimed of {}'.format(self.queue_dir, *self.progress(keys)))
+
+        candidates = (i for i in order if self.available(keys[i]))
+        if load is None:
+            candidates = ((i, None) for i in candidates)
+        else:
+            candidates = utils.prefetch(candidates, lambda i: load(items[i]), lookahead)
+
+        num_processed = 0
+        for i, loaded in candidates:
+            if self.is_done(keys[i]) or not self.claim(keys[i]):
+                continue
+            if self.is_done(keys[i]):  # finished by another job between the check and the claim
+                self.release(keys[i])
+                continue
+            completed = False
+            try:
+                yield items[i] if load is None else (items[i], loaded)
+                completed = True
+            finally:
+                if completed and self.writer is not None:
+                    self.writer.submit(self.done, keys[i])
+                elif completed:
+                    self.done(keys[i])
+                else:
+                    self.release(keys[i])
+            num_processed += 1
+            if num_processed % report_every == 0:
+                print('Queue {}: {} done, {} claimed of {}'.format(self.queue_dir, *self.progress(keys)))
+
+        if self.writer is not None:
+            self.writer.flush()
+        num_done, num_claimed, num_items = self.progress(keys)
+        print(f'Queue {self.queue_dir}: {num_done} done, {num_claimed} claimed of {num_items} '
+              f'({num_processed} by this job)')
+        self.complete = num_done == num_items
+        if not self.complete:
+            held = [k for k in keys if not self.is_done(k) and os.path.isfile(self._path(k, 'lock'))]
+            if held:
+                print(f'Queue {self.queue_dir}: {len(held)} items are held by other jobs (rerun once their lease of '
+                      f'{self.lease_timeout:.0f} s expires if those jobs died): {", ".join(map(str, held[:10]))}')
+
+
+    def iterrows(self, df, key, load=None, lookahead=4):
+        """
+        Iterate over the claimed rows of a dataframe, key is a function of the row. If load (a function of the row)
+        is given, yields (index, row, load(row)) and loads the next lookahead rows in the background.
+        """
+        if load is None:
+            return self.process(df.iterrows(), key=lambda item: key(item[1]))
+        rows = self.process(df.iterrows(), key=lambda item: key(item[1]), load=lambda item: load(item[1]),
+                            lookahead=lookahead)
+        return ((i, row, x) for (i, row), x in rows)
+
+
+########################################################################################
+# useful functions
+########################################################################################
+
+
+def parse_args(argv=None):
+    """
+    Remove the common work queue options (--workers N --shard K --lease SECONDS) from the command line of a
+    driver script so that its positional arguments stay in place.
+
+    Returns
+    -------
+        dict of WorkQueue arguments.
+    """
+    if argv is None:
+        argv = sys.argv
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--shard', type=int, default=0)
+    parser.add_argument('--lease', type=float, default=600)
+    args, rest = parser.parse_known_args(argv[1:])
+    argv[1:] = rest
+    return {'workers': args.workers, 'shard': args.shard, 'lease_timeout': args.lease}
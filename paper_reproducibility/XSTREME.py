@@ -8,14 +8,16 @@ from pymemesuite.fimo import FIMO
 from pymemesuite.common import MotifFile
 import Bio.SeqIO
 from pymemesuite.common import Sequence
-import copy
 
 from creme import creme
 from creme import custom_model
 from creme import utils
+from creme import work_queue
+from creme import motif_masks
 
 
 def main():
+    queue_args = work_queue.parse_args()
 
     meme_path = sys.argv[1]
     track_index = int(sys.argv[2])
@@ -33,6 +35,8 @@ def main():
 
     result_dir = utils.make_dir(f"{utils.make_dir(f'../results/XSTREME/')}/FIMO/")
     result_dir = utils.make_dir(f"{result_dir}/{meme_filename}_{track_index}/")
+    writer = utils.ResultWriter()
+    queue = work_queue.WorkQueue(f'{result_dir}/queue', writer=writer, **queue_args)
     csv_dir = f'../results/summary_csvs/{model_name}/'
     cre_df_path = f'{csv_dir}/sufficient_CREs.csv'
     cre_set = pd.read_csv(cre_df_path)
@@ -49,7 +53,8 @@ def main():
 
     fimo = FIMO(both_strands=True)
 
-    for r, row in tqdm(cre_set.iterrows(), total=cre_set.shape[0]):
+    for r, row in tqdm(queue.iterrows(cre_set, key=lambda row: f"{row['seq_id']}_{row['tile_start']}_{row['tile_end']}"),
+                       total=cre_set.shape[0]):
         chrom, start, strand = row['seq_id'].split('_')[1:]
 
         seq_wt = seq_parser.extract_seq_centered(chrom, int(start), strand, model.seq_length,
@@ -71,31 +76,19 @@ def main():
 
             sequences = [Sequence(str(record.seq), name=record.id.encode())
                          for record in Bio.SeqIO.parse(fasta_path, "fasta")]  # weird seq format for fimo
-            # create N motifs x L mask of motif positions
-            mask = np.zeros((len(motifs), tile_size))
-            for i, motif in enumerate(motifs):
-                pattern = fimo.score_motif(motif, sequences, motif_file.background)
-                for m in pattern.matched_elements:
-                    mask[i, m.start:m.stop] = 1
-            index_bool = [True if m else False for m in np.max(mask, axis=0)]  # mask showing motif positions
-            non_index_bool = [not e for e in index_bool]  # mask showing where motifs are not
-            random_mask = copy.copy(index_bool)
-            np.random.shuffle(random_mask)
-
-            control_sequences = motif_search_res['control_sequences']
-            result_summary = {"motif_mask": index_bool}
-            for label, mask in {"motifs": index_bool, "non-motifs": non_index_bool, "random": random_mask,
-                                "all": [True for _ in range(5000)]}.items():
-                # take shuffled CRE from controlseqs
-                cre_motifs = control_sequences[:, cre_start: cre_end, :].copy()  # start with shuffled CRE
-                cre_motifs[:, mask, :] = cre_onehot_wt[mask]  # embed
-                # embed CRE with just the motifs back into seqs
-                test_seqs = control_sequences.copy()
-                test_seqs[:, cre_start: cre_end, :] = cre_motifs
-
-                test_pred = model.predict(test_seqs)
-                result_summary[label] = test_pred.mean()
-            utils.save_pickle(result_path, result_summary)
+            # mask of the positions of all FIMO hits of all motifs
+            hits = [(m.start, m.stop) for motif in motifs
+                    for m in fimo.score_motif(motif, sequences, motif_file.background).matched_elements]
+            starts, stops = np.array(hits, dtype=int).reshape(-1, 2).T
+            motif_mask = motif_masks.interval_mask(starts, stops, tile_size)
+
+            # motifs, non-motifs, random and all positions kept from the WT, predicted in one call
+            labels, masks = motif_masks.mask_conditions(motif_mask)
+            preds = motif_masks.evaluate_masks(model, motif_search_res['control_sequences'], cre_onehot_wt,
+                                               cre_start, masks)
+            result_summary = {"motif_mask": motif_mask.tolist()}
+            result_summary.update(zip(labels, preds))
+            writer.save_pickle(result_path, result_summary)
 
 
 if __name__ == '__main__':
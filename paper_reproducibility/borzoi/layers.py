@@ -256,6 +256,37 @@ def positional_features(
     return embeddings
 
 
+_positional_features_cache = {}
+
+
+def cached_positional_features(seq_length: int, feature_size: int, symmetric=False):
+    """Relative positional features over all 2T-1 distances, computed once.
+
+    The features depend only on the sequence length and feature size, so they
+    are computed eagerly on first use and returned as a constant thereafter.
+
+    Args:
+      seq_length: Sequence length T.
+      feature_size: Total number of basis functions.
+      symmetric: Use only the symmetric version of the features.
+
+    Returns:
+      Constant tensor of shape: `(1, 2T-1, feature_size)`.
+    """
+    cache_key = (seq_length, feature_size, symmetric)
+    if cache_key not in _positional_features_cache:
+        with tf.init_scope():
+            distances = tf.range(-seq_length + 1, seq_length, dtype=tf.float32)
+            embeddings = positional_features(
+                positions=distances[tf.newaxis],
+                feature_size=feature_size,
+                seq_length=seq_length,
+                symmetric=symmetric,
+            )
+            _positional_features_cache[cache_key] = embeddings.numpy()
+    return tf.constant(_positional_features_cache[cache_key])
+
+
 def relative_shift(x):
     """Shift the relative logits like in TransformerXL."""
     # We prepend zeros on the final timescale dimension.
@@ -481,11 +512,9 @@ class MultiheadAttention(tf.keras.layers.Layer):
             logits = content_logits
         else:
             # Project positions to form relative keys.
-            distances = tf.range(-seq_len + 1, seq_len, dtype=tf.float32)[tf.newaxis]
-            positional_encodings = positional_features(
-                positions=distances,
-                feature_size=self._num_position_features,
+            positional_encodings = cached_positional_features(
                 seq_length=seq_len,
+                feature_size=self._num_position_features,
                 symmetric=self._relative_position_symmetric,
             )
             # [1, 2T-1, Cr]
@@ -30,14 +30,22 @@ class SeqNN:
 
     Args:
       params (dict): Model specification and parameters.
+      precision (str): CPU inference precision, float32 or bfloat16
+        (see creme.custom_model.set_cpu_precision). If None, keep the current one.
     """
 
-    def __init__(self, params: dict):
+    def __init__(self, params: dict, precision: str = None):
+        # reduced-precision CPU inference
+        if precision:
+            from creme.custom_model import set_cpu_precision
+
+            set_cpu_precision(precision)
         self.set_defaults()
         for key, value in params.items():
             self.__setattr__(key, value)
         self.build_model()
         self.ensemble = None
+        self.incremental = None
 
     def set_defaults(self):
         """Set default parameters.
@@ -144,8 +152,10 @@ class SeqNN:
         ###################################################
         # build convolution blocks
         self.reprs = []
+        self.trunk_outputs = []
         for bi, block_params in enumerate(self.trunk):
             current = self.build_block(current, block_params)
+            self.trunk_outputs.append(current)
             if save_reprs:
                 self.reprs.append(current)
 
@@ -259,6 +269,35 @@ class SeqNN:
             # create meta model
             self.ensemble = tf.keras.Model(inputs=sequence, outputs=preds_avg)
 
+    def build_folds(self, fold_seqnns, average: bool = True):
+        """Build ensemble of cross-validation fold models, in graph.
+
+        Every fold computes on the same input sequence within one graph, so
+        the folds' independent branches run concurrently across the
+        inter-op thread pool rather than one after another.
+
+        Args:
+          fold_seqnns ([SeqNN]): Other fold models with matching inputs.
+          average (bool): Average fold predictions, else stack them on axis 1.
+        """
+        # sequence input
+        sequence = tf.keras.Input(shape=(self.seq_length, 4), name="sequence")
+
+        # predict each fold
+        fold_models = [self.ensemble or self.model]
+        for fold_seqnn in fold_seqnns:
+            fold_models.append(fold_seqnn.ensemble or fold_seqnn.model)
+        preds = [fold_model(sequence) for fold_model in fold_models]
+
+        # combine folds
+        if average:
+            preds_folds = tf.keras.layers.Average()(preds)
+        else:
+            preds_folds = tf.stack(preds, axis=1)
+
+        # create meta model
+        self.ensemble = tf.keras.Model(inputs=sequence, outputs=preds_folds)
+
     def build_sad(self):
         """Sum across length axis, in graph."""
         # sequence input
@@ -300,6 +339,251 @@ class SeqNN:
             # replace model
             self.model = tf.keras.Model(inputs=sequence, outputs=predictions_sum)
 
+    def build_crop(self, target_bins, target_slice=None, head_i=None):
+        """Crop the model to the receptive field of target bins, in graph.
+
+        The U-net upsampling, cropping and final blocks after the last global
+        (e.g. attention) trunk block only see a local window of their inputs.
+        These layers are re-applied to activations cropped to the receptive
+        field of the target bins, and the final dense layer is reduced to the
+        target tracks, so only the requested predictions are computed. Call
+        after restore, since the reduced dense layer copies its weights.
+
+        Args:
+          target_bins ([int]): Output bins to predict.
+          target_slice ([int]): Output tracks to predict.
+          head_i (int): Model head index.
+        """
+        if head_i is None:
+            head_i = 0
+        model = self.models[head_i]
+        sequence = model.inputs[0]
+        output = model.outputs[0]
+
+        # crop after the last global trunk block
+        global_bi = [
+            bi
+            for bi, block_params in enumerate(self.trunk)
+            if block_params["name"] not in CROP_BLOCKS
+        ]
+        if len(global_bi) == 0:
+            raise ValueError("Model trunk has no global block to crop after.")
+        pre_nodes = _graph_nodes([self.trunk_outputs[global_bi[-1]]], {id(sequence)})
+        boundary = _boundary_tensors(output, pre_nodes)
+        crop_nodes = _graph_nodes([output], {id(t) for t in boundary})
+
+        # propagate target bin range back through the cropped layers
+        target_bins = np.array(target_bins)
+        target_range = {id(output): (target_bins.min(), target_bins.max() + 1)}
+        for node in reversed(crop_nodes):
+            out_id = id(tf.nest.flatten(node.outputs)[0])
+            if out_id not in target_range:
+                continue
+            inputs = _crop_inputs(node)
+            for t in inputs:
+                in_range = _crop_input_range(node.layer, target_range[out_id], t)
+                if id(t) in target_range:
+                    in_range = (
+                        min(in_range[0], target_range[id(t)][0]),
+                        max(in_range[1], target_range[id(t)][1]),
+                    )
+                target_range[id(t)] = in_range
+
+        # reduced final dense layer
+        final_node = _producer_node(output)
+        if final_node.layer.__class__.__name__ in REVERSE_LAYERS:
+            final_node = _producer_node(final_node.keras_inputs[0])
+        final_layer = final_node.layer
+        if target_slice is not None and isinstance(final_layer, tf.keras.layers.Dense):
+            kernel, bias = final_layer.get_weights()
+            final_slice = tf.keras.layers.Dense(
+                units=len(target_slice), activation=final_layer.activation
+            )
+            final_slice.build(kernel.shape[:1])
+            final_slice.set_weights([kernel[:, target_slice], bias[target_slice]])
+        else:
+            final_slice = None
+
+        # re-apply layers to cropped activations
+        values = {id(t): (t, 0) for t in boundary}
+        for node in crop_nodes:
+            out_t = tf.nest.flatten(node.outputs)[0]
+            if id(out_t) not in target_range:
+                continue
+            out_start, out_end = target_range[id(out_t)]
+            inputs = _crop_inputs(node)
+
+            # slice inputs to the range this layer needs
+            tensor_dict = {}
+            for t in inputs:
+                in_start, in_end = _crop_input_range(
+                    node.layer, (out_start, out_end), t
+                )
+                value, value_start = values[id(t)]
+                value = value[:, in_start - value_start : in_end - value_start]
+                tensor_dict.setdefault(str(id(t)), []).append(value)
+
+            layer_type = node.layer.__class__.__name__
+            if layer_type in REVERSE_LAYERS or layer_type == "Cropping1D":
+                current = tensor_dict[str(id(inputs[0]))][0]
+            else:
+                if node is final_node and final_slice is not None:
+                    layer = final_slice
+                else:
+                    layer = node.layer
+                args, kwargs = node.map_arguments(tensor_dict)
+                current = layer(*args, **kwargs)
+
+            # slice output to the target range
+            in_start = _crop_input_range(node.layer, (out_start, out_end), inputs[0])[0]
+            current_start = _crop_output_start(node.layer, in_start)
+            current = current[:, out_start - current_start : out_end - current_start]
+            values[id(out_t)] = (current, out_start)
+
+        # gather target bins and tracks
+        predictions, predictions_start = values[id(output)]
+        if not np.array_equal(
+            target_bins, np.arange(target_bins.min(), target_bins.max() + 1)
+        ):
+            predictions = tf.gather(
+                predictions, target_bins - predictions_start, axis=-2
+            )
+        if target_slice is not None and final_slice is None:
+            predictions = tf.gather(predictions, target_slice, axis=-1)
+
+        # replace model
+        self.model = tf.keras.Model(inputs=sequence, outputs=predictions)
+
+    def build_incremental(self, head_i=None):
+        """Split the model at its convolution tower for incremental prediction.
+
+        The leading trunk blocks listed in LOCAL_BLOCKS only see a finite window
+        of the sequence, so an edited sequence changes their activations only
+        around the edit. The tower activations consumed downstream (the tower
+        output and any U-net skip representations) are cached for a reference
+        sequence with set_reference and patched by predict_incremental.
+
+        Args:
+          head_i (int): Model head index.
+        """
+        if head_i is None:
+            head_i = 0
+        model = self.models[head_i]
+        sequence = model.inputs[0]
+
+        # leading local blocks make up the tower
+        num_tower = 0
+        for block_params in self.trunk:
+            if block_params["name"] not in LOCAL_BLOCKS:
+                break
+            num_tower += 1
+        if num_tower == 0:
+            raise ValueError("Model trunk does not start with convolution blocks.")
+        tower_output = self.trunk_outputs[num_tower - 1]
+
+        # separate tower nodes from downstream nodes
+        tower_nodes = _graph_nodes([tower_output], {id(sequence)})
+        boundary = _boundary_tensors(model.outputs[0], tower_nodes)
+
+        self.incremental = {
+            "sequence": sequence,
+            "boundary": boundary,
+            "tower_nodes": _graph_nodes(boundary, {id(sequence)}),
+            "downstream_nodes": _graph_nodes(model.outputs, {id(t) for t in boundary}),
+            "output": model.outputs[0],
+            "receptive": _tower_receptive_fields(tower_nodes, sequence),
+            "reference": None,
+        }
+        self.incremental["stride"] = self.incremental["receptive"][id(tower_output)][0]
+        self.incremental["halo"] = max(
+            self.incremental["receptive"][id(t)][1] for t in boundary
+        )
+
+        if self.verbose:
+            print("incremental tower blocks", num_tower)
+            print("incremental tower stride", self.incremental["stride"])
+            print("incremental tower halo", self.incremental["halo"])
+
+    def set_reference(self, seq_1hot):
+        """Cache convolution tower activations of a reference sequence.
+
+        Args:
+          seq_1hot (np.array): 1-hot encoded reference sequence (L, 4).
+        """
+        if self.incremental is None:
+            self.build_incremental()
+        inc = self.incremental
+
+        seq_1hot = np.asarray(seq_1hot, dtype="float32")
+        if seq_1hot.ndim == 3:
+            seq_1hot = seq_1hot[0]
+        values = _run_nodes(
+            inc["tower_nodes"], {id(inc["sequence"]): seq_1hot[np.newaxis]}
+        )
+        inc["reference"] = seq_1hot
+        inc["reference_reprs"] = [values[id(t)].numpy() for t in inc["boundary"]]
+
+    def predict_incremental(self, seqs_1hot, dtype="float32"):
+        """Predict sequences that differ locally from the cached reference.
+
+        Convolution tower activations are recomputed only in stride-aligned
+        windows covering the receptive field of the positions that differ from
+        the reference; the rest of the model runs on the patched activations.
+        Results match full recomputation up to float round-off.
+
+        Args:
+          seqs_1hot (np.array): 1-hot encoded sequences (N, L, 4) or (L, 4).
+          dtype (str): Data type to return.
+        Returns:
+          Predictions of the head selected in build_incremental.
+        """
+        inc = self.incremental
+        if inc is None or inc["reference"] is None:
+            raise ValueError("Call set_reference before predict_incremental.")
+
+        seqs_1hot = np.asarray(seqs_1hot, dtype="float32")
+        if seqs_1hot.ndim == 2:
+            seqs_1hot = seqs_1hot[np.newaxis]
+        seq_length = seqs_1hot.shape[1]
+        stride, halo = inc["stride"], inc["halo"]
+        margin = 2 * halo + stride
+
+        patched = [[] for _ in inc["boundary"]]
+        for seq_1hot in seqs_1hot:
+            reprs = [r.copy() for r in inc["reference_reprs"]]
+            for edit_start, edit_end in _edit_spans(seq_1hot, inc["reference"], margin):
+                # stride-aligned window holding the full receptive field
+                win_start = max(0, (edit_start - margin) // stride * stride)
+                win_end = min(seq_length, -(-(edit_end + margin) // stride) * stride)
+                values = _run_nodes(
+                    inc["tower_nodes"],
+                    {id(inc["sequence"]): seq_1hot[np.newaxis, win_start:win_end]},
+                )
+
+                # patch affected positions of each representation
+                for ti, t in enumerate(inc["boundary"]):
+                    if len(t.shape) != 3:
+                        continue
+                    jump = inc["receptive"][id(t)][0]
+                    pos_start = max(0, (edit_start - halo) // jump)
+                    pos_end = min(reprs[ti].shape[1], -(-(edit_end + halo) // jump))
+                    offset = win_start // jump
+                    reprs[ti][:, pos_start:pos_end] = values[id(t)].numpy()[
+                        :, pos_start - offset : pos_end - offset
+                    ]
+            for ti, r in enumerate(reprs):
+                patched[ti].append(r)
+
+        # run downstream of the tower on the patched representations
+        feed = {}
+        for ti, t in enumerate(inc["boundary"]):
+            if len(t.shape) == 3:
+                feed[id(t)] = np.concatenate(patched[ti], axis=0)
+            else:
+                feed[id(t)] = inc["reference_reprs"][ti]
+        values = _run_nodes(inc["downstream_nodes"], feed)
+        return values[id(inc["output"])].numpy().astype(dtype)
+
     def downcast(self, dtype=tf.float16, head_i=None):
         """Downcast model output type."""
         # choose model
@@ -659,3 +943,230 @@ class SeqNN:
             print("model_strides", self.model_strides)
             print("target_lengths", self.target_lengths)
             print("target_crops", self.target_crops)
+
+
+############################################################
+# Incremental prediction helpers
+############################################################
+
+# trunk blocks whose outputs depend only on a local sequence window
+LOCAL_BLOCKS = [
+    "conv_block",
+    "conv_dna",
+    "conv_nac",
+    "conv_next",
+    "conv_tower",
+    "conv_tower_nac",
+    "convnext_tower",
+    "res_tower",
+]
+
+# layers that act on each position independently (in inference mode)
+POINTWISE_LAYERS = [
+    "Activation",
+    "Add",
+    "BatchNormalization",
+    "Concatenate",
+    "Dense",
+    "Dropout",
+    "Exp",
+    "LayerNormalization",
+    "Multiply",
+    "PolyReLU",
+    "ReLU",
+    "Scale",
+    "Softplus",
+    "StochasticReverseComplement",
+    "StochasticShift",
+    "TFOpLambda",
+]
+
+
+# trunk blocks that only see a local window of their inputs
+CROP_BLOCKS = LOCAL_BLOCKS + [
+    "concat_unet",
+    "fpn_unet",
+    "fpn1_unet",
+    "upsample_unet",
+    "Conv1D",
+    "Cropping1D",
+    "Dense",
+]
+
+# layers that undo reverse complement augmentation (identity at inference)
+REVERSE_LAYERS = ["SwitchReverse", "SwitchReverseTriu"]
+
+
+def _producer_node(tensor):
+    """Return the Keras node that produced a symbolic tensor."""
+    layer, node_index, _ = tensor._keras_history
+    return layer._inbound_nodes[node_index]
+
+
+def _graph_nodes(outputs, feed_ids):
+    """Return the nodes computing outputs from fed tensors, in execution order.
+
+    Args:
+      outputs ([KerasTensor]): Symbolic tensors to compute.
+      feed_ids (set): ids of the symbolic tensors that will be fed.
+    Returns:
+      nodes ([Node]): Topologically sorted graph nodes.
+    """
+    nodes = []
+    visited = set()
+    stack = [(t, False) for t in outputs]
+    while stack:
+        t, expanded = stack.pop()
+        if id(t) in feed_ids:
+            continue
+        node = _producer_node(t)
+        if node.is_input:
+            raise ValueError("Graph disconnected at input %s." % t.name)
+        if expanded:
+            if id(node) not in visited:
+                visited.add(id(node))
+                nodes.append(node)
+        elif id(node) not in visited:
+            stack.append((t, True))
+            stack.extend((ti, False) for ti in node.keras_inputs)
+    return nodes
+
+
+def _boundary_tensors(output, inner_nodes):
+    """Return tensors made by inner nodes that the rest of the graph consumes.
+
+    Args:
+      output (KerasTensor): Symbolic model output.
+      inner_nodes ([Node]): Nodes computing the inner part of the graph.
+    Returns:
+      boundary ([KerasTensor]): Inner tensors consumed by outer nodes.
+    """
+    inner_tensors = {
+        id(t) for node in inner_nodes for t in tf.nest.flatten(node.outputs)
+    }
+    boundary = {}
+    stack = [output]
+    while stack:
+        t = stack.pop()
+        if id(t) in inner_tensors:
+            boundary[id(t)] = t
+            continue
+        node = _producer_node(t)
+        if node.is_input:
+            raise ValueError("Model output depends on the sequence directly.")
+        stack.extend(node.keras_inputs)
+    return list(boundary.values())
+
+
+def _run_nodes(nodes, feed):
+    """Run graph nodes eagerly in inference mode.
+
+    Args:
+      nodes ([Node]): Topologically sorted graph nodes.
+      feed (dict): Values keyed by the ids of symbolic input tensors.
+    Returns:
+      values (dict): Fed and computed values keyed by symbolic tensor id.
+    """
+    values = {k: tf.convert_to_tensor(v) for k, v in feed.items()}
+    for node in nodes:
+        tensor_dict = {}
+        for t in node.keras_inputs:
+            tensor_dict.setdefault(str(id(t)), []).append(values[id(t)])
+        args, kwargs = node.map_arguments(tensor_dict)
+        outputs = node.layer(*args, **kwargs)
+        for t, y in zip(tf.nest.flatten(node.outputs), tf.nest.flatten(outputs)):
+            values[id(t)] = y
+    return values
+
+
+def _tower_receptive_fields(nodes, sequence):
+    """Track stride and receptive field half-width through local layers.
+
+    Position i of a tensor with stride s and halo h depends only on sequence
+    positions [i * s - h, (i + 1) * s + h).
+
+    Args:
+      nodes ([Node]): Topologically sorted tower nodes.
+      sequence (KerasTensor): Symbolic sequence input.
+    Returns:
+      receptive (dict): (stride, halo) keyed by symbolic tensor id.
+    """
+    receptive = {id(sequence): (1, 0)}
+    for node in nodes:
+        layer = node.layer
+        stride = max(receptive[id(t)][0] for t in node.keras_inputs)
+        halo = max(receptive[id(t)][1] for t in node.keras_inputs)
+        layer_type = layer.__class__.__name__
+
+        if hasattr(layer, "kernel_size"):
+            if getattr(layer, "padding", "same") != "same":
+                raise ValueError("Layer %s must use same padding." % layer.name)
+            halo += (layer.kernel_size[0] - 1) * layer.dilation_rate[0] * stride
+            stride *= layer.strides[0]
+        elif hasattr(layer, "pool_size"):
+            pool_size = np.ravel(layer.pool_size)[0]
+            pool_stride = np.ravel(getattr(layer, "strides", pool_size))[0]
+            halo += max(0, pool_size - pool_stride) * stride
+            stride *= pool_stride
+        elif layer_type not in POINTWISE_LAYERS:
+            raise ValueError("Layer %s is not local." % layer.name)
+
+        for t in tf.nest.flatten(node.outputs):
+            receptive[id(t)] = (int(stride), int(halo))
+    return receptive
+
+
+def _crop_inputs(node):
+    """Return the positional inputs a cropped layer computes from."""
+    if node.layer.__class__.__name__ in REVERSE_LAYERS:
+        return node.keras_inputs[:1]
+    return [t for t in node.keras_inputs if len(t.shape) == 3]
+
+
+def _crop_input_range(layer, out_range, input_tensor):
+    """Return the input position range a layer needs for an output range."""
+    out_start, out_end = out_range
+    in_length = input_tensor.shape[1]
+    layer_type = layer.__class__.__name__
+
+    if hasattr(layer, "kernel_size"):
+        if layer.strides[0] != 1 or layer.padding != "same":
+            raise ValueError("Layer %s cannot be cropped." % layer.name)
+        width = (layer.kernel_size[0] - 1) * layer.dilation_rate[0]
+        in_start, in_end = out_start - width // 2, out_end + width - width // 2
+    elif layer_type == "UpSampling1D":
+        in_start, in_end = out_start // layer.size, -(-out_end // layer.size)
+    elif layer_type == "Cropping1D":
+        in_start = out_start + layer.cropping[0]
+        in_end = out_end + layer.cropping[0]
+    elif layer_type in POINTWISE_LAYERS or layer_type in REVERSE_LAYERS:
+        in_start, in_end = out_start, out_end
+    else:
+        raise ValueError("Layer %s cannot be cropped." % layer.name)
+
+    return max(0, in_start), min(in_length, in_end)
+
+
+def _crop_output_start(layer, in_start):
+    """Return the output position of a layer applied from input in_start."""
+    layer_type = layer.__class__.__name__
+    if layer_type == "UpSampling1D":
+        return in_start * layer.size
+    elif layer_type == "Cropping1D":
+        return in_start - layer.cropping[0]
+    else:
+        return in_start
+
+
+def _edit_spans(seq_1hot, ref_1hot, margin):
+    """Return [start, end) spans where a sequence differs from the reference.
+
+    Differences closer than twice the margin are merged into one span.
+    """
+    diff_i = np.flatnonzero(np.any(seq_1hot != ref_1hot, axis=-1))
+    if len(diff_i) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(diff_i) > 2 * margin)
+    starts = np.concatenate([[diff_i[0]], diff_i[breaks + 1]])
+    ends = np.concatenate([diff_i[breaks], [diff_i[-1]]]) + 1
+    return list(zip(starts, ends))
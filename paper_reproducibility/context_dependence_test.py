@@ -1,4 +1,5 @@
 import glob
+import functools
 import pickle
 import pandas as pd
 import numpy as np
@@ -11,9 +12,20 @@ import borzoi_custom_model
 from creme import creme
 from creme import custom_model
 from creme import utils
+from creme import work_queue
+
+
+def summarize_context(context_res, bin_index, cell_index):
+    """Context effect of one sequence at the TSS bins of a cell line."""
+    wt = context_res['wt'][bin_index, cell_index].mean()
+    mut = context_res['mut'][bin_index, cell_index].mean()
+    return {'delta_mean': creme.context_effect_on_tss(wt, mut), 'wt': wt,
+            'std': context_res['std'][bin_index, cell_index].mean(), 'mean_mut': mut}
 
 
 def main():
+    queue_args = work_queue.parse_args()
+    shuffle_args = utils.parse_shuffle_args()
     model_name = sys.argv[1]
     N_shuffles = int(sys.argv[2])
     threshold_enh, threshold_neu, threshold_sil = 0.95, 0.05, -0.3
@@ -59,6 +71,8 @@ def main():
     model_results_dir = utils.make_dir(
         f"{utils.make_dir(f'{result_dir}/context_dependence_test_{N_shuffles}')}/{model_name}")  # output of this test
     print(model_results_dir)
+    writer = utils.ResultWriter()
+    queue = work_queue.WorkQueue(f'{model_results_dir}/queue', writer=writer, **queue_args)
     selected_gene_csvs = glob.glob(f'{csv_dir}/*selected_genes.csv')
 
     seq_parser = utils.SequenceParser(fasta_path)
@@ -67,30 +81,36 @@ def main():
     tss_df = tss_df.sample(frac=1)
     seq_halflen = model.seq_length // 2
 
-    #
-    for i, row in tqdm(tss_df.iterrows(), total=tss_df.shape[0]):
+    def load_seq(row):
+        # sequences are extracted in the background while the model predicts, None if the result exists
+        if os.path.isfile(f"{model_results_dir}/{utils.get_summary(row)}.pickle"):
+            return None
+        return seq_parser.extract_seq_centered(row['Chromosome'], row['Start'], row['Strand'], model.seq_length)
+
+    for i, row, x in tqdm(queue.iterrows(tss_df, key=utils.get_summary, load=load_seq), total=tss_df.shape[0]):
         result_path = f"{model_results_dir}/{utils.get_summary(row)}.pickle"
-        if not os.path.isfile(result_path):
-            x = seq_parser.extract_seq_centered(row['Chromosome'], row['Start'], row['Strand'], model.seq_length)
+        if x is not None:
             if model_name == 'enformer':
-                pred_wt, pred_mut, pred_std = creme.context_dependence_test(model, x,
-                                                                            [seq_halflen - half_window_size,
-                                                                             seq_halflen + half_window_size],
-                                                                            N_shuffles)
+                test_res = creme.context_dependence_test(model, x,
+                                                         [seq_halflen - half_window_size,
+                                                          seq_halflen + half_window_size],
+                                                         N_shuffles, **shuffle_args)
+                result_dict = {'wt': test_res[0], 'mut': test_res[1], 'std': test_res[2]}
+                if shuffle_args['tol'] is not None:
+                    result_dict['num_shuffle'] = test_res[3]
 
-                with open(result_path, 'wb') as handle:
-                    pickle.dump({'wt': pred_wt, 'mut': pred_mut, 'std': pred_std},
-                                handle, protocol=pickle.HIGHEST_PROTOCOL)
+                writer.save_pickle(result_path, result_dict)
 
             elif model_name == 'borzoi':
                 _, pred_mut = creme.context_dependence_test(model, x,
                                                             [seq_halflen - half_window_size,
                                                              seq_halflen + half_window_size],
-                                                            N_shuffles, mean=False, drop_wt=True)
+                                                            N_shuffles, mean=False, drop_wt=True, **shuffle_args)
 
-                with open(result_path, 'wb') as handle:
-                    pickle.dump({'mut': pred_mut},
-                                handle, protocol=pickle.HIGHEST_PROTOCOL)
+                writer.save_pickle(result_path, {'mut': pred_mut})
+
+    if not queue.complete:  # summarize once all jobs are done
+        return
 
     ####### SUMMARIZE RESULTS
     if model_name == 'enformer':
@@ -105,21 +125,14 @@ def main():
                 print(f'{csv_dir.replace("borzoi", "enformer")}/*_{cell_name}_selected_genes.csv')
                 selected_tss = pd.read_csv(glob.glob(f'{csv_dir}/*_{cell_name}_selected_genes.csv')[0])
 
-            summary_per_cell = {k: [] for k in ['delta_mean', 'path', 'wt', 'std', 'mean_mut', 'seq_id']}
-            for _, row in selected_tss.iterrows():
-                path = f'{model_results_dir}/{utils.get_summary(row)}.pickle'
-                summary_per_cell['path'].append(path)
-                summary_per_cell['seq_id'].append(utils.get_summary(row))
-                with open(path, 'rb') as handle:
-                    context_res = pickle.load(handle)
-                delta = creme.context_effect_on_tss(context_res['wt'][bin_index, i].mean(),
-                                                    context_res['mut'][bin_index, i].mean())
-                summary_per_cell['delta_mean'].append(delta)
-                summary_per_cell['wt'].append(context_res['wt'][bin_index, i].mean())
-                summary_per_cell['std'].append(context_res['std'][bin_index, i].mean())
-                summary_per_cell['mean_mut'].append(context_res['mut'][bin_index, i].mean())
-
-            summary_per_cell = pd.DataFrame.from_dict(summary_per_cell)
+            seq_ids = [utils.get_summary(row) for _, row in selected_tss.iterrows()]
+            manifest = pd.DataFrame({'path': [f'{model_results_dir}/{seq_id}.pickle' for seq_id in seq_ids],
+                                     'seq_id': seq_ids})
+            summary_per_cell = utils.aggregate_pickles(manifest,
+                                                       functools.partial(summarize_context, bin_index=bin_index,
+                                                                         cell_index=i),
+                                                       cache_path=f'{model_results_dir}/summary_cache_{i}.pickle')
+            summary_per_cell = summary_per_cell[['delta_mean', 'path', 'wt', 'std', 'mean_mut', 'seq_id']]
             summary_per_cell['context'] = [v for v in pd.cut(summary_per_cell['delta_mean'],
                                                              [summary_per_cell['delta_mean'].min() - 1, threshold_sil,
                                                               -threshold_neu, threshold_neu, threshold_enh,
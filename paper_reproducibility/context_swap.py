@@ -1,5 +1,6 @@
 import glob
 import pickle
+import itertools
 import pandas as pd
 import seaborn as sns
 import numpy as np
@@ -8,12 +9,18 @@ from tqdm import tqdm
 import json
 
 from creme import creme
+from creme import shuffle
 from creme import custom_model
 from creme import utils
+from creme import work_queue
 
 
 def main():
+    queue_args = work_queue.parse_args()
     model_name = sys.argv[1]
+    # optional sub-block of the swap matrix, e.g. ./context_swap.py enformer enhancing silencing
+    source_context, target_context = sys.argv[2:4] if len(sys.argv) > 3 else (None, None)
+    block_name = f'{source_context}_vs_{target_context}' if source_context else 'all'
     data_dir = '../data/'
     result_dir = f'../results/'
     csv_dir = f'../results/summary_csvs/{model_name}/'
@@ -40,56 +47,86 @@ def main():
 
     results_dir = utils.make_dir(f'{result_dir}/context_swap_test/')
     test_results_dir = utils.make_dir(f'{results_dir}/{model_name}/')
-
+    queue = work_queue.WorkQueue(f'{test_results_dir}/queue', **queue_args)
+    block_size = 4
+    bin_index = [447, 448]
 
     dfs = {cell_line: pd.read_csv(f'{csv_dir}/{cell_line}_selected_contexts.csv') for
            cell_line in cell_lines}
+    sources = {cell: np.flatnonzero(df['context'] == source_context) if source_context else np.arange(len(df))
+               for cell, df in dfs.items()}
+    targets = {cell: np.flatnonzero(df['context'] == target_context) if target_context else np.arange(len(df))
+               for cell, df in dfs.items()}
+
+    # WT predictions of the TSS activity stage (step 1), used instead of predicting sources in their own context
+    tss_prefix = f'{result_dir}/gencode_tss_predictions/{model_name}/tss_predictions'
+    if os.path.isfile(f'{tss_prefix}.npy'):
+        tss_keys = pd.read_csv(f'{result_dir}/tss_positions.csv').apply(utils.get_summary, axis=1).values
+    else:
+        print('No TSS activity predictions, predicting WT sequences')
+        tss_keys = None
 
+    all_complete = True
     for cell, df in dfs.items():
-        df = df.sample(frac=1)
         cell_line_dir = utils.make_dir(f'{test_results_dir}/{cell}')
-        sequences = {}
-        for i, row in tqdm(df.iterrows()):
-            # get sequence from reference genome and convert to one-hot
-            seq_info = row['path'].split('/')[-1].split('.')[0]
-            chrom, start, strand = seq_info.split('_')[1:]
-            sequences[seq_info] = seq_parser.extract_seq_centered(chrom, int(start), strand, model.seq_length,
-                                                                  onehot=True)
-
-        for src_seq_info, src_seq in tqdm(sequences.items(), total=len(sequences.keys())):
-            for dest_seq_info, dest_seq in sequences.items():
-
-                result_path = f'{cell_line_dir}/src_{src_seq_info}_dest_{dest_seq_info}.pickle'
-
-                if not os.path.isfile(result_path):
-                    pred_mut = creme.context_swap_test(model, src_seq, dest_seq, tss_tile)
-                    utils.save_pickle(result_path, pred_mut)
+        # rows and columns of the swap matrix are in the order of the contexts csv
+        seq_ids = [p.split('/')[-1].split('.')[0] for p in df['path']]
+        wt_preds = None
+        if tss_keys is not None:
+            wt_preds = utils.lookup_predictions(tss_prefix, tss_keys, seq_ids).mean(axis=1)
+        sequences = np.empty((len(seq_ids), model.seq_length), dtype=np.uint8)
+        for k, seq_id in enumerate(tqdm(seq_ids)):
+            # get sequence from reference genome and store as tokens
+            chrom, start, strand = seq_id.split('_')[1:]
+            sequences[k] = shuffle.one_hot_to_tokens(seq_parser.extract_seq_centered(chrom, int(start), strand,
+                                                                                     model.seq_length))
+
+        # swap predictions averaged over the TSS bins and done bitmap of source x target blocks
+        num_blocks = (-(-len(sources[cell]) // block_size), -(-len(targets[cell]) // block_size))
+        swap_matrix, done = utils.open_prediction_matrix(f'{cell_line_dir}/swap_matrix_{block_name}',
+                                                         len(sources[cell]), (len(targets[cell]), len(track_index)),
+                                                         done_shape=num_blocks)
+        blocks = queue.process(itertools.product(range(num_blocks[0]), range(num_blocks[1])),
+                               key=lambda b: f'{cell}_{block_name}_{b[0]}_{b[1]}')
+        creme.context_swap_all_pairs(model, sequences, tss_tile, block_size, bin_index, swap_matrix, done,
+                                     tqdm(blocks, total=num_blocks[0] * num_blocks[1]),
+                                     sources=sources[cell], targets=targets[cell], wt_preds=wt_preds)
+        all_complete &= queue.complete
+
+    if not all_complete:  # summarize once all jobs are done
+        return
 
     result_summary = []
-    bin_index = [447, 448]
     for cell_index, cell_line in enumerate(cell_lines):
-        # result_files = glob.glob(f'{results_dir}/{cell_line}/*')
-        df_context = pd.read_csv(f'../results/summary_csvs/{model_name}/{cell_line}_selected_contexts.csv')
-        df_context['source_id'] = [p.split('/')[-1].split('.')[0] for p in df_context['path']]
-        # context_id = dict(zip(df_context['source_id'], df_context['context']))
-        preds = []
-        for i, row_src in tqdm(df_context.iterrows()):
-            res = utils.read_pickle(
-                f'{test_results_dir}/{cell_line}/src_{row_src["source_id"]}_dest_{row_src["source_id"]}.pickle')
-
-            src_wt = res[0, bin_index, cell_index].mean()
-            for j, row_dest in df_context.iterrows():
-                res = utils.read_pickle(
-                    f'../results/context_swap_test/enformer/{cell_line}/src_{row_src["source_id"]}_dest_{row_dest["source_id"]}.pickle')
-                preds.append([row_src["source_id"], row_src['context'],
-                              row_dest["source_id"], row_dest['context'],
-                              res[0, bin_index, cell_index].mean() / src_wt])
-        df = pd.DataFrame(preds)
-        df.columns = ['source', 'source_context', 'target', 'target_context', 'normalised']
+        df_context = dfs[cell_line]
+        src, dest = sources[cell_line], targets[cell_line]
+        seq_id = np.array([p.split('/')[-1].split('.')[0] for p in df_context['path']])
+        swap_matrix, _ = utils.open_prediction_matrix(f'{test_results_dir}/{cell_line}/swap_matrix_{block_name}',
+                                                      len(src))
+        swap_matrix = np.array(swap_matrix[..., cell_index])
+
+        # normalise by the source in its own context (WT), from the TSS activity stage or the diagonal
+        src_wt = np.full(len(src), np.nan)
+        if tss_keys is not None:
+            src_wt = utils.lookup_predictions(tss_prefix, tss_keys, seq_id[src])[..., cell_index].mean(axis=1)
+        diagonal = src[:, np.newaxis] == dest[np.newaxis]
+        missing = np.isnan(src_wt) & diagonal.any(axis=1)
+        src_wt[missing] = swap_matrix[missing][diagonal[missing]]
+        if np.isnan(src_wt).any():
+            print(f'{np.isnan(src_wt).sum()} sources of {cell_line} have no WT prediction, run step 1')
+        normalised = swap_matrix / src_wt[:, np.newaxis]
+        df = pd.DataFrame({'source': np.repeat(seq_id[src], len(dest)),
+                           'source_context': np.repeat(df_context['context'].values[src], len(dest)),
+                           'target': np.tile(seq_id[dest], len(src)),
+                           'target_context': np.tile(df_context['context'].values[dest], len(src)),
+                           'normalised': normalised.ravel()})
         df['cell_line'] = cell_line
         result_summary.append(df)
     result_summary = pd.concat(result_summary)
-    result_summary.to_csv(f'../results/summary_csvs/{model_name}/context_swap_test.csv')
+    if block_name == 'all':
+        result_summary.to_csv(f'../results/summary_csvs/{model_name}/context_swap_test.csv')
+    else:
+        result_summary.to_csv(f'../results/summary_csvs/{model_name}/context_swap_test_{block_name}.csv')
 
 if __name__ == '__main__':
     main()
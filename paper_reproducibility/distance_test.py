@@ -1,4 +1,5 @@
 import glob
+import functools
 import pandas as pd
 import seaborn as sns
 import numpy as np
@@ -12,6 +13,14 @@ import borzoi_custom_model
 from creme import creme
 from creme import custom_model
 from creme import utils
+from creme import work_queue
+
+
+def summarize_distance(res, cell_index, cre_tiles_starts_abs):
+    """TSS activity of one CRE at every tested distance."""
+    test = res['mean_mut'][:, 447:449, cell_index].mean(axis=-1)
+    return pd.DataFrame({'Fold change over control': test / np.max(test), 'test': test,
+                         'Binned distance (Kb)': cre_tiles_starts_abs})
 
 
 ########################################################################################
@@ -20,6 +29,8 @@ from creme import utils
 
 def main():
 
+    queue_args = work_queue.parse_args()
+    shuffle_args = utils.parse_shuffle_args()
     if len(sys.argv) == 4:
         model_name = sys.argv[1]
         num_shuffle = int(sys.argv[2])
@@ -35,6 +46,8 @@ def main():
     fasta_path = f'{data_dir}/GRCh38.primary_assembly.genome.fa'
     result_dir = utils.make_dir(f'../results/distance_test_{set_seed}')
     result_dir_model = utils.make_dir(f'{result_dir}/{model_name}_{num_shuffle}/')
+    writer = utils.ResultWriter()
+    queue = work_queue.WorkQueue(f'{result_dir_model}/queue', writer=writer, **queue_args)
     csv_dir = f'../results/summary_csvs/{model_name}/'
     print(f'USING model {model_name}')
     cre_df_path = f'{csv_dir}/sufficient_CREs.csv'
@@ -69,57 +82,56 @@ def main():
     # set up sequence parser from fasta
     seq_parser = utils.SequenceParser(fasta_path)
     cre_df = cre_df.sample(frac=1)
+
+    def load_seq(row):
+        # get sequence from reference genome and convert to one-hot, in the background while the model predicts,
+        # None if the result exists
+        if os.path.isfile(f"{result_dir_model}/{row['seq_id']}_{row['tile_start']}_{row['tile_end']}.pickle"):
+            return None
+        chrom, start, strand = row['seq_id'].split('_')[1:]
+        return seq_parser.extract_seq_centered(chrom, int(start), strand, model.seq_length, onehot=True)
+
     # loop through and predict TSS activity
-    for i, row in tqdm(cre_df.iterrows(), total=len(cre_df)):
+    for i, row, x in tqdm(queue.iterrows(cre_df, key=lambda row: f"{row['seq_id']}_{row['tile_start']}_{row['tile_end']}",
+                                         load=load_seq), total=len(cre_df)):
         tile_start, tile_end = [row['tile_start'], row['tile_end']]
         result_path = f'{result_dir_model}/{row["seq_id"]}_{tile_start}_{tile_end}.pickle'
         print(result_path)
-        if not os.path.isfile(result_path):
-            # get sequence from reference genome and convert to one-hot
-            chrom, start, strand = row['seq_id'].split('_')[1:]
-            x = seq_parser.extract_seq_centered(chrom, int(start), strand, model.seq_length, onehot=True)
-
+        if x is not None:
             # perform TSS-CRE distance dependence Test
 
             res = creme.distance_test(model, x, tss_tile, [tile_start, tile_end],
                                        cre_tiles_starts, num_shuffle, mean=compute_mean,
-                                       seed=set_seed)
+                                       seed=set_seed, **shuffle_args)
+
+            # store predictions (with the number of shuffles used in adaptive mode)
+            writer.save_pickle(result_path, res)
 
-            # store predictions
-            utils.save_pickle(result_path, res)
+    if not queue.complete:  # summarize once all jobs are done
+        return
 
     if model_name == 'enformer':
         result_normalized_effects = []
-        all_norm_effects = []
-        raw_preds = {}
         for i, cell_line in enumerate(cell_lines):
-            raw_preds[cell_line] = []
             cre_df_cell = cre_df[cre_df['cell_line'] == cell_line]
-            cre_df_cell.insert(1, "distance to TSS (Kb)",
-                               [(int(i) - tss_tile[0]) // 1000 for i in cre_df_cell['tile_start'].values])
-            for j, (_, row) in tqdm(enumerate(cre_df_cell.iterrows())):
-                tile_start, tile_end = [row['tile_start'], row['tile_end']]
-                result_path = f'{result_dir_model}/{row["seq_id"]}_{tile_start}_{tile_end}.pickle'
-                res = utils.read_pickle(result_path)
-                control = row['control']  # res['mean_control'][447:449,i].mean()
-                test = res['mean_mut'][:, 447:449, i].mean(axis=-1)
-                if row['context'] == 'enhancing':
-                    CRE_norm_effects = (test - control) / row['wt']
-                else:
-                    CRE_norm_effects = (test - control) / control
-
-                norm_effects = test / np.max(test)
-                all_norm_effects.append(norm_effects)
-                df = pd.DataFrame([norm_effects, CRE_norm_effects, cre_tiles_starts_abs]).T
-                df.columns = ['Fold change over control', "CRE sufficiency effect", 'Binned distance (Kb)']
-                df['Normalized CRE effect (control)'] = row['Normalized CRE effect']
-                raw_preds[cell_line].append(test)
-                df['cell line'] = cell_line
-                df['control'] = control
-                df['enf_data_id'] = f'{row["seq_id"]}_{tile_start}_{tile_end}'
-                df['context'] = row['context']
-                df['tile class'] = row['tile class']
-                result_normalized_effects.append(df)
+            enf_data_ids = [f'{seq_id}_{tile_start}_{tile_end}' for seq_id, tile_start, tile_end in
+                            cre_df_cell[['seq_id', 'tile_start', 'tile_end']].values]
+            manifest = pd.DataFrame({'path': [f'{result_dir_model}/{enf_data_id}.pickle'
+                                              for enf_data_id in enf_data_ids],
+                                     'Normalized CRE effect (control)': cre_df_cell['Normalized CRE effect'].values,
+                                     'cell line': cell_line,
+                                     'control': cre_df_cell['control'].values,  # res['mean_control'][447:449,i].mean()
+                                     'wt': cre_df_cell['wt'].values,
+                                     'enf_data_id': enf_data_ids,
+                                     'context': cre_df_cell['context'].values,
+                                     'tile class': cre_df_cell['tile class'].values})
+            df = utils.aggregate_pickles(manifest,
+                                         functools.partial(summarize_distance, cell_index=i,
+                                                           cre_tiles_starts_abs=cre_tiles_starts_abs),
+                                         cache_path=f'{result_dir_model}/summary_cache_{i}.pickle')
+            norm = np.where(df['context'] == 'enhancing', df['wt'], df['control'])
+            df.insert(1, 'CRE sufficiency effect', (df.pop('test') - df['control']) / norm)
+            result_normalized_effects.append(df.drop(columns=['path', 'wt']))
 
         result_normalized_effects = pd.concat(result_normalized_effects)
         result_normalized_effects.to_csv(f"{csv_dir}/distance_test.csv")
@@ -1,4 +1,3 @@
-import glob
 import pandas as pd
 import seaborn as sns
 import numpy as np
@@ -11,18 +10,27 @@ import borzoi_custom_model
 from creme import creme
 from creme import custom_model
 from creme import utils
+from creme import work_queue
 
 
 def main():
 
+    queue_args = work_queue.parse_args()
     model_name = sys.argv[1]
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 8 # windows per model call
+    max_offset = int(sys.argv[3]) if len(sys.argv) > 3 else 0 # bins between TSSs that share a window, 0 for exact
+    num_check = 32 # shifted TSSs predicted exactly to check the shared windows
     print(f'USING model {model_name}')
+    predict_args = {}
     if model_name.lower() == 'enformer':
         # target_df = pd.read_csv('../data/enformer_targets_human.txt', sep='\t')
         # cage_tracks = [i for i, t in enumerate(target_df['description']) if 'CAGE' in t]
         track_index = [4824, 5110, 5111]
         bin_index = [447, 448]
         model = custom_model.Enformer(track_index=track_index, bin_index=bin_index)
+        predict_args = {'batch_size': batch_size}
+        bin_size = 128
+        bin_axis = 1 # predictions (N, bins, tracks)
     elif model_name.lower() == 'borzoi':
         target_df = pd.read_csv('../data/borzoi_targets_human.txt', sep='\t')
         cage_tracks = [i for i, t in enumerate(target_df['description']) if
@@ -32,6 +40,8 @@ def main():
         target_df.iloc[cage_tracks].to_csv('../data/borzoi_cage_tracks.csv')
         model = borzoi_custom_model.Borzoi('../data/borzoi/*/*', track_index=cage_tracks, aggregate=False)
         model.bin_index = list(np.arange(model.target_lengths // 2 - 4, model.target_lengths // 2 + 4, 1))
+        bin_size = 32
+        bin_axis = 2 # predictions (N, folds, bins, tracks)
 
 
     else:
@@ -46,6 +56,7 @@ def main():
     tss_csv_path = f'{results_dir}/tss_positions.csv'
     results_dir = utils.make_dir(f'{results_dir}/gencode_tss_predictions/')
     results_dir = utils.make_dir(f'{results_dir}/{model_name}/')
+    queue = work_queue.WorkQueue(f'{results_dir}/queue', **queue_args)
 
     if os.path.isfile(tss_csv_path):
         tss_df = pd.read_csv(tss_csv_path, index_col=None)
@@ -61,28 +72,72 @@ def main():
         tss_df = tss_df[['Chromosome', 'Start', 'gene_name', 'gene_id', 'Strand']]
 
         tss_df.to_csv(tss_csv_path, index=False)
-    tss_df = tss_df.sample(frac = 1)
 
     seq_parser = utils.SequenceParser(fasta_path)
     N = tss_df.shape[0]
     print(N)
-    for j, (i, row) in tqdm(enumerate(tss_df.iterrows()), total=N):
-        chrom, start = row[:2]
-        strand = row['Strand']
-        result_path_prefix = f'{results_dir}/{utils.get_summary(row)}'
-        print(result_path_prefix)
-        assert j < N, 'bad index'
-        if len(glob.glob(f'{result_path_prefix}*')) == 0: # if result does not exist
-
-            sequence_one_hot = seq_parser.extract_seq_centered(chrom, start, strand, seq_len)
-            if model_name == 'enformer':
-                wt_pred = np.squeeze(model.predict(sequence_one_hot))
-                np.save(f'{result_path_prefix}.npy', wt_pred)
-            elif model_name == 'borzoi':
-                wt_pred = model.predict(sequence_one_hot)
-
-                utils.save_pickle(f'{result_path_prefix}.pickle', wt_pred)
 
+    # predictions of all TSSs (rows in order of tss_positions.csv) and which ones are done
+    matrix_prefix = f'{results_dir}/tss_predictions'
+    if os.path.isfile(f'{matrix_prefix}.npy'):
+        preds, done = utils.open_prediction_matrix(matrix_prefix, N)
+    else:
+        preds, done = None, np.zeros(N, dtype=bool)
+
+    # nearby alternative TSSs share one predicted window and read their own bins by offset
+    anchor, offset = utils.plan_shared_windows(tss_df, bin_size, max_offset)
+    members = pd.DataFrame({'anchor': anchor}).groupby('anchor').indices
+    windows = np.array(sorted(members))
+    print(f'{len(windows)} windows for {N} TSSs, {N - len(windows)} forward passes saved')
+    tss_bins = list(model.bin_index)
+    window_bins = utils.shared_window_bins(tss_bins, max_offset)
+    model.bin_index = window_bins
+    # row whose window was predicted for each row, so that later stages (see utils.lookup_predictions) only reuse
+    # exact predictions
+    anchor_rows = utils.open_anchor_rows(matrix_prefix, N)
+    shared_rows = []  # rows predicted from a shared window by this job
+
+    def load_seqs(rows):
+        return np.array([seq_parser.extract_seq_centered(chrom, start, strand, seq_len) for chrom, start, strand in
+                         tss_df.iloc[rows][['Chromosome', 'Start', 'Strand']].itertuples(index=False)])
+
+    # stream batches of windows through the model; the done bitmap is the completed set (read once), so rows
+    # finished by an earlier or another job are neither extracted nor predicted again
+    batches = [windows[start:start + batch_size] for start in range(0, len(windows), batch_size)]
+
+    def load_batch(batch):
+        # extract the windows with unfinished TSSs, in the background while the model predicts
+        batch = np.array([w for w in batch if not done[members[w]].all()], dtype=int)
+        return batch, load_seqs(batch)
+
+    for _, (batch, x) in tqdm(queue.process(batches, key=lambda batch: f'tss_{batch[0]}_{batch[-1]}',
+                                            load=load_batch), total=len(batches)):
+        if not len(batch):
+            continue
+        window_pred = model.predict(x, **predict_args)
+        rows = np.concatenate([members[w] for w in batch])
+        window_of_row = np.repeat(np.arange(len(batch)), [len(members[w]) for w in batch])
+        wt_pred = utils.read_shared_window(window_pred[window_of_row], offset[rows], tss_bins, window_bins,
+                                           bin_axis)
+        if preds is None:
+            preds, done = utils.open_prediction_matrix(matrix_prefix, N, wt_pred.shape[1:])
+        preds[rows] = wt_pred
+        preds.flush()
+        anchor_rows[rows] = anchor[rows]
+        anchor_rows.flush()
+        shared_rows.extend(rows[anchor[rows] != rows])
+        # rows are marked done only after their predictions are on disk
+        done[rows] = True
+        done.flush()
+
+    # deviation of the shared-window predictions of this job from exact predictions of a sample of them
+    if len(shared_rows):
+        check = np.random.default_rng(0).choice(shared_rows, min(num_check, len(shared_rows)), replace=False)
+        model.bin_index = tss_bins
+        exact = model.predict(load_seqs(check), **predict_args)
+        deviation = np.abs(preds[check] - exact)
+        print(f'Shared windows of {len(check)} shifted TSSs: max abs deviation {deviation.max():.4f}, '
+              f'max relative deviation {(deviation / np.abs(exact).clip(min=1e-6)).max():.4f}')
 
 
 if __name__ == '__main__':
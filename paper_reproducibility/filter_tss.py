@@ -1,7 +1,6 @@
 import pandas as pd
 import numpy as np
 import sys
-from tqdm import tqdm
 from creme import utils
 
 def main():
@@ -22,24 +21,24 @@ def main():
     elif model_name == 'borzoi':
         cell_lines = ['K562 ENCODE, biol_', 'GM12878 ENCODE, biol_', 'PC-3']
         column_names = cell_lines
-        cell_line_info = utils.get_borzoi_targets(target_df, cell_lines)
+        cell_line_info, _ = utils.get_borzoi_targets(target_df, cell_lines)
 
 
     N = tss_df.shape[0]
-    all_tss = np.empty((N, len(cell_lines)))
-    for i, row in tqdm(tss_df.iterrows(), total=N):
-        if model_name == 'enformer':
-            pred = np.load(f'{result_dir}/{utils.get_summary(row)}.npy')
-            all_tss[i] = pred.mean(axis=0)
-        elif model_name == 'borzoi':
-
+    preds, done = utils.open_prediction_matrix(f'{result_dir}/tss_predictions', N)
+    if not done.all():
+        print(f'Missing predictions for {(~done).sum()} TSS positions, run estimate_TSS_activity.py {model_name}')
+        sys.exit(1)
 
-            pred = utils.read_pickle(f'{result_dir}/{utils.get_summary(row)}.pickle')
-            pred = (pred[0, :, :, :].mean(axis=0).sum(axis=0) / 2)
-            for j, (cell_line, v) in enumerate(cell_line_info.items()):
+    all_tss = np.empty((N, len(cell_lines)))
+    if model_name == 'enformer':
+        all_tss[:] = preds.mean(axis=1)
+    elif model_name == 'borzoi':
+        pred = preds.mean(axis=1).sum(axis=1) / 2
+        for j, (cell_line, v) in enumerate(cell_line_info.items()):
 
-                indeces = v['output']
-                all_tss[i, j] = pred[indeces].sum() # sum across strands of cell line tracks
+            indeces = v['output']
+            all_tss[:, j] = pred[:, indeces].sum(axis=1) # sum across strands of cell line tracks
 
 
 
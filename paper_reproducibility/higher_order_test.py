@@ -11,44 +11,12 @@ import copy
 from creme import creme
 from creme import custom_model
 from creme import utils
+from creme import work_queue
+from creme import greedy_search
 
 
-def process_greedy_search_res(res_path, cre_tiles, log, optimization_name):
-    raw_res = utils.read_pickle(res_path)
-    res = {}
-    if log:
-        for i in raw_res.keys():
-            res[i] = {}
-            for k, v in raw_res[i].items():
-                if 'pred' in k:
-                    res[i][k] = np.log(v)
-                else:
-                    res[i][k] = v
-    else:
-        res = raw_res
-
-    wt = res[0]['initial_pred']
-    trace = [res[i]['initial_pred'] / wt for i in res.keys()]
-    if optimization_name == 'min':
-        trace.append(np.min(res[24]['preds'].mean(axis=-1)) / wt)
-    else:
-        trace.append(np.max(res[24]['preds'].mean(axis=-1)) / wt)
-
-    ####hypothetical additive model
-    greedy_search_order = [np.argwhere(np.array(cre_tiles) == res[i]['selected_tile'])[0][0] for i in
-                           res.keys()]
-
-    mutant_predictions_first_iter = res[0]['preds'].mean(axis=-1)
-
-    effect_sizes_first_iter = mutant_predictions_first_iter - wt
-    sorted_effect_first_iter = effect_sizes_first_iter[greedy_search_order]
-    sorted_effect = (sorted_effect_first_iter / wt)
-    sum_of_effects = np.cumsum(sorted_effect_first_iter)
-    hypothetical_trace = wt + sum_of_effects
-    hypothetical_trace = (np.concatenate([[wt], hypothetical_trace]) / wt)#[:-1] # last of greedy is useless
-    return [trace, hypothetical_trace, sorted_effect]
-
 def main():
+    queue_args = work_queue.parse_args()
     model_name = sys.argv[1]
     optimization_name = sys.argv[2]
 
@@ -67,6 +35,9 @@ def main():
     fasta_path = f'{data_dir}/GRCh38.primary_assembly.genome.fa'
     result_dir = utils.make_dir(f'../results/higher_order_test_{optimization_name}')
     result_dir_model = utils.make_dir(f'{result_dir}/{model_name}/')
+    writer = utils.ResultWriter()
+    queue = work_queue.WorkQueue(f'{result_dir_model}/queue', writer=writer, **queue_args)
+    all_complete = True
     csv_dir = f'../results/summary_csvs/{model_name}/'
     cell_lines = []
     for track_index in [4824, 5110, 5111]:
@@ -96,7 +67,9 @@ def main():
         # set up sequence parser from fasta
         seq_parser = utils.SequenceParser(fasta_path)
 
-        for i, row in tqdm(context_df.iterrows(), total=len(context_df)):
+        for i, row in tqdm(queue.iterrows(context_df,
+                                          key=lambda row: f"{cell_line}_{row['path'].split('/')[-1].split('.')[0]}"),
+                           total=len(context_df)):
             seq_id = row['path'].split('/')[-1].split('.')[0]
             result_path = f'{result_dir_cell}/{seq_id}.pickle'
             print(result_path)
@@ -110,63 +83,26 @@ def main():
                 result_summary = creme.higher_order_interaction_test(model, x, copy.copy(cre_tiles), optimization, num_shuffle,
                                                                      num_rounds)
 
-                utils.save_pickle(result_path, result_summary)
+                writer.save_pickle(result_path, result_summary)
+        all_complete &= queue.complete
 
-    locations_all = []
-    second_its_all = []
-    traces_all = []
+    if not all_complete:  # summarize once all jobs are done
+        return
 
+    # load all results of a cell line once and summarize them together
+    tables = {'second_iteration': [], 'traces': [], 'locations': []}
     for cell_line in cell_lines:
-        # location_map = [0 for _ in range(len(cre_tiles))]
         context_df = pd.read_csv(f'../results/summary_csvs/{model_name}/{cell_line}_selected_contexts.csv')
-
         print(context_df.shape)
-        for _, row in context_df.iterrows():
-            res_path = f"../results/higher_order_test_{optimization_name}/{model_name}/{cell_line}/{row['path'].split('/')[-1]}"
-            res = utils.read_pickle(res_path)
-            greedy_search_order = [np.argwhere(np.array(cre_tiles) == res[i]['selected_tile'])[0][0] for i in
-                                   res.keys()]
-            first_two_points = res[0]['preds'][greedy_search_order[:2]].mean(axis=1)
-            two_cres_shuffled = res[2]['initial_pred']
-            second_it = [res[0]['initial_pred'], first_two_points[0], first_two_points[1], two_cres_shuffled]
-
-
-            trace, hypothetical_trace, sorted_effect = process_greedy_search_res(res_path, cre_tiles, False,
-                                                                                 optimization_name)
-            log_trace, log_hypothetical_trace, log_sorted_effect = process_greedy_search_res(res_path, cre_tiles, True,
-                                                                                             optimization_name)
-
-
-            location_map = [0 for _ in range(len(cre_tiles))]
-            for iteration in range(5):
-                location_map[np.argwhere(res[iteration]['selected_tile'] == np.array(cre_tiles))[0][0]] = 1
-            location_map = pd.DataFrame(location_map, columns=['tile_selected'])
-            location_map['context'] = row['context']
-            location_map['seq_id'] = row['seq_id']
-            location_map['cell_line'] = cell_line
-            locations_all.append(location_map)
-
-            one_seq_res = pd.DataFrame([trace, hypothetical_trace, sorted_effect,
-                                        log_trace, log_hypothetical_trace, log_sorted_effect]).T
-            one_seq_res.columns = ['trace', 'hypothetical_trace', 'sorted_effects',
-                                   'log_trace', 'log_hypothetical_trace', 'log_sorted_effects']
-            one_seq_res['cell_line'] = cell_line
-            one_seq_res['context'] = row['context']
-            one_seq_res['seq_id'] = row['seq_id']
-            traces_all.append(one_seq_res)
-
-            second_it_points = pd.DataFrame(second_it)
-            second_it_points['context'] = row['context']
-            second_it_points['seq_id'] = row['seq_id']
-            second_it_points['cell_line'] = cell_line
-            second_its_all.append(second_it_points.set_index(pd.Index(['wt', 'greedy_it1', 'greedy_it2',
-                                                                       'two_cres_shuffled'])))
-
+        result_paths = [f"{result_dir_model}/{cell_line}/{p.split('/')[-1]}" for p in context_df['path']]
+        results = greedy_search.load_results(result_paths, cre_tiles)
+        info = context_df[['context', 'seq_id']].assign(cell_line=cell_line)
+        for name, table in greedy_search.summary_tables(results, optimization_name, info).items():
+            tables[name].append(table)
 
     greedy_csv_dir = utils.make_dir(f'../results/summary_csvs/{model_name}/greedy_search/')
-    pd.concat(second_its_all).to_csv(f'{greedy_csv_dir}/{optimization_name}_second_iteration.csv')
-    pd.concat(traces_all).to_csv(f'{greedy_csv_dir}/{optimization_name}_traces.csv')
-    pd.concat(locations_all).to_csv(f'{greedy_csv_dir}/{optimization_name}_locations.csv')
+    for name, table in tables.items():
+        pd.concat(table).to_csv(f'{greedy_csv_dir}/{optimization_name}_{name}.csv')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,22 @@
+import sys
+
+from creme import result_store
+
+
+def main():
+    """Copy per-sequence result pickles of a test into a result store, e.g.
+        ./migrate_pickles.py ../results/necessity_test/enformer ../results/result_store/enformer necessity
+    """
+
+    pickle_dir = sys.argv[1]
+    store_dir = sys.argv[2]
+    test = sys.argv[3]
+
+    store = result_store.ResultStore(store_dir, writer='migration')
+    num_migrated = result_store.migrate_pickles(pickle_dir, store, test)
+    print(f'Migrated {num_migrated} pickles from {pickle_dir} to {store_dir} ({test})')
+    store.consolidate(test)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,9 +9,11 @@ import os
 from creme import creme
 from creme import custom_model
 from creme import utils
+from creme import work_queue
 
 
 def main():
+    queue_args = work_queue.parse_args()
     scales = [int(i) for i in sys.argv[1].split(',')]
     thresholds = [float(i) for i in sys.argv[2].split(',')]
     N_batches = [int(i) for i in sys.argv[3].split(',')]
@@ -43,6 +45,8 @@ def main():
 
     minitile_dir = utils.make_dir(f'../results/motifs_{sys.argv[1]}_batch_{sys.argv[3]}_shuffle_{shuffle_num}_thresh_{sys.argv[2]}')
     print(f'Results will be saved in {minitile_dir}')
+    writer = utils.ResultWriter()
+    queue = work_queue.WorkQueue(f'{minitile_dir}/queue', writer=writer, **queue_args)
 
 
 
@@ -57,7 +61,8 @@ def main():
 
         outdir = utils.make_dir(f'{minitile_dir}/{cell_line}')
 
-        for i, row in tqdm(cre_df.iterrows(), total=cre_df.shape[0]):
+        for i, row in tqdm(queue.iterrows(cre_df, key=lambda row: f"{cell_line}_{row['seq_id']}_{row['tile_start']}_{row['tile_end']}"),
+                           total=cre_df.shape[0]):
             result_path = f"{outdir}/{row['seq_id']}_{row['tile_start']}_{row['tile_end']}.pickle"
             print(result_path)
             if not os.path.isfile(result_path):
@@ -84,7 +89,7 @@ def main():
 
                 if not os.path.isfile(result_path):
 
-                    utils.save_pickle(result_path, result_summary)
+                    writer.save_pickle(result_path, result_summary)
                 else:
                     print('File already exists!')
 
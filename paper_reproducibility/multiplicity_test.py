@@ -8,12 +8,14 @@ import copy
 from creme import creme
 from creme import custom_model
 from creme import utils
+from creme import work_queue
 
 
 
 
 
 def main():
+    queue_args = work_queue.parse_args()
     model_name = sys.argv[1]
     # track_index = int(sys.argv[2])
 
@@ -24,7 +26,10 @@ def main():
     fasta_path = f'{data_dir}/GRCh38.primary_assembly.genome.fa'
     result_dir = utils.make_dir(f'../results/multiplicity_test/')
     result_dir_model = utils.make_dir(f'{result_dir}/{model_name}/')
+    writer = utils.ResultWriter()
+    queue = work_queue.WorkQueue(f'{result_dir_model}/queue', writer=writer, **queue_args)
     csv_dir = f'../results/summary_csvs/{model_name}/'
+    all_complete = True
 
     print(f'USING model {model_name}')
     for track_index in [4824, 5110, 5111]:
@@ -51,7 +56,9 @@ def main():
         seq_parser = utils.SequenceParser(fasta_path)
         tss_tile, cre_tiles = utils.set_tile_range(model.seq_length, perturb_window)
 
-        for i, row in tqdm(sufficient_cre_df.iterrows(), total=len(sufficient_cre_df)):
+        for i, row in tqdm(queue.iterrows(sufficient_cre_df,
+                                          key=lambda row: f"{cell_line}_{row['seq_id']}_{row['tile_start']}_{row['tile_end']}"),
+                           total=len(sufficient_cre_df)):
             seq_id = row['seq_id']
             result_path = f"{result_dir_cell}/{seq_id}_tile_start_{row['tile_start']}_tile_end_{row['tile_end']}.pickle"
             print(result_path)
@@ -75,10 +82,13 @@ def main():
 
                 if not os.path.isfile(result_path):
 
-                    utils.save_pickle(result_path, result_summary)
+                    writer.save_pickle(result_path, result_summary)
                 else:
                     print('File already exists!')
+        all_complete &= queue.complete
 
+    if not all_complete:  # summarize once all jobs are done
+        return
 
     ######SUMMARIZE RESULTS
     sufficient_cre_df = pd.read_csv(f'{csv_dir}/sufficient_CREs.csv')
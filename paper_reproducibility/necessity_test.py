@@ -9,11 +9,14 @@ import json
 
 from creme import creme
 from creme import custom_model
-from creme import utilsf
+from creme import utils
+from creme import work_queue
 
 
 def main():
 
+    queue_args = work_queue.parse_args()
+    shuffle_args = utils.parse_shuffle_args()
     model_name = sys.argv[1]
     perturb_window = 5000
     num_shuffle = 10
@@ -21,6 +24,8 @@ def main():
     csv_dir = f'../results/summary_csvs/{model_name}/'
     fasta_path = f'{data_dir}/GRCh38.primary_assembly.genome.fa'
     result_dir_model = utils.make_dir(f"{utils.make_dir(f'../results/necessity_test')}/{model_name}/")
+    writer = utils.ResultWriter()
+    queue = work_queue.WorkQueue(f'{result_dir_model}/queue', writer=writer, **queue_args)
 
     print(f'USING model {model_name}')
     if model_name.lower() == 'enformer':
@@ -50,20 +55,31 @@ def main():
     # set up sequence parser from fasta
     seq_parser = utils.SequenceParser(fasta_path)
 
+    def load_seq(row):
+        # get seq from reference genome and convert to one-hot, in the background while the model predicts,
+        # None if the result exists
+        seq_id = row['path'].split('/')[-1].split('.')[0]
+        if os.path.isfile(f'{result_dir_model}/{seq_id}.pickle'):
+            return None
+        chrom, start, strand = seq_id.split('_')[1:]
+        return seq_parser.extract_seq_centered(chrom, int(start), strand, model.seq_length, onehot=True)
 
-    for i, row in tqdm(context_df.iterrows(), total=len(context_df)):
+    for i, row, x in tqdm(queue.iterrows(context_df, key=lambda row: row['path'].split('/')[-1].split('.')[0],
+                                         load=load_seq), total=len(context_df)):
         seq_id = row['path'].split('/')[-1].split('.')[0]
         result_path = f'{result_dir_model}/{seq_id}.pickle'
         print(result_path)
-        if not os.path.isfile(result_path):
-            chrom, start, strand = seq_id.split('_')[1:]
-            # get seq from reference genome and convert to one-hot
-            x = seq_parser.extract_seq_centered(chrom, int(start), strand, model.seq_length, onehot=True)
-
+        if x is not None:
             # perform CRE Necessity Test
-            pred_wt, pred_mut, std_mut = creme.necessity_test(model, x, cre_tiles, num_shuffle, mean=True)
-            utils.save_pickle(result_path, {'wt': pred_wt, 'mut': pred_mut, 'mut_std': std_mut})
+            test_res = creme.necessity_test(model, x, cre_tiles, num_shuffle, mean=True, **shuffle_args)
+            result_dict = {'wt': test_res[0], 'mut': test_res[1], 'mut_std': test_res[2]}
+            if shuffle_args['tol'] is not None:
+                result_dict['num_shuffle'] = test_res[3]  # per tile
+            writer.save_pickle(result_path, result_dict)
+
 
+    if not queue.complete:  # summarize once all jobs are done
+        return
 
     ######### SUMMARIZE RESULTS
     cre_tile_coords = pd.DataFrame(cre_tiles)
@@ -74,7 +90,7 @@ def main():
         for _, row in cell_line_context.iterrows():
             res_path = f'{result_dir_model}/{row["seq_id"]}.pickle'
             res_raw = utils.read_pickle(res_path)
-            res = {k: r[:, :, c].mean(axis=1) for k, r in res_raw.items()}
+            res = {k: res_raw[k][:, :, c].mean(axis=1) for k in ['wt', 'mut', 'mut_std']}
             # res['mut'] = np.delete(res['mut'], 19)
             one_seq = pd.DataFrame((res['wt'] - res['mut']) / res['wt'])
             one_seq.columns = ['Normalized shuffle effect']
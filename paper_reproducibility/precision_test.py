@@ -0,0 +1,126 @@
+import pandas as pd
+import numpy as np
+import sys, os
+from tqdm import tqdm
+
+sys.path.append('./borzoi')
+import borzoi_custom_model
+
+from creme import creme
+from creme import custom_model
+from creme import utils
+from creme import work_queue
+
+
+def main():
+    """Compare necessity and sufficiency effect sizes of a reduced-precision model against float32.
+    Run once with float32 and once with the reduced precision on the same held-out genes, e.g.
+        ./precision_test.py enformer float32 100 10
+        ./precision_test.py enformer bfloat16 100 10
+    The same works with borzoi instead of enformer.
+    """
+
+    queue_args = work_queue.parse_args()
+    model_name = sys.argv[1]
+    precision = sys.argv[2]
+    num_genes = int(sys.argv[3])
+    num_shuffle = int(sys.argv[4])
+    perturb_window = 5000
+    data_dir = '../data/'
+    csv_dir = f'../results/summary_csvs/{model_name}/'
+    fasta_path = f'{data_dir}/GRCh38.primary_assembly.genome.fa'
+    result_dir_model = utils.make_dir(f"{utils.make_dir(f'../results/precision_test')}/{model_name}/")
+    result_dir = utils.make_dir(f'{result_dir_model}/{precision}/')
+    writer = utils.ResultWriter()
+    queue = work_queue.WorkQueue(f'{result_dir}/queue', writer=writer, **queue_args)
+
+    print(f'USING model {model_name} in {precision}')
+    if model_name.lower() == 'enformer':
+        track_index = [4824, 5110, 5111]
+        bin_index = [447, 448]
+        model = custom_model.Enformer(track_index=track_index, bin_index=bin_index, precision=precision)
+        target_df = pd.read_csv(f'{data_dir}/enformer_targets_human.txt', sep='\t')
+        cell_lines = [utils.clean_cell_name(target_df.iloc[t]['description']) for t in track_index]
+        cell_outputs = [[c] for c in range(len(track_index))]  # output tracks of each cell line
+
+    elif model_name.lower() == 'borzoi':
+        # precision is process-wide, so set it before the Borzoi replicates (SeqNN) are built
+        custom_model.set_cpu_precision(precision)
+        target_df = pd.read_csv(f'{data_dir}/borzoi_targets_human.txt', sep='\t')
+        cell_lines_for_search = ['K562 ENCODE, biol_', 'GM12878 ENCODE, biol_', 'PC-3']
+        cell_line_info, cage_tracks = utils.get_borzoi_targets(target_df, cell_lines_for_search)
+        print('Loading Borzoi(s)')
+        model = borzoi_custom_model.Borzoi(f'{data_dir}/borzoi/*/*', track_index=cage_tracks, aggregate=True)
+        model.bin_index = list(np.arange(model.target_lengths // 2 - 4, model.target_lengths // 2 + 4, 1))
+        cell_lines = [cell_line.split()[0] for cell_line in cell_lines_for_search]
+        cell_outputs = [cell_line_info[cell_line]['output'] for cell_line in cell_lines_for_search]
+
+    else:
+        print('Unkown model')
+        sys.exit(1)
+
+    # same held-out genes for every precision
+    context_df = pd.concat([pd.read_csv(f'{csv_dir}/{cell_line}_selected_contexts.csv')
+                            for cell_line in cell_lines]).drop_duplicates('path')
+    context_df = context_df.sample(n=min(num_genes, len(context_df)), random_state=42)
+
+    # get coordinates of central tss
+    tss_tile, cre_tiles = utils.set_tile_range(model.seq_length, perturb_window)
+    # set up sequence parser from fasta
+    seq_parser = utils.SequenceParser(fasta_path)
+
+    def load_seq(row):
+        # get seq from reference genome and convert to one-hot, in the background while the model predicts,
+        # None if the result exists
+        seq_id = row['path'].split('/')[-1].split('.')[0]
+        if os.path.isfile(f'{result_dir}/{seq_id}.pickle'):
+            return None
+        chrom, start, strand = seq_id.split('_')[1:]
+        return seq_parser.extract_seq_centered(chrom, int(start), strand, model.seq_length, onehot=True)
+
+    for i, row, x in tqdm(queue.iterrows(context_df, key=lambda row: row['path'].split('/')[-1].split('.')[0],
+                                         load=load_seq), total=len(context_df)):
+        seq_id = row['path'].split('/')[-1].split('.')[0]
+        result_path = f'{result_dir}/{seq_id}.pickle'
+        if x is not None:
+            # seeded shuffles so that every precision sees the same sequences
+            pred_wt, pred_mut, _ = creme.necessity_test(model, x, cre_tiles, num_shuffle, mean=True, seed=True)
+            necessity = (pred_wt[0] - pred_mut).mean(axis=1) / pred_wt[0].mean(axis=0)
+            pred_wt, pred_mut, _, pred_control, _ = creme.sufficiency_test(model, x, tss_tile, cre_tiles, num_shuffle,
+                                                                           mean=True, seed=True)
+            sufficiency = (pred_mut - pred_control).mean(axis=1) / pred_wt.mean(axis=0)
+            writer.save_pickle(result_path, {'necessity': necessity, 'sufficiency': sufficiency})
+
+    if precision == 'float32' or not queue.complete:
+        return
+
+    ######### COMPARE TO FLOAT32
+    result_summary = []
+    for _, row in context_df.iterrows():
+        seq_id = row['path'].split('/')[-1].split('.')[0]
+        ref_path = f'{result_dir_model}/float32/{seq_id}.pickle'
+        if not os.path.isfile(ref_path):
+            print(f'Missing float32 results, run: ./precision_test.py {model_name} float32 {num_genes} {num_shuffle}')
+            sys.exit(1)
+        res_ref = utils.read_pickle(ref_path)
+        res = utils.read_pickle(f'{result_dir}/{seq_id}.pickle')
+        for test in ['necessity', 'sufficiency']:
+            for c, cell_line in enumerate(cell_lines):
+                one_seq = pd.DataFrame({'float32': res_ref[test][:, cell_outputs[c]].mean(axis=-1),
+                                        precision: res[test][:, cell_outputs[c]].mean(axis=-1)})
+                one_seq['tile'] = np.arange(len(cre_tiles))
+                one_seq['seq_id'] = seq_id
+                one_seq['test'] = test
+                one_seq['cell_line'] = cell_line
+                result_summary.append(one_seq)
+    result_summary = pd.concat(result_summary)
+    result_summary.to_csv(f'{csv_dir}/precision_test_{precision}.csv')
+
+    for (test, cell_line), df in result_summary.groupby(['test', 'cell_line']):
+        r = np.corrcoef(df['float32'], df[precision])[0, 1]
+        max_diff = np.abs(df['float32'] - df[precision]).max()
+        print(f'{test} {cell_line}: Pearson r = {r:.4f}, max abs difference = {max_diff:.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,15 @@
 import pandas as pd
-import pyBigWig
-from tqdm import tqdm
 import numpy as np
 import sys
 from creme import utils
+from creme import bigwig_signal
 
 
 
 def main():
     res_dir = utils.make_dir('../results/biochemical_marks')
     cre_size = 5000
+    num_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4 # bigwig tracks read in parallel
     # load enhancing and silencing tiles
     selected_cres = pd.read_csv(f'../results/summary_csvs/enformer/sufficient_CREs.csv')
 
@@ -38,7 +38,19 @@ def main():
             subsampled.append(tile_df)
     cres = pd.concat(subsampled)
 
+    # coordinates of the CREs from the tile positions relative to the TSS
     model_seq_length = 196608
+    seq_info = cres['seq_id'].str.split('_', expand=True)
+    tss = seq_info[2].astype(int).values
+    delta = cres['tile_end'].values - cre_size // 2 - model_seq_length // 2
+    cre_midpoint_coord = np.where(seq_info[3].values == '+', tss + delta, tss - delta)
+    cres['chrom'] = seq_info[1].values
+    cres['start'] = cre_midpoint_coord - cre_size // 2
+    cres['end'] = cre_midpoint_coord + cre_size // 2
+    cres['CRE id'] = cres['chrom'] + '_' + cres['start'].astype(str) + '_' + cres['end'].astype(str)
+    cres['CRE type'] = cres['tile class']
+    cres = cres.sort_values('tile class', kind='stable')
+
     for assay in ['histone', 'accessibility', 'tf']:
         print(f'Processing {assay} marks')
         all_features = []
@@ -46,55 +58,28 @@ def main():
             print(f'Processing {cell_line}')
             assay_dir = f'../data/biochemical_marks/{cell_line}/{assay}'
             metadata = pd.read_csv(f'{assay_dir}/metadata.csv')
-            cell_df = cres[cres['cell_line'] == cell_line]
-
-            for m, metadata_row in tqdm(metadata.iterrows()):  # per bigwig track
-                # get generic descriptors
-                bw_id = metadata_row['File accession']
-
-                if assay == 'accessibility':
-                    descr = metadata_row['Assay']
-                else:
-                    descr = metadata_row['Experiment target'].split('-')[0]
+            cell_df = cres[cres['cell_line'] == cell_line][['chrom', 'start', 'end', 'CRE type', 'CRE id']]
 
-                # read in values
-                bw = pyBigWig.open(f'{assay_dir}/{bw_id}.bigWig')
+            # generic descriptors of each bigwig track
+            tracks = pd.DataFrame({'path': [f'{assay_dir}/{bw_id}.bigWig' for bw_id in metadata['File accession']],
+                                   'track_id': metadata.index})
+            if assay == 'accessibility':
+                tracks['epigenetic mark'] = metadata['Assay'].values
+            else:
+                tracks['epigenetic mark'] = metadata['Experiment target'].str.split('-').str[0].values
 
-                for cre_type, df in cell_df.groupby('tile class'):
-                    vals_mean = []
-                    vals_max = []
-                    cre_types = []
-                    cre_id = []
-                    for i, row in df.iterrows():
-                        chrom, tss, strand = row['seq_id'].split('_')[1:]
-                        tss = int(tss)
-                        cre_midpoint = row['tile_end'] - cre_size // 2
-                        delta = cre_midpoint - model_seq_length // 2
-                        if strand == "+":
-                            cre_midpoint_coord = tss + delta
-                        elif strand == '-':
-                            cre_midpoint_coord = tss - delta
-                        cre_start = cre_midpoint_coord - cre_size // 2
-                        cre_end = cre_midpoint_coord + cre_size // 2
-                        v = bw.values(chrom, cre_start, cre_end)
-                        vals_max.append(np.max(v))
-                        vals_mean.append(np.mean(v))
-                        cre_types.append(cre_type)
-                        cre_id.append(f"{chrom}_{cre_start}_{cre_end}")
-                    df = pd.DataFrame([vals_mean, vals_max, cre_types, cre_id]).T
-                    df.columns = ['Mean coverage', 'Max coverage', 'CRE type', 'CRE id']
-                    df['assay'] = assay
-                    df['cell line'] = cell_line
-                    df['epigenetic mark'] = descr
-                    df['track_id'] = m
-
-                    all_features.append(df)
-                bw.close()
+            # all tracks of the cell line in parallel, one read per block of nearby CREs
+            features = bigwig_signal.signal_table(tracks, cell_df, num_workers=num_workers)
+            features = features.rename(columns={'mean': 'Mean coverage', 'max': 'Max coverage'})
+            features['assay'] = assay
+            features['cell line'] = cell_line
+            features.index = features.groupby(['track_id', 'CRE type']).cumcount()
+            all_features.append(features[['Mean coverage', 'Max coverage', 'CRE type', 'CRE id', 'assay',
+                                          'cell line', 'epigenetic mark', 'track_id']])
 
         all_features = pd.concat(all_features)
 
         all_features.to_csv(f'{res_dir}/{assay}.csv')
 
-
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,6 +1,7 @@
 import pandas as pd
 import numpy as np
 import glob
+import functools
 import sys, os
 
 from tqdm import tqdm
@@ -8,6 +9,24 @@ from tqdm import tqdm
 from creme import custom_model
 from creme import utils
 
+def summarize_motif_scores(prune_res, xstreme_res, saliency_res, bps):
+    """Fraction of the CRE effect left after CREME pruning, saliency and XSTREME motif masking of one tile."""
+    # CREME results
+    creme_frac = np.array([1] + prune_res[500]['scores'][:-1] + prune_res[50]['scores'])
+    creme_bps = bps[:len(creme_frac)]
+    control = prune_res['mut']
+
+    # Saliency
+    saliency_frac = np.array(saliency_res['saliency']) / control
+    random_frac = np.array(saliency_res['random']) / control
+    df = pd.DataFrame([creme_frac, creme_bps, saliency_frac, random_frac]).T
+    df.columns = ['CREME score', 'CREME bps', 'Saliency score', 'Random score']
+
+    # XSTREME
+    df['XSTREME score'] = xstreme_res['motifs'] / control
+    return df
+
+
 def main():
     summary_csv_dir = utils.make_dir('../results/summary_csvs/enformer/motif_analysis')
     xstreme_res_dir = '../results/XSTREME/FIMO/'
@@ -19,27 +38,18 @@ def main():
     bps = np.arange(0, 5001, 500)
     dfs = []
     for a, (index, cell_line) in enumerate({4824: 'PC-3', 5110: 'GM12878', 5111: 'K562'}.items()):
-        for s, seq_tile_id in enumerate(os.listdir(f'{saliency_dir}/{index}/')):
-            # CREME results
-            prune_res = utils.read_pickle(f'{result_dir}/{cell_line}/{seq_tile_id}')
-            creme_frac = np.array([1] + prune_res[500]['scores'][:-1] + prune_res[50]['scores'])
-            creme_bps = bps[:len(creme_frac)]
-            control = prune_res['mut']
-
-            # XSTREME
-            xstreme_res = utils.read_pickle(
-                glob.glob(f'{xstreme_res_dir}/{cell_line}_enhancers_*/{seq_tile_id}')[0])
-
-            # Saliency
-            saliency_res = utils.read_pickle(f'{saliency_dir}/{index}/{seq_tile_id}')
-            saliency_frac = np.array(saliency_res['saliency']) / control
-            random_frac = np.array(saliency_res['random']) / control
-            df = pd.DataFrame([creme_frac, creme_bps, saliency_frac, random_frac]).T
-            df.columns = ['CREME score', 'CREME bps', 'Saliency score', 'Random score']
-            df['XSTREME score'] = xstreme_res['motifs'] / control
-            df['seq_id'] = seq_tile_id
-            df['cell_line'] = cell_line
-            dfs.append(df)
+        seq_tile_ids = os.listdir(f'{saliency_dir}/{index}/')
+        xstreme_paths = {}
+        for path in glob.glob(f'{xstreme_res_dir}/{cell_line}_enhancers_*/*'):
+            xstreme_paths.setdefault(os.path.basename(path), path)
+        manifest = pd.DataFrame({'prune_path': [f'{result_dir}/{cell_line}/{s}' for s in seq_tile_ids],
+                                 'xstreme_path': [xstreme_paths[s] for s in seq_tile_ids],
+                                 'saliency_path': [f'{saliency_dir}/{index}/{s}' for s in seq_tile_ids],
+                                 'seq_id': seq_tile_ids,
+                                 'cell_line': cell_line})
+        df = utils.aggregate_pickles(manifest, functools.partial(summarize_motif_scores, bps=bps),
+                                     path_columns=['prune_path', 'xstreme_path', 'saliency_path'])
+        dfs.append(df.drop(columns=['prune_path', 'xstreme_path', 'saliency_path']))
     dfs = pd.concat(dfs)
     dfs.to_csv(f'{summary_csv_dir}/CREME_vs_saliency_vs_XSTREME.csv')
 
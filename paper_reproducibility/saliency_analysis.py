@@ -7,8 +7,10 @@ import os
 from creme import creme
 from creme import custom_model
 from creme import utils
+from creme import work_queue
 
 def main():
+    queue_args = work_queue.parse_args()
     track_index = int(sys.argv[1])
 
     model_name = 'enformer'
@@ -22,6 +24,8 @@ def main():
 
     result_dir = utils.make_dir(f'../results/saliency/')
     result_dir = utils.make_dir(f"{result_dir}/{track_index}/")
+    writer = utils.ResultWriter()
+    queue = work_queue.WorkQueue(f'{result_dir}/queue', writer=writer, **queue_args)
     csv_dir = f'../results/summary_csvs/{model_name}/'
     cre_df_path = f'{csv_dir}/sufficient_CREs.csv'
     all_cre_set = pd.read_csv(cre_df_path)
@@ -31,7 +35,8 @@ def main():
 
     for cell_line, cre_set in all_cre_set.groupby('cell_line'):
 
-        for r, row in tqdm(cre_set.iterrows(), total=cre_set.shape[0]):
+        for r, row in tqdm(queue.iterrows(cre_set, key=lambda row: f"{row['seq_id']}_{row['tile_start']}_{row['tile_end']}"),
+                           total=cre_set.shape[0]):
             tile_start, tile_end = row['tile_start'], row['tile_end']
             result_path = f"{result_dir}/{row['seq_id']}_{row['tile_start']}_{row['tile_end']}.pickle"
             prune_res_path = f"../results/motifs_500,50_batch_1,10_shuffle_10_thresh_0.9,0.7/{cell_line}/{row['seq_id']}_{row['tile_start']}_{row['tile_end']}.pickle"
@@ -57,19 +62,13 @@ def main():
                 saliency_positions = [l + row['tile_start'] for l in np.argsort(cre_saliency_scores)]
                 random_pos = [l + row['tile_start'] for l in
                               np.random.choice(list(range(tile_end - tile_start)), 5000, replace=False)]
-                result_summary = {}
-                for label, mask in {'saliency': saliency_positions, 'abs_saliency': abs_saliency_positions,
-                                    'random': random_pos}.items():
-                    preds = []
-                    for bp in bps:
-                        current_mask = mask.copy()[:bp]
-                        prune_seqs = control_sequences.copy()
-                        prune_seqs[:, tile_start: tile_end, :] = wt_seq[tile_start:tile_end].copy()
-                        prune_seqs[:, current_mask, :] = control_sequences[:, current_mask, :].copy()
-
-                        preds.append(model.predict(prune_seqs)[:, target_bins, track_index].mean())
-                    result_summary[label] = preds
-                utils.save_pickle(result_path, result_summary)
+                # activity as positions are pruned in the order of each ranking, all points predicted in batches
+                rankings = {'saliency': saliency_positions, 'abs_saliency': abs_saliency_positions,
+                            'random': random_pos}
+                curves = creme.pruning_curve(model, wt_seq, control_sequences, [tile_start, tile_end], rankings, bps,
+                                             reduce_fn=lambda pred: pred[:, target_bins, track_index].mean(axis=1))
+                result_summary = {label: list(curve) for label, curve in curves.items()}
+                writer.save_pickle(result_path, result_summary)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -8,9 +8,11 @@ import json
 from creme import creme
 from creme import custom_model
 from creme import utils
+from creme import work_queue
 from creme import shuffle
 
 def main():
+    queue_args = work_queue.parse_args()
     model_name = sys.argv[1]
     # track_index = int(sys.argv[2])
     optimization_name = sys.argv[2]
@@ -21,7 +23,10 @@ def main():
     fasta_path = f'{data_dir}/GRCh38.primary_assembly.genome.fa'
     higher_order_test_result_dir = f'../results/higher_order_test_{optimization_name}/{model_name}' # existing results
     result_dir_model = utils.make_dir(f'{higher_order_test_result_dir}/sufficiency/')
+    writer = utils.ResultWriter()
+    queue = work_queue.WorkQueue(f'{result_dir_model}/queue', writer=writer, **queue_args)
     csv_dir = f'../results/summary_csvs/{model_name}/'
+    all_complete = True
 
     for track_index in [4824, 5110, 5111]:
         print(f'USING model {model_name}')
@@ -50,7 +55,9 @@ def main():
         # set up sequence parser from fasta
         seq_parser = utils.SequenceParser(fasta_path)
 
-        for i, row in tqdm(context_df.iterrows(), total=len(context_df)):
+        for i, row in tqdm(queue.iterrows(context_df,
+                                          key=lambda row: f"{cell_line}_{row['path'].split('/')[-1].split('.')[0]}"),
+                           total=len(context_df)):
             seq_id = row['path'].split('/')[-1].split('.')[0]
             result_path = f'{result_dir_cell}/{seq_id}.pickle'
             print(result_path)
@@ -73,8 +80,11 @@ def main():
                     current_seq[:, tile_start: tile_end, :] = x[tile_start: tile_end, :].copy()
                     result_summary['predictions'].append(model.predict(current_seq).mean())
                     result_summary['tile_added'].append(old_res[i]['selected_tile'])
-                utils.save_pickle(result_path, result_summary)
+                writer.save_pickle(result_path, result_summary)
+        all_complete &= queue.complete
 
+    if not all_complete:  # summarize once all jobs are done
+        return
 
     ######SUMMARIZE
     if optimization_name == 'min':
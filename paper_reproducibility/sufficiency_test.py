@@ -1,4 +1,5 @@
 import glob
+import functools
 import pickle
 import pandas as pd
 import numpy as np
@@ -13,14 +14,28 @@ import borzoi_custom_model
 from creme import creme
 from creme import custom_model
 from creme import utils
+from creme import work_queue
 
 
 
 
 
 
+def summarize_sufficiency(res, bin_index, cell_index, tile_df):
+    """Sufficiency of every tile of one sequence at the TSS bins of a cell line."""
+    wt = res['wt'][bin_index, cell_index].mean(axis=0)
+    mut = res['mut'][:, bin_index, cell_index].mean(axis=1)
+    control = res['control'][:, bin_index, cell_index].mean(axis=1)
+    return pd.DataFrame({'(MUT - CONTROL) / WT': (mut - control) / wt,
+                         '(MUT - CONTROL) / CONTROL': (mut - control) / control,
+                         'control': control, 'wt': wt, 'mut': mut,
+                         'tile_start': tile_df[0].values, 'tile_end': tile_df[1].values})
+
+
 def main():
 
+    queue_args = work_queue.parse_args()
+    shuffle_args = utils.parse_shuffle_args()
     model_name = sys.argv[1]
     num_shuffle = int(sys.argv[2])
     perturb_window = 5000
@@ -28,6 +43,8 @@ def main():
     data_dir = '../data/'
     fasta_path = f'{data_dir}/GRCh38.primary_assembly.genome.fa'
     result_dir_model = utils.make_dir(f"{utils.make_dir(f'../results/sufficiency_test')}/{model_name}/")
+    writer = utils.ResultWriter()
+    queue = work_queue.WorkQueue(f'{result_dir_model}/queue', writer=writer, **queue_args)
     csv_dir = f'../results/summary_csvs/{model_name}/'
 
     print(f'USING model {model_name}')
@@ -82,28 +99,35 @@ def main():
     # set up sequence parser from fasta
     seq_parser = utils.SequenceParser(fasta_path)
 
+    def load_seq(row):
+        # get seq from reference genome and convert to one-hot, in the background while the model predicts,
+        # None if the result exists
+        seq_id = row['path'].split('/')[-1].split('.')[0]
+        if os.path.isfile(f'{result_dir_model}/{seq_id}.pickle'):
+            return None
+        chrom, start, strand = seq_id.split('_')[1:]
+        return seq_parser.extract_seq_centered(chrom, int(start), strand, model.seq_length, onehot=True)
 
-    for i, row in tqdm(context_df.iterrows(), total=len(context_df)):
+    for i, row, x in tqdm(queue.iterrows(context_df, key=lambda row: row['path'].split('/')[-1].split('.')[0],
+                                         load=load_seq), total=len(context_df)):
         seq_id = row['path'].split('/')[-1].split('.')[0]
         result_path = f'{result_dir_model}/{seq_id}.pickle'
         print(result_path)
-        if not os.path.isfile(result_path):
-            chrom, start, strand = seq_id.split('_')[1:]
-            # get seq from reference genome and convert to one-hot
-            x = seq_parser.extract_seq_centered(chrom, int(start), strand, model.seq_length, onehot=True)
-
+        if x is not None:
             # perform CRE Necessity Test
-            pred_wt, pred_mut_mean, pred_mut_std, pred_control_mean, pred_control_std = creme.sufficiency_test(model, x,
-                                                                                                               tss_tile,
-                                                                                                             cre_tiles,
-                                                                                                             num_shuffle,
-                                                                                                             mean=True)
+            test_res = creme.sufficiency_test(model, x, tss_tile, cre_tiles, num_shuffle, mean=True, **shuffle_args)
+            pred_wt, pred_mut_mean, pred_mut_std, pred_control_mean, pred_control_std = test_res[:5]
             result_dict = {'wt': pred_wt, 'mut': pred_mut_mean, 'mut_std': pred_mut_std,
                                             'control': pred_control_mean, 'control_std': pred_control_std}
+            if shuffle_args['tol'] is not None:
+                result_dict['num_shuffle'] = test_res[5]  # per tile
 
 
             if not os.path.isfile(result_path):
-                utils.save_pickle(result_path, result_dict)
+                writer.save_pickle(result_path, result_dict)
+
+    if not queue.complete:  # summarize once all jobs are done
+        return
 
     if model_name == 'enformer':
         ######## SUMMARIZE RESULTS
@@ -113,26 +137,15 @@ def main():
         for c, cell_line in enumerate(cell_lines):
             cell_line_context = context_dfs_per_cell[cell_line]
             print(c, cell_line)
-            for _, row in cell_line_context.iterrows():
-                res_path = f'{result_dir_model}/{row["seq_id"]}.pickle'
-                res = utils.read_pickle(res_path)
-                res['wt'] = res['wt'][bin_index, c].mean(axis=0)
-                res['mut'] = res['mut'][:, bin_index, c].mean(axis=1)
-                res['control'] = res['control'][:, bin_index, c].mean(axis=1)
-                # one_seq = pd.DataFrame((res['mut'] - res['control']) / res['wt'])
-                one_seq = pd.DataFrame((res['mut']-res['control']) / res['wt'])
-
-                one_seq.columns = ['(MUT - CONTROL) / WT']
-                one_seq['(MUT - CONTROL) / CONTROL'] = (res['mut']-res['control']) / res['control']
-                one_seq['seq_id'] = row['seq_id']
-                one_seq['control'] = res['control']
-                one_seq['wt'] = res['wt']
-                one_seq['mut'] = res['mut']
-                one_seq['tile_start'] = tile_df[0].values
-                one_seq['tile_end'] = tile_df[1].values
-                one_seq['context'] = row['context']
-                one_seq['cell_line'] = cell_line
-                result_summary.append(one_seq)
+            manifest = cell_line_context[['seq_id', 'context']].copy()
+            manifest['path'] = [f'{result_dir_model}/{seq_id}.pickle' for seq_id in manifest['seq_id']]
+            one_cell = utils.aggregate_pickles(manifest,
+                                               functools.partial(summarize_sufficiency, bin_index=bin_index,
+                                                                 cell_index=c, tile_df=tile_df),
+                                               cache_path=f'{result_dir_model}/summary_cache_{c}.pickle')
+            one_cell['cell_line'] = cell_line
+            result_summary.append(one_cell[['(MUT - CONTROL) / WT', '(MUT - CONTROL) / CONTROL', 'seq_id', 'control',
+                                            'wt', 'mut', 'tile_start', 'tile_end', 'context', 'cell_line']])
         result_summary = pd.concat(result_summary)
         result_summary.to_csv(f'{csv_dir}/sufficiency_test.csv')
 
@@ -31,6 +31,7 @@ setup(
         "kipoiseq",
         "tensorflow-hub",
         "pyfaidx",
+        "h5py",
         "matplotlib",
         "seaborn",
         "tqdm",